@@ -25,12 +25,15 @@ $Id: ArchivistTool.py,v 1.15 2005/06/24 11:34:08 gregweb Exp $
 """
 
 import time
+from copy import copy
+from hashlib import sha256
 from StringIO import StringIO
 from cPickle import Pickler, Unpickler
 from zope.interface import implements, alsoProvides
 
 from App.class_init import InitializeClass
 from Persistence import Persistent
+from ZODB.blob import Blob
 from Acquisition import aq_base, aq_parent, aq_inner
 from AccessControl import ClassSecurityInfo, getSecurityManager
 from OFS.SimpleItem import SimpleItem
@@ -39,6 +42,7 @@ from Products.CMFCore.utils import UniqueObject, getToolByName
 
 from Products.CMFEditions.utilities import KwAsAttributes
 from Products.CMFEditions.utilities import dereference
+from Products.CMFEditions.interfaces.IStorage import StorageError
 from Products.CMFEditions.interfaces.IStorage import StorageRetrieveError
 from Products.CMFEditions.interfaces.IStorage import StorageUnregisteredError
 
@@ -62,6 +66,8 @@ RETRIEVING_UNREGISTERED_FAILED = \
     "Retrieving a version of an unregistered object is not possible. " \
     "Register the object '%r' first. "
 
+_marker = []
+
 def deepcopy(obj):
     """Makes a deep copy of the object using the pickle mechanism.
     """
@@ -206,6 +212,8 @@ class ArchivistTool(UniqueObject, SimpleItem):
     # -------------------------------------------------------------------
     def _cloneByPickle(self, obj):
         """Returns a deep copy of a ZODB object, loading ghosts as needed.
+
+        The fingerprint of the object is taken from the pickle as well.
         """
         modifier = getToolByName(self, 'portal_modifier')
         callbacks = modifier.getOnCloneModifiers(obj)
@@ -214,18 +222,39 @@ class ArchivistTool(UniqueObject, SimpleItem):
         else:
             inside_orefs, outside_orefs = (), ()
 
-        stream = StringIO()
-        p = Pickler(stream, 1)
-        if callbacks is not None:
-            p.persistent_id = pers_id
-        p.dump(aq_base(obj))
+        stream, fingerprint = self._pickle(obj, callbacks)
         approxSize = stream.tell()
         stream.seek(0)
         u = Unpickler(stream)
         if callbacks is not None:
             u.persistent_load = pers_load
-        return approxSize, u.load(), inside_orefs, outside_orefs
+        return approxSize, u.load(), inside_orefs, outside_orefs, fingerprint
 
+    def _pickle(self, obj, callbacks):
+        """Pickles the object with the hooks of the clone modifiers
+
+        Returns the stream and the fingerprint of the object (a digest of
+        the pickle and of the objects left out by the hooks) or None if
+        the object can't be fingerprinted. The version id isn't pickled,
+        it changes with every save.
+        """
+        stream = StringIO()
+        p = Pickler(stream, 1)
+        left_out = []
+        if callbacks is not None:
+            pers_id = callbacks[0]
+            def persistent_id(obj):
+                pid = pers_id(obj)
+                if pid is not None:
+                    left_out.append(getFingerprintId(obj))
+                return pid
+            p.persistent_id = persistent_id
+        p.dump(_withoutVersionId(obj))
+        if None in left_out:
+            return stream, None
+        digest = sha256(stream.getvalue())
+        digest.update(repr(left_out))
+        return stream, digest.hexdigest()
 
     # -------------------------------------------------------------------
     # methods implementing IArchivist
@@ -262,15 +291,20 @@ class ArchivistTool(UniqueObject, SimpleItem):
         #    history storage by reference
         # 2. clone the object with some modifications
         # 3. modify the clone further
-        referenced_data = modifier.getReferencedAttributes(obj)
-        approxSize, clone, inside_orefs, outside_orefs = \
-            self._cloneByPickle(obj)
-        metadata, inside_crefs, outside_crefs = \
-            modifier.beforeSaveModifier(obj, clone)
+        modifier.beginOperation()
+        try:
+            referenced_data = modifier.getReferencedAttributes(obj)
+            approxSize, clone, inside_orefs, outside_orefs, fingerprint = \
+                self._cloneByPickle(obj)
+            metadata, inside_crefs, outside_crefs = \
+                modifier.beforeSaveModifier(obj, clone)
+        finally:
+            modifier.endOperation()
 
         # extend the ``sys_metadata`` by the metadata returned by the
         # ``beforeSaveModifier`` modifier
         sys_metadata.update(metadata)
+        sys_metadata['fingerprint'] = fingerprint
 
         # set the version id of the clone to be saved to the repository
         # location_id and history_id are the same as on the working copy
@@ -313,6 +347,41 @@ class ArchivistTool(UniqueObject, SimpleItem):
                             prepared_obj.referenced_data,
                             prepared_obj.metadata)
 
+    security.declarePrivate('getFingerprint')
+    def getFingerprint(self, obj, callbacks=_marker):
+        """See IArchivist.
+
+        The object is pickled the same way as when cloning it. Objects
+        left out by the hooks are fingerprinted by their oid (e.g.
+        childrens, their changes get versioned with them), blobs by their
+        oid and serial.
+        """
+        if callbacks is _marker:
+            modifier = getToolByName(self, 'portal_modifier')
+            callbacks = modifier.getOnCloneModifiers(obj)
+        return self._pickle(obj, callbacks)[1]
+
+    security.declarePrivate('isUnchanged')
+    def isUnchanged(self, obj=None, history_id=None, callbacks=_marker,
+                    fingerprint=_marker):
+        """See IArchivist.
+        """
+        storage = getToolByName(self, 'portal_historiesstorage')
+        obj, history_id = dereference(obj, history_id, self)
+        if getattr(aq_base(obj), 'version_id', None) is None \
+           or not storage.isRegistered(history_id):
+            return False
+        try:
+            metadata = storage.getMetadata(history_id)
+        except StorageError:
+            return False
+        saved = metadata.get('sys_metadata', {}).get('fingerprint')
+        if saved is None:
+            return False
+        if fingerprint is _marker:
+            fingerprint = self.getFingerprint(obj, callbacks)
+        return saved == fingerprint
+
     # -------------------------------------------------------------------
     # methods implementing IPurgeSupport
     # -------------------------------------------------------------------
@@ -343,6 +412,19 @@ class ArchivistTool(UniqueObject, SimpleItem):
                 "Retrieving of '%r' failed. Version '%s' does not exist. "
                 % (obj, selector))
 
+    security.declarePrivate('retrieveMany')
+    def retrieveMany(self, obj=None, history_id=None, selectors=(),
+                     preserve=(), countPurged=True):
+        """See IPurgeSupport.
+        """
+        history = self.getHistory(obj, history_id, preserve, countPurged)
+        try:
+            return history.retrieveMany(selectors)
+        except StorageRetrieveError:
+            raise ArchivistRetrieveError(
+                "Retrieving of '%r' failed. One of the versions %s does not "
+                "exist. " % (obj, list(selectors)))
+
     security.declarePrivate('getHistory')
     def getHistory(self, obj=None, history_id=None, preserve=(),
                    countPurged=True):
@@ -405,6 +487,34 @@ def getUserId():
     return getSecurityManager().getUser().getUserName()
 
 
+def _withoutVersionId(obj):
+    """Returns the object or a shallow copy of it without the version id
+
+    The working copy is left untouched.
+    """
+    obj = aq_base(obj)
+    if getattr(obj, 'version_id', None) is None \
+       or 'version_id' not in obj.__dict__:
+        return obj
+    obj = copy(obj)
+    del obj.version_id
+    return obj
+
+
+def getFingerprintId(obj):
+    """Returns what identifies an object left out of the fingerprinted
+    pickle or None if its state isn't committed yet (e.g. a new blob)
+    """
+    oid = getattr(obj, '_p_oid', None)
+    if oid is None:
+        return None
+    if isinstance(obj, Blob):
+        if obj._p_changed or getattr(obj, '_p_blob_uncommitted', None):
+            return None
+        return oid, obj._p_serial
+    return oid
+
+
 class ObjectData(Persistent):
     """
     """
@@ -479,6 +589,9 @@ class LazyHistory:
         self._obj, history_id = dereference(obj, history_id, archivist)
         self._preserve = preserve
         self._history = storage.getHistory(history_id, countPurged)
+        self._storage = storage
+        self._history_id = history_id
+        self._countPurged = countPurged
 
     def __len__(self):
         """See IHistory
@@ -492,8 +605,20 @@ class LazyHistory:
         # steps have to be carried out:
         #
         # 1. get the appropriate data from the storage
-        vdata = self._history[selector]
+        return self._prepareVersionData(self._history[selector])
 
+    def retrieveMany(self, selectors):
+        """Returns the selected versions
+
+        The storage retrieves all versions at once.
+        """
+        vdatas = self._storage.retrieveMany(self._history_id, selectors,
+                                            self._countPurged)
+        return [self._prepareVersionData(vdata) for vdata in vdatas]
+
+    def _prepareVersionData(self, vdata):
+        """Carries out the steps following the retrieval from the storage
+        """
         # 2. clone the data and add the version id
         data = deepcopy(vdata.object)
         repo_clone = aq_base(data.object)
@@ -504,14 +629,18 @@ class LazyHistory:
         # 4. clone the metadata
         metadata = deepcopy(vdata.metadata)
 
-        # 5. reattach the separately saved attributes
-        self._modifier.reattachReferencedAttributes(repo_clone,
-                                                    referenced_data)
-
-        # 6. call the after retrieve modifier
-        refs_to_be_deleted, attr_handling_references, preserved_data = \
-            self._modifier.afterRetrieveModifier(self._obj, repo_clone,
-                                                 self._preserve)
+        self._modifier.beginOperation()
+        try:
+            # 5. reattach the separately saved attributes
+            self._modifier.reattachReferencedAttributes(repo_clone,
+                                                        referenced_data)
+
+            # 6. call the after retrieve modifier
+            refs_to_be_deleted, attr_handling_references, preserved_data = \
+                self._modifier.afterRetrieveModifier(self._obj, repo_clone,
+                                                     self._preserve)
+        finally:
+            self._modifier.endOperation()
 
         return VersionData(data, refs_to_be_deleted,
                            attr_handling_references, preserved_data,
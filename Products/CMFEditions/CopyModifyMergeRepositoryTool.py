@@ -34,6 +34,7 @@ from Acquisition import ImplicitAcquisitionWrapper
 from AccessControl import ClassSecurityInfo, Unauthorized
 from OFS.SimpleItem import SimpleItem
 from BTrees.OOBTree import OOBTree
+from ZODB.POSException import ConflictError
 from zope.event import notify
 from zope.interface import implements, Interface
 from zope.lifecycleevent import ObjectModifiedEvent
@@ -45,6 +46,7 @@ from Products.CMFEditions.interfaces.IArchivist import ArchivistRetrieveError
 
 from Products.CMFEditions.interfaces.IRepository import ICopyModifyMergeRepository
 from Products.CMFEditions.interfaces.IRepository import IPurgeSupport
+from Products.CMFEditions.interfaces.IRepository import IDeferredSaveSupport
 from Products.CMFEditions.interfaces.IRepository import RepositoryPurgeError
 from Products.CMFEditions.interfaces.IRepository import IContentTypeVersionPolicySupport
 from Products.CMFEditions.interfaces.IRepository import IRepositoryTool
@@ -61,6 +63,10 @@ from Products.CMFEditions.Permissions import RevertToPreviousVersions
 from Products.CMFEditions.Permissions import ManageVersioningPolicies
 from Products.CMFEditions.VersionPolicies import VersionPolicy
 from Products.CMFEditions.utilities import STUB_OBJECT_PREFIX
+from Products.CMFEditions.ArchivistTool import getUserId
+from Products.CMFEditions.savequeue import SaveQueue
+from Products.CMFEditions.savequeue import getWorker, wakeupWorker
+from Products.CMFEditions.savequeue import processEntry
 
 try:
     from Products.Archetypes.event import ObjectEditedEvent
@@ -95,6 +101,7 @@ class CopyModifyMergeRepositoryTool(UniqueObject,
 
     implements(
         IPurgeSupport,
+        IDeferredSaveSupport,
         ICopyModifyMergeRepository,
         IContentTypeVersionPolicySupport,
         IRepositoryTool,
@@ -106,6 +113,10 @@ class CopyModifyMergeRepositoryTool(UniqueObject,
     meta_type = 'CMFEditions Standard Copy Modify Merge Repository'
 
     autoapply = True
+    deferredSaving = False
+    coalescedSaving = False
+    _save_queue = None
+    _bulk_checkpoints = None
 
     security = ClassSecurityInfo()
 
@@ -308,6 +319,91 @@ class CopyModifyMergeRepositoryTool(UniqueObject,
             sp.rollback()
             raise
 
+    security.declareProtected(SaveNewVersion, 'saveMany')
+    def saveMany(self, objs, comment='', metadata={}):
+        """See ICopyModifyMergeRepository.
+
+        A failing save is rolled back to the savepoint taken before it.
+        """
+        return self._saveMany(objs, comment, metadata,
+                              autoapply=self.autoapply)
+
+    # -------------------------------------------------------------------
+    # methods implementing IDeferredSaveSupport
+    # -------------------------------------------------------------------
+
+    security.declareProtected(ManageVersioningPolicies, 'setDeferredSaving')
+    def setDeferredSaving(self, deferred):
+        """See IDeferredSaveSupport.
+        """
+        self.deferredSaving = bool(deferred)
+
+    security.declarePublic('isDeferredSaving')
+    def isDeferredSaving(self):
+        """See IDeferredSaveSupport.
+        """
+        return self.deferredSaving
+
+    security.declareProtected(ManageVersioningPolicies, 'setCoalescedSaving')
+    def setCoalescedSaving(self, coalesced):
+        """See IDeferredSaveSupport.
+        """
+        self.coalescedSaving = bool(coalesced)
+
+    security.declarePublic('isCoalescedSaving')
+    def isCoalescedSaving(self):
+        """See IDeferredSaveSupport.
+        """
+        return self.coalescedSaving
+
+    security.declarePublic('enqueueSave')
+    def enqueueSave(self, obj, comment=''):
+        """See IDeferredSaveSupport.
+        """
+        self._assertAuthorized(obj, SaveNewVersion, 'enqueueSave')
+        portal_hidhandler = getToolByName(self, 'portal_historyidhandler')
+        self._getSaveQueue(autoAdd=True).enqueue(
+            '/'.join(obj.getPhysicalPath()),
+            portal_hidhandler.queryUid(obj, None),
+            comment, getUserId(), time.time())
+        # the worker is woken up only if the edit gets committed
+        portal = getToolByName(self, 'portal_url').getPortalObject()
+        transaction.get().addAfterCommitHook(
+            wakeupWorker, (self._p_jar.db(), portal.getPhysicalPath()))
+
+    security.declareProtected(ManageVersioningPolicies,
+                              'getSaveQueueStatistics')
+    def getSaveQueueStatistics(self):
+        """See IDeferredSaveSupport.
+        """
+        queue = self._getSaveQueue()
+        statistics = {'depth': 0, 'lag': 0.0}
+        if queue is not None:
+            statistics['depth'] = len(queue)
+            statistics['lag'] = queue.getLag()
+        if self._p_jar is not None:
+            portal = getToolByName(self, 'portal_url').getPortalObject()
+            worker = getWorker(self._p_jar.db(), portal.getPhysicalPath())
+            if worker is not None:
+                statistics.update(worker.getStatistics())
+        return statistics
+
+    security.declarePrivate('processSaveQueue')
+    def processSaveQueue(self, maxItems=None):
+        """Saves the queued versions in the current transaction
+
+        For maintenance scripts, the worker thread commits every save
+        separately. Returns the number of saved versions.
+        """
+        queue = self._getSaveQueue()
+        if queue is None:
+            return 0
+        portal = getToolByName(self, 'portal_url').getPortalObject()
+        saved = 0
+        for path in queue.getPaths(maxItems):
+            saved += processEntry(portal, path)
+        return saved
+
     # -------------------------------------------------------------------
     # methods implementing IPurgeSupport
     # -------------------------------------------------------------------
@@ -359,12 +455,27 @@ class CopyModifyMergeRepositoryTool(UniqueObject,
         self._doInplaceFixups(fixup_queue, True)
 
     security.declarePublic('retrieve')
-    def retrieve(self, obj, selector=None, preserve=(), countPurged=True):
+    def retrieve(self, obj, selector=None, preserve=(), countPurged=True,
+                 detached=False):
         """See IPurgeSupport.
         """
         self._assertAuthorized(obj, AccessPreviousVersions, 'retrieve')
+        if detached:
+            return self._detachedRetrieve(obj, selector, preserve,
+                                          countPurged)
         return self._retrieve(obj, selector, preserve, countPurged)
 
+    security.declarePublic('retrieveMany')
+    def retrieveMany(self, obj, selectors, preserve=(), countPurged=True,
+                     detached=False):
+        """See IPurgeSupport.
+        """
+        self._assertAuthorized(obj, AccessPreviousVersions, 'retrieveMany')
+        if detached:
+            return self._detachedRetrieveMany(obj, selectors, preserve,
+                                              countPurged)
+        return self._retrieveMany(obj, selectors, preserve, countPurged)
+
     security.declarePublic('restore')
     def restore(self, history_id, selector, container, new_id=None,
                 countPurged=True):
@@ -393,11 +504,12 @@ class CopyModifyMergeRepositoryTool(UniqueObject,
 
     security.declarePublic('getHistory')
     def getHistory(self, obj, oldestFirst=False, preserve=(),
-                   countPurged=True):
+                   countPurged=True, detached=False):
         """See IPurgeSupport.
         """
         self._assertAuthorized(obj, AccessPreviousVersions, 'getHistory')
-        return LazyHistory(self, obj, oldestFirst, preserve, countPurged)
+        return LazyHistory(self, obj, oldestFirst, preserve, countPurged,
+                           detached)
 
     security.declarePublic('getHistoryMetadata')
     def getHistoryMetadata(self, obj):
@@ -433,6 +545,58 @@ class CopyModifyMergeRepositoryTool(UniqueObject,
         if not _checkPermission(permission, obj):
             raise Unauthorized(name)
 
+    def _saveMany(self, objs, comment, metadata, autoapply,
+                  permission=SaveNewVersion):
+        # the transaction boundaries are up to the caller (e.g. the bulk
+        # versioning job commits after every batch)
+        sys_metadata = self._prepareSysMetadata(comment)
+        tools = {
+            'portal_archivist': getToolByName(self, 'portal_archivist'),
+            'portal_modifier': getToolByName(self, 'portal_modifier'),
+        }
+        results = []
+        for obj in objs:
+            if not _checkPermission(permission, obj):
+                results.append((obj, Unauthorized(permission)))
+                continue
+            sp = transaction.savepoint(optimistic=True)
+            try:
+                # the originator is set per saved object
+                self._recursiveSave(obj, metadata, dict(sys_metadata),
+                                    autoapply=autoapply, tools=tools)
+            except ConflictError:
+                raise
+            except Exception, e:
+                sp.rollback()
+                results.append((obj, e))
+                continue
+            results.append((obj, None))
+        return results
+
+    def _getSaveQueue(self, autoAdd=False):
+        if self._save_queue is None and autoAdd:
+            self._save_queue = SaveQueue()
+        return self._save_queue
+
+    def _getBulkCheckpoints(self, autoAdd=False):
+        # checkpoints of the bulk versioning jobs by worker
+        if self._bulk_checkpoints is None and autoAdd:
+            self._bulk_checkpoints = OOBTree()
+        return self._bulk_checkpoints
+
+    def _saveQueued(self, obj, comment, timestamp):
+        # the permission was checked when queueing the save
+        sys_metadata = self._prepareSysMetadata(comment)
+        sys_metadata['timestamp'] = timestamp
+        sp = transaction.savepoint(optimistic=True)
+        try:
+            self._recursiveSave(obj, {}, sys_metadata,
+                                autoapply=self.autoapply)
+        except ModifierException:
+            # modifiers can abort save operations under certain conditions
+            sp.rollback()
+            raise
+
     def _prepareSysMetadata(self, comment):
         return {
             # comment is system metadata
@@ -445,9 +609,19 @@ class CopyModifyMergeRepositoryTool(UniqueObject,
             'originator': None,
         }
 
-    def _recursiveSave(self, obj, app_metadata, sys_metadata, autoapply):
+    def _recursiveSave(self, obj, app_metadata, sys_metadata, autoapply,
+                       tools=None, skipUnchanged=False):
+        """Saves the object and its changed inside references
+
+        If ``skipUnchanged`` is ``True`` no version is saved if neither
+        the object nor its inside references changed since their last
+        versions. Returns ``True`` if a version was saved.
+        """
         # prepare the save of the originating working copy
-        portal_archivist = getToolByName(self, 'portal_archivist')
+        if tools is None:
+            portal_archivist = getToolByName(self, 'portal_archivist')
+        else:
+            portal_archivist = tools['portal_archivist']
         prep = portal_archivist.prepare(obj, app_metadata, sys_metadata)
 
         # set the originator of the save operation for the referenced
@@ -461,17 +635,28 @@ class CopyModifyMergeRepositoryTool(UniqueObject,
         # What comes now is the current hardcoded policy:
         #
         # - recursively save inside references, then set a version aware
-        #   reference
+        #   reference (inside references unchanged since their last
+        #   version aren't saved again but just referenced)
         # - on outside references only set a version aware reference
         #   (if under version control)
         inside_refs = map(lambda original_refs, clone_refs:
                           (original_refs, clone_refs.getAttribute()),
                           prep.original.inside_refs, prep.clone.inside_refs)
+        saved = False
         for orig_ref, clone_ref in inside_refs:
-            self._recursiveSave(orig_ref, app_metadata, sys_metadata,
-                                autoapply)
+            # the inside references get their own system metadata (the
+            # archivist adds the size and fingerprint of every object)
+            saved = self._recursiveSave(orig_ref, app_metadata,
+                                        dict(sys_metadata), autoapply,
+                                        tools, skipUnchanged=True) or saved
             clone_ref.setReference(orig_ref, remove_info=True)
 
+        # the fingerprint was taken when cloning, don't pickle again
+        fingerprint = prep.metadata['sys_metadata'].get('fingerprint')
+        if skipUnchanged and not saved and \
+           portal_archivist.isUnchanged(obj, fingerprint=fingerprint):
+            return False
+
         outside_refs = map(lambda oref, cref: (oref, cref.getAttribute()),
                            prep.original.outside_refs, prep.clone.outside_refs)
         for orig_ref, clone_ref in outside_refs:
@@ -482,6 +667,7 @@ class CopyModifyMergeRepositoryTool(UniqueObject,
         # just to ensure that the working copy has the correct
         # ``version_id``
         prep.copyVersionIdFromClone()
+        return True
 
     def _retrieve(self, obj, selector, preserve, countPurged):
         """Retrieve a former state.
@@ -503,10 +689,128 @@ class CopyModifyMergeRepositoryTool(UniqueObject,
         return VersionData(wrapped, vd.preserved_data,
                            vd.sys_metadata, vd.app_metadata)
 
+    def _retrieveMany(self, obj, selectors, preserve, countPurged):
+        """Retrieve many former states.
+
+        Same as ``_retrieve`` for every selector. The versions of the
+        working copy are fetched from the archivist at once and one
+        savepoint is rolled back to after every version.
+        """
+        selectors = list(selectors)
+        portal_archivist = getToolByName(self, 'portal_archivist')
+        parent = aq_parent(aq_inner(obj))
+        saved = transaction.savepoint()
+        vdatas = portal_archivist.retrieveMany(obj, selectors=selectors,
+                                               preserve=preserve,
+                                               countPurged=countPurged)
+        result = []
+        for selector, vdata in zip(selectors, vdatas):
+            vd = self._recursiveRetrieve(obj=obj, selector=selector,
+                                         preserve=preserve, inplace=False,
+                                         countPurged=countPurged,
+                                         prefetched=vdata)
+            saved.rollback()
+            wrapped = wrap(vd.data.object, parent)
+            result.append(VersionData(wrapped, vd.preserved_data,
+                                      vd.sys_metadata, vd.app_metadata))
+        return result
+
+    def _detachedRetrieve(self, obj, selector, preserve, countPurged):
+        """Retrieve a former state without touching the working copy.
+
+        The version is built from the clones retrieved from the archivist
+        only. Neither the working copy nor its container are modified, no
+        savepoint is needed. Thus usable on read only clients.
+        """
+        portal_archivist = getToolByName(self, 'portal_archivist')
+        vdata = portal_archivist.retrieve(obj, None, selector, preserve,
+                                          countPurged)
+        return self._detachVersionData(obj, vdata)
+
+    def _detachedRetrieveMany(self, obj, selectors, preserve, countPurged):
+        """Retrieve many former states without touching the working copy.
+        """
+        portal_archivist = getToolByName(self, 'portal_archivist')
+        vdatas = portal_archivist.retrieveMany(obj, selectors=selectors,
+                                               preserve=preserve,
+                                               countPurged=countPurged)
+        return [self._detachVersionData(obj, vdata) for vdata in vdatas]
+
+    def _detachVersionData(self, obj, vdata):
+        """Builds the version data of a detached version.
+
+        Puts the version into the context of the working copy without
+        setting it as attribute of the container (see ``wrap``).
+        """
+        self._recursiveDetach(obj, vdata)
+        parent = aq_parent(aq_inner(obj))
+        wrapped = aq_base(vdata.data.object).__of__(parent)
+        return VersionData(wrapped, vdata.preserved_data,
+                           vdata.sys_metadata, vdata.app_metadata)
+
+    def _recursiveDetach(self, obj, vdata):
+        """Builds the object graph of a version around the retrieved clone.
+
+        Does the same as ``_recursiveRetrieve`` but changes the clone
+        instead of the working copy ``obj`` (which may be ``None`` if it
+        was deleted).
+        """
+        portal_archivist = getToolByName(self, 'portal_archivist')
+        repo_clone = vdata.data.object
+
+        # The attributes of the working copy the version doesn't know
+        # about are kept (except the ones referencing sub objects).
+        if obj is not None:
+            attrs_to_leave = vdata.attr_handling_references
+            clone_dict = repo_clone.__dict__
+            for key, val in aq_base(obj).__dict__.items():
+                if key in clone_dict or key in attrs_to_leave \
+                   or key.startswith('_v_'):
+                    continue
+                setattr(repo_clone, key, val)
+
+        # retrieve all inside refs detached also
+        for attr_ref in vdata.data.inside_refs:
+            va_ref = attr_ref.getAttribute()
+            if va_ref is None:
+                # a missing reference, the policy has changed,
+                # don't try to replace it
+                continue
+            try:
+                ref_obj = dereference(history_id=va_ref.history_id,
+                                      zodb_hook=self)[0]
+            except (TypeError, AttributeError):
+                ref_obj = None
+            ref_vdata = portal_archivist.retrieve(ref_obj, va_ref.history_id,
+                                                  va_ref.version_id, (),
+                                                  True)
+            self._recursiveDetach(ref_obj, ref_vdata)
+            attr_ref.setAttribute(ref_vdata.data.object)
+
+        # reattach all outside refs to the current working copy
+        for attr_ref in vdata.data.outside_refs:
+            va_ref = attr_ref.getAttribute()
+            if va_ref is None:
+                continue
+            cur_value = None
+            if obj is not None:
+                cur_value = attr_ref.getAttribute(alternate=obj)
+            try:
+                ref = dereference(history_id=va_ref.history_id,
+                                  zodb_hook=self)[0]
+            except (TypeError, AttributeError):
+                ref = cur_value
+            if ref is not None and aq_base(ref) is not aq_base(va_ref):
+                attr_ref.setAttribute(ref)
+
     def _recursiveRetrieve(self, obj=None, history_id=None, selector=None, preserve=(),
                            inplace=False, source=None, fixup_queue=None,
-                           ignore_existing=False, countPurged=True):
+                           ignore_existing=False, countPurged=True,
+                           prefetched=None):
         """This is the real workhorse pulling objects out recursively.
+
+        ``prefetched`` may pass the version of the working copy already
+        retrieved from the archivist.
         """
         portal_archivist = getToolByName(self, 'portal_archivist')
         portal_reffactories = getToolByName(self, 'portal_referencefactories')
@@ -532,6 +836,7 @@ class CopyModifyMergeRepositoryTool(UniqueObject,
             repo_clone = vdata.data.object
             obj = portal_reffactories.invokeFactory(repo_clone, source)
             hasBeenMoved = False
+            prefetched = None
         else:
             if source is None:
                 ##### the source has to be stored with the object at save time
@@ -551,12 +856,16 @@ class CopyModifyMergeRepositoryTool(UniqueObject,
                                                   preserve, countPurged)
                 repo_clone = vdata.data.object
                 obj = portal_reffactories.invokeFactory(repo_clone, source)
+                prefetched = None
             else:
                 # What is the desired behavior
                 pass
 
-        vdata = portal_archivist.retrieve(obj, history_id, selector,
-                                          preserve, countPurged)
+        if prefetched is None:
+            vdata = portal_archivist.retrieve(obj, history_id, selector,
+                                              preserve, countPurged)
+        else:
+            vdata = prefetched
 
         # Replace the objects attributes retaining identity.
         _missing = object()
@@ -769,14 +1078,18 @@ class LazyHistory:
 
     __allow_access_to_unprotected_subobjects__ = 1
 
-    def __init__(self, repository, obj, oldestFirst, preserve, countPurged):
+    def __init__(self, repository, obj, oldestFirst, preserve, countPurged,
+                 detached=False):
         archivist = getToolByName(repository, 'portal_archivist')
         self._repo = repository
         self._obj = obj
         self._oldestFirst = oldestFirst
         self._preserve = preserve
         self._countPurged = countPurged
-        self._retrieve = repository._retrieve
+        if detached:
+            self._retrieve = repository._detachedRetrieve
+        else:
+            self._retrieve = repository._retrieve
         self._length = len(archivist.queryHistory(obj=obj, preserve=preserve,
                                                   countPurged=countPurged))
         self._cache={}
@@ -55,6 +55,9 @@ class KeepLastNVersionsTool(UniqueObject, SimpleItem, PropertyManager):
 
     maxNumberOfVersionsToKeep = -1 # disabled
 
+    # the history id the retention sweeper continues after
+    _sweep_cursor = None
+
     _properties = (
         {'id': 'maxNumberOfVersionsToKeep', 'type': 'int', 'mode': 'w',
          'label': "maximum number of versions to keep in the storage (set to -1 for infinite)"},
@@ -78,19 +81,37 @@ class KeepLastNVersionsTool(UniqueObject, SimpleItem, PropertyManager):
 
         storage = getToolByName(self, 'portal_historiesstorage')
         currentVersion = len(storage.getHistory(history_id))
-        while True:
-            length = len(storage.getHistory(history_id, countPurged=False))
-            if length < self.maxNumberOfVersionsToKeep:
-                break
+        # make room for the version about to be saved
+        selectors = self.getVersionsToPurge(history_id, room=1)
+        if selectors:
             comment = "purged on save of version %s" % currentVersion
-            storage.purge(history_id, 0, metadata={'sys_metadata': {
-                                                           'comment': comment}
-                                                   },
+            purgeMetadata = {'sys_metadata': {'comment': comment}}
+            purgeMany = getattr(storage, 'purgeMany', None)
+            if purgeMany is not None:
+                # all versions purged in one pass (selectors not counting
+                # purged versions are resolved before purging)
+                purgeMany(history_id, selectors, metadata=purgeMetadata,
                           countPurged=False)
+            else:
+                for i in selectors:
+                    storage.purge(history_id, 0, metadata=purgeMetadata,
+                                  countPurged=False)
 
         # save current version
         return True
 
+    def getVersionsToPurge(self, history_id, room=0):
+        """Returns the oldest versions exceeding the maximum number
+
+        The selectors returned don't count purged versions.
+        """
+        if self.maxNumberOfVersionsToKeep == -1:
+            return []
+        storage = getToolByName(self, 'portal_historiesstorage')
+        length = len(storage.getHistory(history_id, countPurged=False))
+        excess = min(length - self.maxNumberOfVersionsToKeep + room, length)
+        return range(max(excess, 0))
+
     def retrieveSubstitute(self, history_id, selector, default=None):
         """Retrives the next older version
 
@@ -23,6 +23,10 @@
 
 """
 
+import threading
+import time
+from collections import OrderedDict, deque
+
 from zope.interface import implements
 
 from App.class_init import InitializeClass
@@ -31,6 +35,7 @@ from Missing import MV
 from Acquisition import aq_base
 from AccessControl import ClassSecurityInfo
 from OFS.OrderedFolder import OrderedFolder
+from Products.PageTemplates.PageTemplateFile import PageTemplateFile
 
 from Products.CMFCore.utils import UniqueObject, getToolByName
 
@@ -51,6 +56,130 @@ from Products.CMFEditions import StandardModifiers
 from Products.CMFEditions.Modifiers import ConditionalModifier
 from Products.CMFEditions.Modifiers import ConditionalTalesModifier
 
+# number of objects whose modifier chain is remembered per operation
+CHAIN_CACHE_SIZE = 8
+
+# number of records kept by the profile of a modifier registry
+PROFILE_BUFFER_SIZE = 1000
+
+# profiles by physical path of the modifier registry (in process only)
+_profiles = {}
+
+
+def approxDataSize(data):
+    """Returns the approximate size in bytes of referenced data
+    """
+    if isinstance(data, basestring):
+        return len(data)
+    if isinstance(data, dict):
+        return sum([approxDataSize(v) for v in data.values()])
+    if isinstance(data, (list, tuple)):
+        return sum([approxDataSize(v) for v in data])
+    for name in ('getSize', 'get_size'):
+        getSize = getattr(data, name, None)
+        if getSize is not None:
+            try:
+                return int(getSize())
+            except Exception:
+                return 0
+    return 0
+
+
+class ModifierProfile:
+    """Ring buffer of the timings of the modifiers
+
+    Every record is a dictionary with the time, the modifiers id, the
+    phase, the wall time spent, the number of calls and the size of the
+    data affected (if known).
+
+    The profile is shared by the threads of the process. The records
+    still being summed up are kept per thread.
+    """
+
+    def __init__(self, size=PROFILE_BUFFER_SIZE):
+        self._records = deque(maxlen=size)
+        self._local = threading.local()
+
+    def record(self, modifier_id, phase, seconds, size=0, token=None):
+        """Records a call of a modifier
+
+        Calls passing the same ``token`` are summed up in one record
+        (e.g. the many ``persistent_id`` calls of one clone operation).
+        """
+        local = self._local
+        if token is not None:
+            if getattr(local, 'token', None) is not token:
+                local.token = token
+                local.open = {}
+            record = local.open.get((modifier_id, phase), None)
+            if record is not None:
+                record['seconds'] += seconds
+                record['calls'] += 1
+                record['size'] += size
+                return
+        record = {
+            'time': time.time(),
+            'modifier': modifier_id,
+            'phase': phase,
+            'seconds': seconds,
+            'calls': 1,
+            'size': size,
+        }
+        if token is not None:
+            local.open[(modifier_id, phase)] = record
+        self._records.append(record)
+
+    def listRecords(self):
+        """Returns the records, the oldest first
+        """
+        return [dict(record) for record in list(self._records)]
+
+    def getSummary(self):
+        """Returns the records summed up by modifier and phase
+
+        The slowest first.
+        """
+        totals = {}
+        for record in list(self._records):
+            key = (record['modifier'], record['phase'])
+            total = totals.get(key, None)
+            if total is None:
+                total = totals[key] = {
+                    'modifier': record['modifier'],
+                    'phase': record['phase'],
+                    'seconds': 0.0,
+                    'calls': 0,
+                    'size': 0,
+                }
+            total['seconds'] += record['seconds']
+            total['calls'] += record['calls']
+            total['size'] += record['size']
+        summary = totals.values()
+        summary.sort(key=lambda total: total['seconds'], reverse=True)
+        return summary
+
+    def clear(self):
+        """Forgets all records
+        """
+        self._records.clear()
+        self._local = threading.local()
+
+
+def timedPersistentId(profile, modifier_id, pers_id, token):
+    """Wraps a ``persistent_id`` callback recording its timings
+
+    The calls during one clone operation (identified by ``token``) are
+    summed up.
+    """
+    def persistent_id(obj):
+        start = time.time()
+        try:
+            return pers_id(obj)
+        finally:
+            profile.record(modifier_id, 'persistent_id',
+                           time.time() - start, token=token)
+    return persistent_id
+
 
 class ModifierRegistryTool(UniqueObject, OrderedFolder):
     __doc__ = __doc__ # copy from module
@@ -83,8 +212,30 @@ class ModifierRegistryTool(UniqueObject, OrderedFolder):
         StandardModifiers=StandardModifiers,
     )
 
+    # incremented on every change of the configuration (invalidates the
+    # cached modifier chains also in other ZEO clients)
+    _chainSerial = 0
+
+    # records the timings of the modifiers if enabled
+    profiling = False
+
     security = ClassSecurityInfo()
 
+    manage_options = OrderedFolder.manage_options[:1] \
+        + ({'label' : 'Conditions', 'action' : 'manage_conditions'},
+           {'label' : 'Profile', 'action' : 'manage_profile'},) \
+        + OrderedFolder.manage_options[1:]
+
+    security.declareProtected(ManagePortal, 'manage_profile')
+    manage_profile = PageTemplateFile('www/modifierProfile.pt',
+                                      globals(),
+                                      __name__='manage_profile')
+
+    security.declareProtected(ManagePortal, 'manage_conditions')
+    manage_conditions = PageTemplateFile('www/modifierConditions.pt',
+                                         globals(),
+                                         __name__='manage_conditions')
+
     def all_meta_types(self, interfaces=None):
         """Allow adding of objects implementing 'IConditionalModifier' only.
         """
@@ -103,27 +254,134 @@ class ModifierRegistryTool(UniqueObject, OrderedFolder):
         if not IConditionalModifier.providedBy(object):
             object = ConditionalTalesModifier(id, object)
 
-        return self.orderedFolderSetObject(id, object, roles=roles,
-                                           user=user, set_owner=set_owner)
+        id = self.orderedFolderSetObject(id, object, roles=roles,
+                                         user=user, set_owner=set_owner)
+        self.invalidateModifierChains()
+        return id
+
+    def _delObject(self, id, dp=1, suppress_events=False):
+        OrderedFolder._delObject(self, id, dp=dp,
+                                 suppress_events=suppress_events)
+        self.invalidateModifierChains()
+
+    def moveObjectsByDelta(self, ids, delta, subset_ids=None,
+                           suppress_events=False):
+        result = OrderedFolder.moveObjectsByDelta(self, ids, delta,
+                    subset_ids=subset_ids, suppress_events=suppress_events)
+        self.invalidateModifierChains()
+        return result
+
+    security.declarePrivate('invalidateModifierChains')
+    def invalidateModifierChains(self):
+        """Forgets the cached modifier chains
+        """
+        self._chainSerial += 1
 
     def _collectModifiers(self, obj, interface, reversed=False):
         """ Returns a list of valid modifiers
         """
-        modifier_list = []
-        portal = getToolByName(self, 'portal_url').getPortalObject()
-        for id, o in self.objectItems():
-            # collect objects modifier only when appropriate
-            if IConditionalModifier.providedBy(o) \
-               and o.isApplicable(obj, portal):
-                mod = o.getModifier()
-                if interface.providedBy(mod):
-                    modifier_list.append((id, mod))
+        modifier_list = [(id, mod) for id, mod in self._getModifierChain(obj)
+                         if interface.providedBy(mod)]
 
         if reversed:
             modifier_list.reverse()
 
         return modifier_list
 
+    security.declarePrivate('beginOperation')
+    def beginOperation(self):
+        """Remembers the modifier chains until the matching ``endOperation``
+
+        One save or retrieve asks for the modifiers of the same objects
+        several times. Operations may be nested, the chains are forgotten
+        when the outermost operation ends (the conditions may depend on
+        attributes changed after it).
+        """
+        depth = getattr(self, '_v_operationDepth', 0)
+        if not depth:
+            self._v_objectChains = (self._chainSerial, OrderedDict())
+        self._v_operationDepth = depth + 1
+
+    security.declarePrivate('endOperation')
+    def endOperation(self):
+        """Ends an operation started by ``beginOperation``
+        """
+        depth = getattr(self, '_v_operationDepth', 1) - 1
+        self._v_operationDepth = depth
+        if not depth:
+            self._v_objectChains = None
+
+    def _getModifierChain(self, obj):
+        """Returns the applicable modifiers in order
+
+        Within an operation (see ``beginOperation``) the chain is
+        remembered for the last few objects.
+        """
+        cache = getattr(self, '_v_objectChains', None)
+        if cache is None:
+            return self._buildModifierChain(obj)
+        if cache[0] != self._chainSerial:
+            cache = self._v_objectChains = (self._chainSerial, OrderedDict())
+        chains = cache[1]
+
+        # keep a reference to the object as its id may be reused else
+        base = aq_base(obj)
+        key = id(base)
+        cached = chains.get(key, None)
+        if cached is not None and cached[0] is base:
+            return cached[1]
+
+        chain = self._buildModifierChain(obj)
+        chains[key] = (base, chain)
+        if len(chains) > CHAIN_CACHE_SIZE:
+            chains.popitem(last=False)
+        return chain
+
+    def _buildModifierChain(self, obj):
+        """Evaluates the conditions of the modifiers
+
+        The results of the conditions only depending on the type are
+        reused for all objects of the same type.
+        """
+        try:
+            portal_type = obj.getPortalTypeName()
+        except AttributeError:
+            portal_type = None
+        type_key = (portal_type, getattr(obj, 'meta_type', None))
+
+        templates = getattr(self, '_v_typeChains', None)
+        if templates is None or templates[0] != self._chainSerial:
+            templates = self._v_typeChains = (self._chainSerial, {})
+        template = templates[1].get(type_key, None)
+
+        portal = None
+        if template is None:
+            portal = getToolByName(self, 'portal_url').getPortalObject()
+            # ``None`` marks modifiers whose condition has to be evaluated
+            # for every object (the template outlives the request, don't
+            # keep acquisition wrappers)
+            template = []
+            for id, o in self.objectItems():
+                if not IConditionalModifier.providedBy(o):
+                    continue
+                if getattr(o, 'dependsOnTypeOnly', lambda: False)():
+                    if o.isApplicable(obj, portal):
+                        template.append((id, aq_base(o), True))
+                else:
+                    template.append((id, aq_base(o), None))
+            templates[1][type_key] = template
+
+        chain = []
+        for id, o, applicable in template:
+            if applicable is None:
+                if portal is None:
+                    portal = getToolByName(self, 'portal_url') \
+                                 .getPortalObject()
+                applicable = o.__of__(self).isApplicable(obj, portal)
+            if applicable:
+                chain.append((id, o.getModifier()))
+        return chain
+
     # -------------------------------------------------------------------
     # methods implementing IModifier
     #
@@ -137,10 +395,19 @@ class ModifierRegistryTool(UniqueObject, OrderedFolder):
         """
         # just loop over all objects implementing the IModifier interface.
         referenced_data = {}
+        profile = self._getActiveProfile()
         for id, mod in self._collectModifiers(obj, IAttributeModifier):
+            if profile is None:
+                attributes = mod.getReferencedAttributes(obj)
+            else:
+                start = time.time()
+                attributes = mod.getReferencedAttributes(obj)
+                profile.record(id, 'getReferencedAttributes',
+                               time.time() - start,
+                               approxDataSize(attributes))
             # prepend the modifiers id to the attributes name
             template = '%s/%%s' % id
-            for name, attrs in mod.getReferencedAttributes(obj).items():
+            for name, attrs in attributes.items():
                 referenced_data[template % name] = attrs
 
         # the return value is of the format:
@@ -165,9 +432,18 @@ class ModifierRegistryTool(UniqueObject, OrderedFolder):
 
         # loop over modifiers in reverse
         if data_by_modid:
+            profile = self._getActiveProfile()
             for id, mod in self._collectModifiers(obj, IAttributeModifier, reversed=True):
-                if id in data_by_modid:
+                if id not in data_by_modid:
+                    continue
+                if profile is None:
                     mod.reattachReferencedAttributes(obj, data_by_modid[id])
+                else:
+                    start = time.time()
+                    mod.reattachReferencedAttributes(obj, data_by_modid[id])
+                    profile.record(id, 'reattachReferencedAttributes',
+                                   time.time() - start,
+                                   approxDataSize(data_by_modid[id]))
 
     security.declarePrivate('getOnCloneModifiers')
     def getOnCloneModifiers(self, obj):
@@ -187,11 +463,22 @@ class ModifierRegistryTool(UniqueObject, OrderedFolder):
         inside_orefs = []
         outside_orefs = []
 
+        profile = self._getActiveProfile()
+        token = object()
         for id, m in modifiers:
-            clone_mod = m.getOnCloneModifiers(obj)
+            if profile is None:
+                clone_mod = m.getOnCloneModifiers(obj)
+            else:
+                start = time.time()
+                clone_mod = m.getOnCloneModifiers(obj)
+                profile.record(id, 'getOnCloneModifiers',
+                               time.time() - start)
             if clone_mod is not None:
-                pers_id_list.append(clone_mod[0])
-                pers_id_nameByMeth[clone_mod[0]] = id
+                pers_id = clone_mod[0]
+                if profile is not None:
+                    pers_id = timedPersistentId(profile, id, pers_id, token)
+                pers_id_list.append(pers_id)
+                pers_id_nameByMeth[pers_id] = id
                 inside_orefs.extend(clone_mod[2])
                 outside_orefs.extend(clone_mod[3])
                 pers_load_byname[id] = clone_mod[1]
@@ -220,8 +507,14 @@ class ModifierRegistryTool(UniqueObject, OrderedFolder):
         metadata = {}
 
         # just loop over all modifiers
-        for ignored_id, mod in self._collectModifiers(obj, ISaveRetrieveModifier):
-            mdata, icrefs, ocrefs = mod.beforeSaveModifier(obj, obj_clone)
+        profile = self._getActiveProfile()
+        for id, mod in self._collectModifiers(obj, ISaveRetrieveModifier):
+            if profile is None:
+                mdata, icrefs, ocrefs = mod.beforeSaveModifier(obj, obj_clone)
+            else:
+                start = time.time()
+                mdata, icrefs, ocrefs = mod.beforeSaveModifier(obj, obj_clone)
+                profile.record(id, 'beforeSaveModifier', time.time() - start)
             inside_crefs.extend(icrefs)
             outside_crefs.extend(ocrefs)
             metadata.update(mdata)
@@ -246,8 +539,17 @@ class ModifierRegistryTool(UniqueObject, OrderedFolder):
         # just loop over all modifiers in reverse order
         refs_to_be_deleted = []
         attrs_handling_subobjects = []
-        for ignored_id, mod in self._collectModifiers(obj, ISaveRetrieveModifier, reversed=True):
-            to_be_del, attrs, preserve = mod.afterRetrieveModifier(obj, repo_clone)
+        profile = self._getActiveProfile()
+        for id, mod in self._collectModifiers(obj, ISaveRetrieveModifier, reversed=True):
+            if profile is None:
+                to_be_del, attrs, preserve = \
+                    mod.afterRetrieveModifier(obj, repo_clone)
+            else:
+                start = time.time()
+                to_be_del, attrs, preserve = \
+                    mod.afterRetrieveModifier(obj, repo_clone)
+                profile.record(id, 'afterRetrieveModifier',
+                               time.time() - start)
             refs_to_be_deleted.extend(to_be_del)
             attrs_handling_subobjects.extend(attrs)
             preserved.update(preserve)
@@ -295,6 +597,7 @@ class ModifierRegistryTool(UniqueObject, OrderedFolder):
                 raise NotImplementedError(
                     '%s does not implement conditions.' % modifier)
             modifier.edit(enabled)
+        self.invalidateModifierChains()
 
     security.declareProtected(ManagePortal, 'get')
     def get(self, id):
@@ -314,6 +617,86 @@ class ModifierRegistryTool(UniqueObject, OrderedFolder):
             return default
 
 
+    # -------------------------------------------------------------------
+    # profiling
+    # -------------------------------------------------------------------
+
+    def _getActiveProfile(self):
+        """Returns the profile if profiling is enabled, else ``None``
+        """
+        if not self.profiling:
+            return None
+        return self.getProfile()
+
+    security.declareProtected(ManagePortal, 'getProfile')
+    def getProfile(self):
+        """Returns the profile of this registry (in this process)
+        """
+        path = self.getPhysicalPath()
+        profile = _profiles.get(path, None)
+        if profile is None:
+            profile = _profiles[path] = ModifierProfile()
+        return profile
+
+    security.declareProtected(ManagePortal, 'getProfileSummary')
+    def getProfileSummary(self):
+        """Returns the recorded timings summed up by modifier and phase
+        """
+        return self.getProfile().getSummary()
+
+    security.declareProtected(ManagePortal, 'listProfileRecords')
+    def listProfileRecords(self):
+        """Returns the recorded timings, the oldest first
+        """
+        return self.getProfile().listRecords()
+
+    security.declareProtected(ManagePortal, 'setProfiling')
+    def setProfiling(self, enabled=True):
+        """Enables or disables the profiling of the modifiers
+        """
+        enabled = bool(enabled)
+        if enabled != self.profiling:
+            self.profiling = enabled
+
+    security.declareProtected(ManagePortal, 'manage_setProfiling')
+    def manage_setProfiling(self, enabled=False, clear=False, REQUEST=None):
+        """Enables or disables the profiling, optionally clears the profile
+        """
+        self.setProfiling(enabled)
+        if clear:
+            self.getProfile().clear()
+        if REQUEST is not None:
+            REQUEST.set("manage_tabs_message", "Changed")
+            return self.manage_profile(self, REQUEST)
+
+    security.declareProtected(ManagePortal, 'listConditions')
+    def listConditions(self):
+        """Lists the conditions of the modifiers and how they are evaluated
+        """
+        conditions = []
+        for id, o in self.objectItems():
+            if not IConditionalModifier.providedBy(o):
+                continue
+            condition = ''
+            if IConditionalTalesModifier.providedBy(o):
+                condition = o.getTalesCondition()
+            if not o.isEnabled():
+                evaluation = 'disabled'
+            elif not condition:
+                evaluation = 'no condition'
+            elif getattr(o, 'isCompiled', lambda: False)():
+                evaluation = 'python predicate'
+            else:
+                evaluation = 'TALES expression'
+            conditions.append({
+                'id': id,
+                'title': o.title,
+                'condition': condition,
+                'evaluation': evaluation,
+            })
+        return conditions
+
+
     # -------------------------------------------------------------------
     # methods implementing IBulkModifierRegistry
     # -------------------------------------------------------------------
@@ -39,6 +39,67 @@ from Products.CMFCore.Expression import Expression
 from Products.CMFEditions.interfaces.IModifier import IConditionalTalesModifier
 from Products.CMFEditions.interfaces.IModifier import IConditionalModifier
 
+# names a condition may use to only depend on the type of the object
+TYPE_CONDITION_NAMES = frozenset(('portal_type', 'meta_type',
+                                  'True', 'False', 'None'))
+
+def compileTypeCondition(text):
+    """Compiles a TALES condition only depending on the type
+
+    Only simple python expressions using nothing else than the
+    ``portal_type`` and ``meta_type`` symbols and constants are
+    recognized (e.g. ``python: portal_type in ('Image', 'File')`` or
+    ``python: True``). Those can't access anything else and are
+    evaluated as plain python code (see ``evalTypeCondition``).
+
+    Returns the code object or ``None`` if the condition has to be
+    evaluated as TALES expression.
+    """
+    text = text.strip()
+    if not text.startswith('python:'):
+        return None
+    try:
+        code = compile(text[len('python:'):].strip(), '<condition>', 'eval')
+    except SyntaxError:
+        return None
+    # nested code (lambdas, generator expressions) isn't inspected
+    for const in code.co_consts:
+        if hasattr(const, 'co_names'):
+            return None
+    if not TYPE_CONDITION_NAMES.issuperset(code.co_names):
+        return None
+    return code
+
+def evalTypeCondition(code, obj):
+    """Evaluates a condition compiled by ``compileTypeCondition``
+    """
+    # same symbols as set up by ``createExpressionContext``
+    try:
+        portal_type = obj.getPortalTypeName()
+    except AttributeError:
+        portal_type = None
+    try:
+        meta_type = obj.meta_type
+    except AttributeError:
+        meta_type = None
+    symbols = {
+        'portal_type': portal_type,
+        'meta_type': meta_type,
+        'True': True,
+        'False': False,
+        'None': None,
+    }
+    return eval(code, {'__builtins__': {}}, symbols)
+
+def invalidateRegistry(modifier):
+    """Tells the modifier registry (if any) the configuration changed
+    """
+    registry = aq_parent(aq_inner(modifier))
+    invalidate = getattr(registry, 'invalidateModifierChains', None)
+    if invalidate is not None:
+        invalidate()
+
+
 manage_addModifierForm = PageTemplateFile('www/modifierAddForm.pt',
                                           globals(),
                                           __name__='manage_addModifierForm')
@@ -76,6 +137,7 @@ class ConditionalModifier(SimpleItem):
             self._enabled = enabled
         else:
             self._enabled = False
+        invalidateRegistry(self)
 
         if REQUEST:
             REQUEST.set("manage_tabs_message", "Changed")
@@ -88,6 +150,11 @@ class ConditionalModifier(SimpleItem):
         if self._enabled:
             return True
 
+    def dependsOnTypeOnly(self):
+        """See IConditionalModifier.
+        """
+        return True
+
     def isEnabled(self):
         """See IConditionalModifier.
         """
@@ -130,6 +197,7 @@ class ConditionalTalesModifier(ConditionalModifier):
         ConditionalModifier.edit(self, enabled, title)
         if condition is not None and condition != self.getTalesCondition():
             self._condition = Expression(condition)
+            invalidateRegistry(self)
 
         if REQUEST:
             REQUEST.set("manage_tabs_message", "Changed")
@@ -142,10 +210,36 @@ class ConditionalTalesModifier(ConditionalModifier):
         if not self._enabled or not self.getTalesCondition():
             return False
 
+        # simple conditions are evaluated without the costly context
+        code = self._getCompiledCondition()
+        if code is not None:
+            return evalTypeCondition(code, obj)
+
         # create the expression context and return result
         context = createExpressionContext(obj, portal)
         return self._condition(context)
 
+    def dependsOnTypeOnly(self):
+        """See IConditionalTalesModifier.
+        """
+        if not self._enabled or not self.getTalesCondition():
+            return True
+        return self.isCompiled()
+
+    def isCompiled(self):
+        """Returns True if the condition is evaluated as python predicate
+        """
+        return self._getCompiledCondition() is not None
+
+    def _getCompiledCondition(self):
+        """Returns the compiled condition or ``None``
+        """
+        text = self.getTalesCondition()
+        compiled = getattr(self, '_v_compiled', None)
+        if compiled is None or compiled[0] != text:
+            compiled = self._v_compiled = (text, compileTypeCondition(text))
+        return compiled[1]
+
     def getTalesCondition(self):
         """See IConditionalTalesModifier.
         """
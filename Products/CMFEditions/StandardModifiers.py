@@ -26,7 +26,14 @@
 """
 
 import os,sys
-from itertools import izip
+import shutil
+import tempfile
+from hashlib import sha256
+try:
+    import fcntl
+except ImportError:
+    # not available on windows
+    fcntl = None
 from App.class_init import InitializeClass
 from zope.copy import copy
 
@@ -34,7 +41,9 @@ from Acquisition import aq_base
 from zope.interface import implements, Interface
 from zope.component.interfaces import ComponentLookupError
 from zope.component.interfaces import IPossibleSite
+from persistent import Persistent
 from ZODB.blob import Blob
+from ZODB.interfaces import BlobError
 from OFS.ObjectManager import ObjectManager
 from Products.BTreeFolder2.BTreeFolder2 import BTreeFolder2Base
 from Products.PageTemplates.PageTemplateFile import PageTemplateFile
@@ -43,7 +52,7 @@ from Products.CMFCore.utils import getToolByName
 from Products.CMFCore.permissions import ManagePortal
 from Products.CMFCore.Expression import Expression
 
-from Products.CMFEditions.interfaces.IArchivist import ArchivistRetrieveError
+from Products.CMFEditions.interfaces.IStorage import StorageError
 from Products.CMFEditions.interfaces.IModifier import IAttributeModifier
 from Products.CMFEditions.interfaces.IModifier import ICloneModifier
 from Products.CMFEditions.interfaces.IModifier import ISaveRetrieveModifier
@@ -396,28 +405,60 @@ class OMBaseModifier(RetainAttributeAnnotationItemsBase):
     PRESERVE_ANNOTATION_KEYS = (DefaultOrdering.ORDER_KEY,
                                 DefaultOrdering.POS_KEY)
 
+    def _getSubObjects(self, obj):
+        """Returns the ids and the wrapped childrens of the object manager
+
+        The childrens are looked up in the internal structures, so they
+        aren't loaded from the ZODB (ghosts stay ghosts).
+        """
+        ids = obj.objectIds()
+        base = aq_base(obj)
+        if isinstance(base, BTreeFolder2Base):
+            children = base._tree
+        else:
+            children = base.__dict__
+        result = []
+        for name in ids:
+            sub = children.get(name, None)
+            if sub is None or not hasattr(sub, '__of__'):
+                sub = obj._getOb(name)
+            else:
+                sub = sub.__of__(obj)
+            result.append((name, sub))
+        return result
+
     def _getOnCloneModifiers(self, obj):
         """Removes all childrens and returns them as references.
         """
         portal_archivist = getToolByName(obj, 'portal_archivist')
         VersionAwareReference = portal_archivist.classes.VersionAwareReference
 
-        # do not pickle the object managers subobjects
+        # do not pickle the object managers subobjects, subobjects already
+        # stored in the ZODB are recognized by their oid without loading
+        # them
+        jar = aq_base(obj)._p_jar
+        oids = {}
         refs = {}
         result_refs = []
-        for sub in obj.objectValues():
+        for name, sub in self._getSubObjects(obj):
             result_refs.append(sub)
-            refs[id(aq_base(sub))] = True
+            sub = aq_base(sub)
+            oid = getattr(sub, '_p_oid', None)
+            if oid is not None and sub._p_jar is jar:
+                oids[oid] = True
+            else:
+                refs[id(sub)] = True
 
         def persistent_id(obj):
-            try:
-                # return a non None value if it is one of the object
-                # managers subobjects or raise an KeyError exception
-                return refs[id(obj)]
-            except KeyError:
-                # signalize the pickler to just pickle the 'obj' as
-                # usual
-                return None
+            # return a non None value if it is one of the object
+            # managers subobjects, otherwise signalize the pickler to
+            # just pickle the 'obj' as usual
+            if id(obj) in refs:
+                return True
+            if isinstance(obj, Persistent) and obj._p_oid in oids \
+               and obj._p_jar is jar:
+                return True
+            return None
 
         def persistent_load(ignored):
             return VersionAwareReference()
@@ -538,9 +579,6 @@ class OMInsideChildrensModifier(OMBaseModifier):
         if obj is None:
             return [], [], {}
 
-        hidhandler = getToolByName(obj, 'portal_historyidhandler')
-        queryUid = hidhandler.queryUid
-
         # Inside refs from the original object that have no counterpart
         # in the repositories clone have to be deleted from the original.
         # The following steps have to be carried out:
@@ -553,8 +591,7 @@ class OMInsideChildrensModifier(OMBaseModifier):
 
         # (1) list originals inside references
         orig_histids = {}
-        for id, o in obj.objectItems():
-            histid = queryUid(o, None)
+        for id, histid in self._getSubObjectHistoryIds(obj):
             # there may be objects without history_id
             # We want to make sure to delete these on revert
             if histid is not None:
@@ -584,6 +621,45 @@ class OMInsideChildrensModifier(OMBaseModifier):
 
         return refs_to_be_deleted, ref_names, {}
 
+    def _getSubObjectHistoryIds(self, obj):
+        """Returns the ids and the history ids of the childrens
+
+        The history ids are read from the catalogs history id index, so
+        the versioned childrens don't have to be loaded from the ZODB.
+        The history ids of childrens missing in the catalog or cataloged
+        without one are looked up on the childrens themselves.
+        """
+        hidhandler = getToolByName(obj, 'portal_historyidhandler')
+        catalog = getToolByName(obj, 'portal_catalog', None)
+        index_name = getattr(hidhandler, 'UID_ATTRIBUTE_NAME', None)
+        index = None
+        if catalog is not None and index_name is not None:
+            try:
+                index = catalog._catalog.getIndex(index_name)
+            except (AttributeError, KeyError):
+                index = None
+
+        cataloged = {}
+        if index is not None:
+            path = '/'.join(obj.getPhysicalPath())
+            brains = catalog.unrestrictedSearchResults(
+                path={'query': path, 'depth': 1})
+            for brain in brains:
+                parent_path, name = brain.getPath().rsplit('/', 1)
+                if parent_path == path:
+                    cataloged[name] = index.getEntryForObject(brain.getRID(),
+                                                              None)
+
+        result = []
+        for name, sub in self._getSubObjects(obj):
+            # childrens registered in this transaction may not be
+            # reindexed yet (e.g. if indexing is deferred)
+            histid = cataloged.get(name, None)
+            if histid is None:
+                histid = hidhandler.queryUid(sub, None)
+            result.append((name, histid))
+        return result
+
 InitializeClass(OMInsideChildrensModifier)
 
 class OMSubObjectAdapter:
@@ -1116,6 +1192,58 @@ InitializeClass(SkipVersioningOfLargeFilesAndImages)
 class BlobProxy(object):
     pass
 
+# (portal type, class) --> (schema, names and types of the schemas
+# fields, names of the blob fields)
+_blob_fields = {}
+_blob_file_classes = None
+
+def _getFieldSignature(schema):
+    return tuple((f.getName(), f.__class__) for f in schema.fields())
+
+def getBlobFields(obj):
+    """Returns the blob fields of the schema of the Archetypes object
+
+    The names of the blob fields are cached per portal type and class.
+    The cache entry is used as long as the object has the same schema.
+    Otherwise (e.g. with a schema extender returning a new schema on
+    every call) it is used if the names and the types of the schemas
+    fields didn't change.
+    """
+    schema = obj.Schema()
+    base = aq_base(obj)
+    key = (getattr(base, 'portal_type', None), base.__class__)
+    cached = _blob_fields.get(key)
+    if cached is None or cached[0] is not schema:
+        signature = _getFieldSignature(schema)
+        if cached is None or cached[1] != signature:
+            blob_names = tuple(f.getName() for f in schema.fields()
+                               if IBlobField.providedBy(f))
+        else:
+            blob_names = cached[2]
+        cached = _blob_fields[key] = (schema, signature, blob_names)
+    return [schema[name] for name in cached[2]]
+
+def getBlobFileClasses():
+    """Returns the available z3c.blobfile and plone.namedfile blob classes
+    """
+    global _blob_file_classes
+    if _blob_file_classes is None:
+        blob_file_classes = []
+        try:
+            from z3c.blobfile.file import File
+        except ImportError:
+            pass
+        else:
+            blob_file_classes.append(File)
+        try:
+            from plone.namedfile.file import NamedBlobFile
+        except ImportError:
+            pass
+        else:
+            blob_file_classes.append(NamedBlobFile)
+        _blob_file_classes = tuple(blob_file_classes)
+    return _blob_file_classes
+
 class SkipBlobs:
     """Standard avoid storing blob data, may be useful for extremely
     large files where versioing the non-file metadata is important but
@@ -1127,10 +1255,12 @@ class SkipBlobs:
     def getOnCloneModifiers(self, obj):
         """Removes blob objects and stores a marker
         """
+        blob_fields = getBlobFields(obj)
+        if not blob_fields:
+            return
 
         blob_refs = dict((id(f.getUnwrapped(obj, raw=True).getBlob()), True)
-                         for f in obj.Schema().fields()
-                         if IBlobField.providedBy(f))
+                         for f in blob_fields)
 
         def persistent_id(obj):
             if id(aq_base(obj)) in blob_refs:
@@ -1148,8 +1278,7 @@ class SkipBlobs:
     def afterRetrieveModifier(self, obj, repo_clone, preserve=()):
         """If we find any BlobProxies, replace them with the values
         from the current working copy."""
-        blob_fields = (f for f in obj.Schema().fields()
-                       if IBlobField.providedBy(f))
+        blob_fields = getBlobFields(obj)
         for f in blob_fields:
             blob = f.getUnwrapped(obj, raw=True).getBlob()
             clone_ref = f.getUnwrapped(repo_clone, raw=True)
@@ -1159,71 +1288,269 @@ class SkipBlobs:
 
 InitializeClass(SkipBlobs)
 
+# referenced data name suffix of the digest stored with a versioned blob
+BLOB_DIGEST_SUFFIX = ':digest'
+BLOB_CHUNK_SIZE = 1 << 16
+BLOB_DIGEST_CACHE_SIZE = 1000
+# ioctl request cloning a file on copy on write file systems (linux)
+FICLONE = 0x40049409
+
+# (oid, serial) of committed blobs --> (sha256 hex digest, size)
+_blob_digests = {}
+
+def blobDigest(blob):
+    """Returns the sha256 hex digest and the size of the blobs data
+
+    The data is read in chunks. The results for committed blobs are
+    cached by oid and serial, blobs with uncommitted data are always
+    read.
+    """
+    key = None
+    if blob._p_oid is not None:
+        blob._p_activate()
+        if not blob._p_changed \
+           and getattr(blob, '_p_blob_uncommitted', None) is None:
+            key = (blob._p_oid, blob._p_serial)
+            result = _blob_digests.get(key)
+            if result is not None:
+                return result
+
+    digest = sha256()
+    size = 0
+    blob_file = blob.open('r')
+    try:
+        while True:
+            chunk = blob_file.read(BLOB_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    finally:
+        blob_file.close()
+
+    result = (digest.hexdigest(), size)
+    if key is not None:
+        if len(_blob_digests) >= BLOB_DIGEST_CACHE_SIZE:
+            _blob_digests.clear()
+        _blob_digests[key] = result
+    return result
+
+def _committedBlobFile(blob):
+    """Returns the name of the committed file of the blob
+
+    Returns ``None`` if the blob has uncommitted data.
+    """
+    if blob._p_jar is None:
+        return None
+    blob._p_activate()
+    try:
+        return blob.committed()
+    except (BlobError, AttributeError):
+        return None
+
+def _uncommittedBlobDirectory(blob):
+    """Returns the directory the uncommitted data of the blob is placed in
+    """
+    if blob._p_jar is not None:
+        return blob._p_jar.db()._storage.temporaryDirectory()
+    return tempfile.gettempdir()
+
+def _linkFile(source, target):
+    """Hard links or reflinks the source file to the target path
+
+    Returns ``False`` if neither is supported (e.g. if the files are on
+    different file systems).
+    """
+    try:
+        os.link(source, target)
+        return True
+    except (OSError, AttributeError):
+        pass
+    if fcntl is None:
+        return False
+
+    try:
+        src = os.open(source, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        try:
+            dst = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        except OSError:
+            return False
+        try:
+            fcntl.ioctl(dst, FICLONE, src)
+            return True
+        except (IOError, OSError):
+            pass
+        finally:
+            os.close(dst)
+        os.remove(target)
+        return False
+    finally:
+        os.close(src)
+
+def _copyFileData(source, target):
+    """Copies the data of the source to the target file
+
+    Uses ``copy_file_range`` or ``sendfile`` if available, so the data
+    isn't passed through the interpreter.
+    """
+    src, dst = source.fileno(), target.fileno()
+    size = os.fstat(src).st_size
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    if copy_file_range is not None or sendfile is not None:
+        target.flush()
+        offset = 0
+        try:
+            while offset < size:
+                if copy_file_range is not None:
+                    copied = copy_file_range(src, dst, size - offset, offset)
+                else:
+                    copied = sendfile(dst, src, offset, size - offset)
+                if not copied:
+                    break
+                offset += copied
+            else:
+                return
+        except OSError:
+            pass
+        # start over with a plain copy
+        target.seek(0)
+        target.truncate()
+    source.seek(0)
+    while True:
+        chunk = source.read(BLOB_CHUNK_SIZE)
+        if not chunk:
+            break
+        target.write(chunk)
+
+def copyBlob(blob, link=True):
+    """Returns a new blob with the data of the given blob
+
+    Committed blob files are immutable, so the new blob shares the
+    committed file through a hard link or reflink where the file system
+    supports it. Otherwise the data is copied.
+    """
+    new_blob = Blob()
+    filename = link and _committedBlobFile(blob) or None
+    if filename is not None:
+        # the link is created in a private directory as it has to be
+        # created by name
+        tmpdir = tempfile.mkdtemp(dir=_uncommittedBlobDirectory(new_blob),
+                                  prefix='CMFEditions')
+        try:
+            path = os.path.join(tmpdir, 'blob')
+            if _linkFile(filename, path):
+                new_blob.consumeFile(path)
+                return new_blob
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+    blob_file = blob.open('r')
+    new_blob_file = new_blob.open('w')
+    try:
+        _copyFileData(blob_file, new_blob_file)
+    finally:
+        blob_file.close()
+        new_blob_file.close()
+    return new_blob
+
+def blobSize(blob):
+    """Returns the size of the blobs data without reading it
+    """
+    blob_file = blob.open('r')
+    try:
+        return os.fstat(blob_file.fileno()).st_size
+    finally:
+        blob_file.close()
+
 class CloneBlobs:
     """Standard modifier to save an un-cloned reference to the blob to avoid it
     being packed away.
+
+    The sha256 digest and the size of the data is stored with every
+    versioned blob. A new blob is only stored if the digest differs
+    from the one of the prior version, otherwise the prior versions
+    blob is referenced.
     """
 
     implements(IAttributeModifier, ICloneModifier)
 
     def getReferencedAttributes(self, obj):
-        blob_fields = (f for f in obj.Schema().fields()
-                       if IBlobField.providedBy(f))
+        blob_fields = getBlobFields(obj)
         file_data = {}
-        # try to get last revision, only store a new blob if the
-        # contents differ from the prior one, otherwise store a
-        # reference to the prior one
-        # XXX: According to CopyModifyMergeRepository, retrieve and getHistory
-        #      should not be used as a part of more complex transactions
-        #      due to some resource managers not supporting savepoints.
-        repo = getToolByName(obj, 'portal_repository')
-        try:
-            prior_rev = repo.retrieve(obj)
-        except ArchivistRetrieveError:
-            prior_rev = None
+        prior_blobs = None
         for f in blob_fields:
-            # XXX: should only do this if data has changed since last
-            # version somehow Resave the blob line by line
-            blob_file = f.get(obj, raw=True).getBlob().open('r')
-            save_new = True
-            if prior_rev is not None:
-                prior_obj = prior_rev.object
-                prior_blob = f.get(prior_obj, raw=True).getBlob()
-                prior_file = prior_blob.open('r')
-                # Check for file size differences
-                if (os.fstat(prior_file.fileno()).st_size ==
-                    os.fstat(blob_file.fileno()).st_size):
-                    # Files are the same size, compare line by line
-                    for line, prior_line in izip(blob_file, prior_file):
-                        if line != prior_line:
-                            break
-                    else:
-                        # The files are the same, save a reference
-                        # to the prior versions blob on this version
-                        file_data[f.getName()] = prior_blob
-                        save_new = False
-            if save_new:
-                new_blob = file_data[f.getName()] = Blob()
-                new_blob_file = new_blob.open('w')
-                try:
-                    blob_file.seek(0)
-                    new_blob_file.writelines(blob_file)
-                finally:
-                    blob_file.close()
-                    new_blob_file.close()
+            if prior_blobs is None:
+                prior_blobs = self._getPriorBlobs(obj)
+            name = f.getName()
+            blob = f.get(obj, raw=True).getBlob()
+            digest = blobDigest(blob)
+            prior_blob, prior_digest = prior_blobs.get(name, (None, None))
+            if prior_blob is not None and prior_digest is None \
+               and blobSize(prior_blob) == digest[1]:
+                # the prior version was saved before digests were stored
+                prior_digest = blobDigest(prior_blob)
+            if digest == prior_digest:
+                # the data didn't change, save a reference to the prior
+                # versions blob on this version
+                file_data[name] = prior_blob
+            else:
+                file_data[name] = copyBlob(blob)
+            file_data[name + BLOB_DIGEST_SUFFIX] = digest
         return file_data
 
+    def _getPriorBlobs(self, obj):
+        """Returns the blobs and digests of the youngest version
+
+        Only the referenced data is looked up in the storage, the prior
+        version isn't retrieved. The format of the return value is:
+
+            {<field name>: (<blob>, <digest or None>), ...}
+        """
+        hidhandler = getToolByName(obj, 'portal_historyidhandler', None)
+        storage = getToolByName(obj, 'portal_historiesstorage', None)
+        if hidhandler is None or storage is None:
+            return {}
+        history_id = hidhandler.queryUid(obj, None)
+        if history_id is None:
+            return {}
+        try:
+            referenced_data = storage.getReferencedData(history_id,
+                                                        countPurged=False)
+        except StorageError:
+            return {}
+
+        # the names are prefixed by the id of the modifier
+        blobs = {}
+        digests = {}
+        for key, value in referenced_data.items():
+            name = key.split('/', 1)[-1]
+            if isinstance(value, Blob):
+                blobs[name] = value
+            elif name.endswith(BLOB_DIGEST_SUFFIX):
+                digests[name[:-len(BLOB_DIGEST_SUFFIX)]] = value
+        return dict((name, (blob, digests.get(name)))
+                    for name, blob in blobs.items())
+
     def reattachReferencedAttributes(self, obj, attrs_dict):
         obj = aq_base(obj)
         for name, blob in attrs_dict.iteritems():
+            if name.endswith(BLOB_DIGEST_SUFFIX):
+                continue
             obj.getField(name).get(obj).setBlob(blob)
 
     def getOnCloneModifiers(self, obj):
         """Removes references to blobs.
         """
+        blob_fields = getBlobFields(obj)
+        if not blob_fields:
+            return
+
         blob_refs = dict((id(f.getUnwrapped(obj, raw=True).getBlob()), True)
-                         for f in obj.Schema().fields()
-                         if IBlobField.providedBy(f))
+                         for f in blob_fields)
 
         def persistent_id(obj):
             if id(aq_base(obj)) in blob_refs:
@@ -1246,20 +1573,7 @@ class Skip_z3c_blobfile:
     implements(ICloneModifier, ISaveRetrieveModifier)
 
     def _blob_file_classes(self):
-        blob_file_classes = []
-        try:
-            from z3c.blobfile.file import File
-        except ImportError:
-            pass
-        else:
-            blob_file_classes.append(File)
-        try:
-            from plone.namedfile.file import NamedBlobFile
-        except ImportError:
-            pass
-        else:
-            blob_file_classes.append(NamedBlobFile)
-        return tuple(blob_file_classes)
+        return getBlobFileClasses()
 
     def getOnCloneModifiers(self, obj):
         """Removes z3c.blobfile fields
@@ -25,21 +25,33 @@ $Id: ZVCStorageTool.py,v 1.18 2005/03/11 11:05:12 varun-rastogi Exp $
 """
 __version__ = "$Revision: 1.18 $"
 
+import bz2
+import heapq
 import logging
+import re
 import time
 import types
+import zlib
+from hashlib import sha256
+from itertools import islice
 from StringIO import StringIO
+from difflib import SequenceMatcher
 from cPickle import Pickler, Unpickler, dumps, loads, HIGHEST_PROTOCOL
 from zope.interface import implements
 
 from App.class_init import InitializeClass
 from BTrees.OOBTree import OOBTree
 from BTrees.IOBTree import IOBTree
+from BTrees.IIBTree import IITreeSet
+from BTrees.Length import Length
 from Persistence import Persistent
+from ZODB.POSException import ConflictError
 from AccessControl import ClassSecurityInfo
 
+from OFS.PropertyManager import PropertyManager
 from OFS.SimpleItem import SimpleItem
 from Products.PageTemplates.PageTemplateFile import PageTemplateFile
+from ZODB.blob import Blob
 
 from Products.CMFCore.utils import UniqueObject, getToolByName
 from Products.CMFCore.permissions import ManagePortal
@@ -64,8 +76,32 @@ from Products.CMFEditions.interfaces.IStorage import StoragePurgeError
 
 from Products.CMFEditions.Permissions import AccessPreviousVersions
 
+try:
+    from backports import lzma
+except ImportError:
+    lzma = None
+
 logger = logging.getLogger('CMFEditions')
 
+# number of trees the shadow histories are spread over
+SHADOW_STORAGE_SHARDS = 64
+
+_marker = []
+
+# compression algorithms available: name -> (compress, decompress)
+COMPRESSORS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+}
+if lzma is not None:
+    COMPRESSORS['lzma'] = (lzma.compress, lzma.decompress)
+
+def compress(data, algorithm):
+    return COMPRESSORS[algorithm][0](data)
+
+def decompress(data, algorithm):
+    return COMPRESSORS[algorithm][1](data)
+
 def deepCopy(obj):
     stream = StringIO()
     p = Pickler(stream, 1)
@@ -74,12 +110,37 @@ def deepCopy(obj):
     u = Unpickler(stream)
     return u.load()
 
+def getPortalType(obj):
+    """Returns the portal type of the object wrapped by the object data
+
+    Returns an empty string if unknown.
+    """
+    getPortalTypeName = getattr(getattr(obj, 'object', None),
+                                'getPortalTypeName', None)
+    if getPortalTypeName is None:
+        return ''
+    return getPortalTypeName() or ''
+
+def getModified(obj):
+    """Returns the modification date of the object wrapped by the object data
+
+    Returns None if unknown.
+    """
+    modified = getattr(getattr(obj, 'object', None), 'modified', None)
+    if modified is None:
+        return None
+    return modified()
+
 def getSize(obj):
     """Calculate the size as cheap as possible
     """
     # Try the cheap variants first.
     # Actually the checks ensure the code never fails but beeing sure
     # is better.
+    if isinstance(obj, (SerializedPayload, PayloadReference)):
+        # the size of the pickle is known already
+        return obj.getSize()
+
     try:
         # check if to return zero (length is zero)
         if len(obj) == 0:
@@ -127,7 +188,7 @@ def getSize(obj):
     return size
 
 
-class ZVCStorageTool(UniqueObject, SimpleItem):
+class ZVCStorageTool(UniqueObject, SimpleItem, PropertyManager):
     """Zope Version Control Based Version Storage
 
     There exist two selector schemas:
@@ -162,9 +223,46 @@ class ZVCStorageTool(UniqueObject, SimpleItem):
     storageStatistics = PageTemplateFile('www/storageStatistics.pt',
                                          globals(),
                                          __name__='modifierEditForm')
-    manage_options = ({'label' : 'Statistics (may take time)', 'action' : 'storageStatistics'}, ) \
+    manage_options = ({'label' : 'Statistics', 'action' : 'storageStatistics'}, ) \
+                     + PropertyManager.manage_options \
                      + SimpleItem.manage_options[:]
 
+    # store the clones as pickle (serialized once at save time and
+    # unserialized only when retrieved)
+    serializedPayloads = False
+
+    # store older versions as reverse delta to the next younger version
+    # (implies serialized payloads). Every n-th version is kept fully
+    # stored, thus retrieving needs at most n-1 deltas to be applied.
+    # 0 disables delta compression.
+    deltaSnapshotInterval = 0
+
+    # store identical versions (of all histories) only once (implies
+    # serialized payloads)
+    deduplicatePayloads = False
+
+    # compress serialized versions and referenced data of at least
+    # ``compressionMinSize`` bytes ('': no compression, implies serialized
+    # payloads otherwise)
+    compressionAlgorithm = ''
+    compressionMinSize = 1024
+    compressionAlgorithms = ('',) + tuple(sorted(COMPRESSORS.keys()))
+
+    _properties = (
+        {'id': 'serializedPayloads', 'type': 'boolean', 'mode': 'w',
+         'label': "store new versions serialized (pickled once at save time)"},
+        {'id': 'deltaSnapshotInterval', 'type': 'int', 'mode': 'w',
+         'label': "store versions as reverse deltas keeping every n-th "
+                  "version fully stored (0: no delta compression)"},
+        {'id': 'deduplicatePayloads', 'type': 'boolean', 'mode': 'w',
+         'label': "store identical versions only once"},
+        {'id': 'compressionAlgorithm', 'type': 'selection', 'mode': 'w',
+         'select_variable': 'compressionAlgorithms',
+         'label': "compress new versions with"},
+        {'id': 'compressionMinSize', 'type': 'int', 'mode': 'w',
+         'label': "compress data of at least n bytes"},
+    )
+
     # make exceptions available trough the tool
     StorageError = StorageError
     StorageRetrieveError = StorageRetrieveError
@@ -176,6 +274,12 @@ class ZVCStorageTool(UniqueObject, SimpleItem):
     # the ZVC repository ("the" version storage)
     zvc_repo = None
 
+    # content addressed storage of the deduplicated payloads
+    _payloadStore = None
+
+    # running aggregates for the statistics
+    _statistics = None
+
     security = ClassSecurityInfo()
 
     # -------------------------------------------------------------------
@@ -244,54 +348,74 @@ class ZVCStorageTool(UniqueObject, SimpleItem):
                  countPurged=True, substitute=True):
         """See ``IStorage`` and Comments in ``IPurgePolicy``
         """
-        zvc_repo = self._getZVCRepo()
-        zvc_histid, zvc_selector = \
-            self._getZVCAccessInfo(history_id, selector, countPurged)
+        return self.retrieveMany(history_id, (selector, ), countPurged,
+                                 substitute)[0]
 
-        if zvc_histid is None:
-            raise StorageRetrieveError(
-                "Retrieving version '%s' of object with history id '%s' "
-                "failed. A history with the given history id does not exist."
-                % (selector, history_id))
-
-        if zvc_selector is None:
-            raise StorageRetrieveError(
-                "Retrieving version '%s' of object with history id '%s' "
-                "failed. The version does not exist."
-                % (selector, history_id))
-
-        # retrieve the object
-        try:
-            zvc_obj = zvc_repo.getVersionOfResource(zvc_histid, zvc_selector)
-        except VersionControlError:
-            # this should never happen
-            raise StorageRetrieveError(
-                "Retrieving version '%s' of object with history id '%s' "
-                "failed. The underlying storage implementation reported "
-                "an error." % (selector, history_id))
-
-        # retrieve metadata
-        # TODO: read this from the shadow storage directly
-        metadata = self._retrieveMetadataFromZVC(zvc_histid, zvc_selector)
+    security.declarePrivate('retrieveMany')
+    def retrieveMany(self, history_id, selectors,
+                     countPurged=True, substitute=True):
+        """See ``IStorage`` and Comments in ``IPurgePolicy``
 
-        # wrap object and referenced data
-        object = zvc_obj.getWrappedObject()
-        # Get referenced data from shadow history
+        The histories are looked up once for all versions and pickles
+        rebuilt from deltas are reused.
+        """
         history = self._getShadowHistory(history_id)
-        referenced_data = history.retrieve(selector).get('referenced_data', {})
-        data = VersionData(object, referenced_data, metadata)
-
-        # check if retrieved a replacement for a removed object and
-        # if so check if a substitute is available
-        if substitute and isinstance(data.object, Removed):
-            # delegate retrieving to purge policy if one is available
-            # if none is available just return the replacement for the
-            # removed object
-            policy = getToolByName(self, 'portal_purgepolicy', None)
-            if policy is not None:
-                data = policy.retrieveSubstitute(history_id, selector,
-                                                 default=data)
-        return data
+        zvc_history = None
+        policy = _marker
+        cache = {}
+        result = []
+        for selector in selectors:
+            if history is None:
+                raise StorageRetrieveError(
+                    "Retrieving version '%s' of object with history id '%s' "
+                    "failed. A history with the given history id does not "
+                    "exist." % (selector, history_id))
+
+            shadowInfo = history.retrieve(selector, countPurged)
+            if shadowInfo is None:
+                raise StorageRetrieveError(
+                    "Retrieving version '%s' of object with history id '%s' "
+                    "failed. The version does not exist."
+                    % (selector, history_id))
+            zvc_histid = shadowInfo["vc_info"].history_id
+            zvc_selector = str(history.getVersionId(selector, countPurged) + 1)
+
+            # retrieve the object
+            try:
+                if zvc_history is None:
+                    zvc_history = \
+                        self._getZVCRepo().getVersionHistory(zvc_histid)
+                object = self._retrieveZVCObject(zvc_histid, zvc_selector,
+                                                 zvc_history, cache)
+            except VersionControlError:
+                # this should never happen
+                raise StorageRetrieveError(
+                    "Retrieving version '%s' of object with history id '%s' "
+                    "failed. The underlying storage implementation reported "
+                    "an error." % (selector, history_id))
+
+            # retrieve metadata and referenced data from the shadow history
+            metadata = self._retrieveMetadata(shadowInfo, zvc_histid,
+                                              zvc_selector)
+            referenced_data = self._decompressReferencedData(
+                shadowInfo.get('referenced_data', {}))
+
+            # wrap object and referenced data
+            data = VersionData(object, referenced_data, metadata)
+
+            # check if retrieved a replacement for a removed object and
+            # if so check if a substitute is available
+            if substitute and isinstance(data.object, Removed):
+                # delegate retrieving to purge policy if one is available
+                # if none is available just return the replacement for the
+                # removed object
+                if policy is _marker:
+                    policy = getToolByName(self, 'portal_purgepolicy', None)
+                if policy is not None:
+                    data = policy.retrieveSubstitute(history_id, selector,
+                                                     default=data)
+            result.append(data)
+        return result
 
     security.declarePrivate('getHistory')
     def getHistory(self, history_id, countPurged=True, substitute=True):
@@ -303,10 +427,81 @@ class ZVCStorageTool(UniqueObject, SimpleItem):
     def getModificationDate(self, history_id, selector=None,
                             countPurged=True, substitute=True):
         """See IStorage.
+
+        The modification date is cached in the shadow history since
+        version 2.2.12. Only versions saved by older releases (and
+        purged versions) are loaded from the ZVC storage.
         """
+        history = self._getShadowHistory(history_id)
+        if history is not None:
+            shadowInfo = history.retrieve(selector, countPurged)
+            if shadowInfo is not None:
+                modified = shadowInfo.get("modified", None)
+                if modified is not None:
+                    return modified
+
         vdata = self.retrieve(history_id, selector, countPurged, substitute)
         return vdata.object.object.modified()
 
+    security.declarePrivate('getMetadata')
+    def getMetadata(self, history_id, selector=None, countPurged=True):
+        """See IStorage.
+
+        Only the shadow history is accessed, the object isn't loaded
+        from the ZVC storage.
+        """
+        history, shadowInfo = self._getShadowInfo(history_id, selector,
+                                                  countPurged, 'metadata')
+        zvc_histid = shadowInfo["vc_info"].history_id
+        zvc_selector = str(history.getVersionId(selector, countPurged) + 1)
+        return self._retrieveMetadata(shadowInfo, zvc_histid, zvc_selector)
+
+    security.declarePrivate('getHistoryIds')
+    def getHistoryIds(self, start=None):
+        """Iterates over the ids of all histories in ascending order
+
+        If ``start`` is given only the ids greater than ``start`` are
+        returned.
+        """
+        storage = self._getShadowStorage(autoAdd=False)
+        if storage is None:
+            return iter(())
+        return storage.getHistoryIds(start)
+
+    security.declarePrivate('getReferencedData')
+    def getReferencedData(self, history_id, selector=None, countPurged=True):
+        """See IStorage.
+
+        Only the shadow history is accessed, the object isn't loaded
+        from the ZVC storage.
+        """
+        history, shadowInfo = self._getShadowInfo(history_id, selector,
+                                                  countPurged,
+                                                  'referenced data')
+        return self._decompressReferencedData(
+            shadowInfo.get('referenced_data', {}))
+
+    def _getShadowInfo(self, history_id, selector, countPurged, what):
+        """Returns the shadow history and the selected shadow record
+
+        Raises a ``StorageRetrieveError`` if the history or the version
+        does not exist.
+        """
+        history = self._getShadowHistory(history_id)
+        if history is None:
+            raise StorageRetrieveError(
+                "Retrieving the %s of version '%s' of object with history "
+                "id '%s' failed. A history with the given history id does "
+                "not exist." % (what, selector, history_id))
+
+        shadowInfo = history.retrieve(selector, countPurged)
+        if shadowInfo is None:
+            raise StorageRetrieveError(
+                "Retrieving the %s of version '%s' of object with history "
+                "id '%s' failed. The version does not exist."
+                % (what, selector, history_id))
+        return history, shadowInfo
+
 
     # -------------------------------------------------------------------
     # methods implementing IPurgeSupport
@@ -316,7 +511,6 @@ class ZVCStorageTool(UniqueObject, SimpleItem):
     def purge(self, history_id, selector, metadata={}, countPurged=True):
         """See ``IPurgeSupport``
         """
-        zvc_repo = self._getZVCRepo()
         zvc_histid, zvc_selector = \
             self._getZVCAccessInfo(history_id, selector, countPurged)
         if zvc_histid is None:
@@ -331,24 +525,71 @@ class ZVCStorageTool(UniqueObject, SimpleItem):
                 "failed. The version does not exist."
                 % (selector, history_id))
 
-        # digging into ZVC internals:
-        # Get a reference to the version stored in the ZVC history storage
-        #
-        # Implementation Note:
-        #
-        # ZVCs ``getVersionOfResource`` is quite more complex. But as we
-        # do not use labeling and branches it is not a problem to get the
-        # version in the following simple way.
-        zvc_history = zvc_repo.getVersionHistory(zvc_histid)
-        version = zvc_history.getVersionById(zvc_selector)
-        data = version._data
-
-        if not isinstance(data.getWrappedObject(), Removed):
+        history = self._getShadowHistory(history_id)
+        self._purgeVersions(history, zvc_histid, [int(zvc_selector) - 1],
+                            metadata)
+
+    security.declarePrivate('purgeMany')
+    def purgeMany(self, history_id, selectors, metadata={}, countPurged=True):
+        """See ``IPurgeSupport``
+
+        The ZVC history is looked up and the statistics are updated once
+        for all versions.
+        """
+        history = self._getShadowHistory(history_id)
+        if history is None:
+            raise StoragePurgeError(
+                "Purging versions '%s' of object with history id '%s' "
+                "failed. A history with the given history id does not exist."
+                % (selectors, history_id))
+
+        version_ids = []
+        for selector in selectors:
+            version_id = history.getVersionId(selector, countPurged)
+            if version_id is None:
+                raise StoragePurgeError(
+                    "Purging version '%s' of object with history id '%s' "
+                    "failed. The version does not exist."
+                    % (selector, history_id))
+            version_ids.append(version_id)
+        if not version_ids:
+            return 0
+
+        zvc_histid = history.retrieve(version_ids[0])["vc_info"].history_id
+        return self._purgeVersions(history, zvc_histid, version_ids,
+                                   metadata)
+
+    def _purgeVersions(self, history, zvc_histid, version_ids, metadata):
+        """Purges the given versions of the shadow and the ZVC history
+
+        Versions purged before are skipped. Returns the number of purged
+        versions.
+        """
+        zvc_history = self._getZVCRepo().getVersionHistory(zvc_histid)
+        size = history.getSize()[0]
+        nbrOfPurged = 0
+        # oldest first: the versions stored as delta to a purged version
+        # are then mostly purged already and needn't be rebuilt
+        for version_id in sorted(set(version_ids)):
+            zvc_selector = str(version_id + 1)
+
+            # digging into ZVC internals:
+            # Get a reference to the version stored in the ZVC history storage
+            version = zvc_history.getVersionById(zvc_selector)
+            data = version._data
+            if data.isRemoved():
+                continue
+
+            # the next older version may be stored as delta to the
+            # version about to be purged
+            self._rebuildDeltaTo(history, zvc_histid, zvc_selector)
+
             # purge version in shadow storages history
-            history = self._getShadowHistory(history_id)
+            history.purge(version_id, metadata, countPurged=True)
 
-            # update administrative data
-            history.purge(selector, metadata, countPurged)
+            # the payload may be shared with other versions
+            if isinstance(data._object, PayloadReference):
+                self._getPayloadStore().release(data._object.getDigest())
 
             # prepare replacement for the deleted object and metadata
             removedInfo = Removed("purged", metadata)
@@ -356,9 +597,18 @@ class ZVCStorageTool(UniqueObject, SimpleItem):
             # digging into ZVC internals: remove the stored object
             version._data = ZVCAwareWrapper(removedInfo, metadata)
 
-            # digging into ZVC internals: replace the message
-            logEntry = self._retrieveZVCLogEntry(zvc_histid, zvc_selector)
-            logEntry.message = self._encodeMetadata(metadata)
+            # The ZVC log message isn't touched anymore: the metadata
+            # stored in the shadow history is authoritative (and
+            # replacing the message would need a scan over the whole log).
+            nbrOfPurged += 1
+
+        # update administrative data
+        if nbrOfPurged:
+            self._getStatistics().change(history.portal_type,
+                                         history.deleted,
+                                         versions=-nbrOfPurged,
+                                         size=history.getSize()[0] - size)
+        return nbrOfPurged
 
 
     # -------------------------------------------------------------------
@@ -378,18 +628,38 @@ class ZVCStorageTool(UniqueObject, SimpleItem):
                 # returning None signalizes that the version wasn't saved
                 return None
 
-        # calculate the approximate size taking into account the object
-        # and the referenced_data (overwriting the archivists size as the
-        # storage knows it better)
-        approxSize = getSize(object) + getSize(referenced_data)
-        metadata["sys_metadata"]["approxSize"] = approxSize
-
         # prepare the object for beeing saved with ZVC
         #
         # - Recall the ``__vc_info__`` from the most current version
         #   (selector=None).
+        # - Serialize the object if configured so
         # - Wrap the object, the referenced data and metadata
         vc_info = self._getVcInfo(object, shadowInfo)
+        portal_type = getPortalType(object)
+        modified = getModified(object)
+        payload = None
+        if self._isSerializing():
+            # the ZVC info attached to the object differs with every
+            # version (it's only needed by ``_getVcInfo``)
+            if vc_info is not None:
+                del object.__vc_info__
+            payload = serialize(object)
+            object = self._storePayload(payload)
+
+        # calculate the approximate size taking into account the object
+        # and the referenced_data (overwriting the archivists size as the
+        # storage knows it better)
+        referencedSize = getSize(referenced_data)
+        approxSize = getSize(object) + referencedSize
+        metadata["sys_metadata"]["approxSize"] = approxSize
+
+        # record the size effectively stored if compressing
+        if self.compressionAlgorithm:
+            referenced_data, saved = \
+                self._compressReferencedData(referenced_data)
+            storedSize = self._getStoredSize(object) + referencedSize - saved
+            metadata["sys_metadata"]["storedSize"] = storedSize
+
         zvc_obj = ZVCAwareWrapper(object, metadata,
                                   vc_info)
         message = self._encodeMetadata(metadata)
@@ -397,15 +667,248 @@ class ZVCStorageTool(UniqueObject, SimpleItem):
         # call appropriate ZVC method
         zvc_method(zvc_obj, message)
 
+        # the previous version may be stored as delta now
+        history = self._getShadowHistory(history_id, autoAdd=True)
+        if self.deltaSnapshotInterval > 0:
+            self._storePreviousAsDelta(history, zvc_obj, payload)
+
         # save the ``__vc_info__`` attached by the zvc call from above
-        # and cache the metadata in the shadow storage
+        # and cache the metadata and the modification date in the shadow
+        # storage
         shadowInfo = {
             "vc_info": zvc_obj.__vc_info__,
             "metadata": metadata,
             "referenced_data": referenced_data,
+            "portal_type": portal_type,
+            "modified": modified,
         }
-        history = self._getShadowHistory(history_id, autoAdd=True)
-        return history.save(shadowInfo)
+        previous_type = history.portal_type
+        version_id = history.save(shadowInfo)
+        self._countSaved(history, previous_type, approxSize)
+        return version_id
+
+    def _countSaved(self, history, previous_type, size):
+        """Updates the statistics after a version was saved
+        """
+        statistics = self._getStatistics()
+        versions = history.getLength(countPurged=False)
+        if history.deleted:
+            # saving a version implies the item exists (again)
+            statistics.move(previous_type, True, previous_type, False,
+                            1, versions - 1, history.getSize()[0] - size)
+            history.deleted = False
+
+        if history.getLength(countPurged=True) == 1:
+            statistics.change(history.portal_type, False, 1, 1, size)
+            return
+        if previous_type != history.portal_type:
+            statistics.move(previous_type, False, history.portal_type, False,
+                            1, versions - 1, history.getSize()[0] - size)
+        statistics.change(history.portal_type, False, 0, 1, size)
+
+    def _isSerializing(self):
+        """Returns True if new versions are stored serialized
+        """
+        return self.serializedPayloads or self.deduplicatePayloads \
+               or self.deltaSnapshotInterval > 0 \
+               or bool(self.compressionAlgorithm)
+
+    def _storePayload(self, payload):
+        """Returns what to store with ZVC for a serialized payload
+
+        Adds the payload to the payload store if deduplicating. The
+        payload is compressed if configured so and not stored already.
+        """
+        reference = None
+        if self.deduplicatePayloads:
+            payloadStore = self._getPayloadStore()
+            reference = payloadStore.add(payload)
+            if reference is not None \
+               and payloadStore.get(reference.getDigest()) is not payload:
+                # an identical payload was stored before
+                return reference
+
+        self._compressPayload(payload)
+        return reference or payload
+
+    def _getStoredSize(self, object):
+        """Returns the size of the object as stored (maybe compressed)
+
+        The size of a shared payload is the one of the payload in the
+        payload store.
+        """
+        if isinstance(object, PayloadReference):
+            object = self._getPayloadStore().get(object.getDigest())
+        if isinstance(object, SerializedPayload):
+            return object.getStoredSize()
+        return getSize(object)
+
+    def _compressPayload(self, payload):
+        """Compresses the payload if configured so
+        """
+        if self.compressionAlgorithm:
+            payload.compress(self.compressionAlgorithm,
+                             self.compressionMinSize)
+
+    def _compressReferencedData(self, referenced_data):
+        """Compresses big strings of the referenced data
+
+        Returns the referenced data and the number of bytes saved.
+        """
+        compressed = {}
+        saved = 0
+        for name, value in referenced_data.items():
+            if type(value) is str and len(value) >= self.compressionMinSize:
+                data = CompressedData(value, self.compressionAlgorithm)
+                if data.getStoredSize() < len(value):
+                    saved += len(value) - data.getStoredSize()
+                    value = data
+            compressed[name] = value
+        return compressed, saved
+
+    def _decompressReferencedData(self, referenced_data):
+        """Returns the referenced data with compressed strings restored
+        """
+        for value in referenced_data.values():
+            if isinstance(value, CompressedData):
+                break
+        else:
+            return referenced_data
+
+        decompressed = {}
+        for name, value in referenced_data.items():
+            if isinstance(value, CompressedData):
+                value = value.getData()
+            decompressed[name] = value
+        return decompressed
+
+    def _storePreviousAsDelta(self, history, zvc_obj, base):
+        """Replaces the pickle of the previous version by a reverse delta
+
+        The delta is calculated against the pickle of the version just
+        saved. Every ``deltaSnapshotInterval``-th version is kept fully
+        stored to limit the length of the chain of deltas to apply when
+        retrieving an old version.
+        """
+        previous_id = history.getLastAvailable()
+        if previous_id is None \
+           or previous_id % self.deltaSnapshotInterval == 0:
+            return
+
+        # only fully stored pickles can be replaced by a delta (not the
+        # versions saved before serializing, shared or purged ones)
+        vc_info = zvc_obj.__vc_info__
+        previous = self._getZVCVersion(vc_info.history_id,
+                                       str(previous_id + 1))
+        payload = previous._data._object
+        if payload.__class__ is not SerializedPayload:
+            return
+
+        delta = DeltaPayload(payload, vc_info.version_id, base.getData())
+        # only worth if smaller
+        if delta.getStoredSize() < payload.getStoredSize():
+            previous._data._object = delta
+
+    def _rebuildDeltaTo(self, history, zvc_histid, zvc_selector):
+        """Stores the next older version fully if it is a delta to the
+        given version
+
+        Has to be called before the given version gets purged.
+        """
+        previous_id = history.getPreviousAvailable(int(zvc_selector) - 1)
+        if previous_id is None:
+            return
+        zvc_history = self._getZVCRepo().getVersionHistory(zvc_histid)
+        previous_selector = str(previous_id + 1)
+        previous = zvc_history.getVersionById(previous_selector)
+        payload = previous._data._object
+        if isinstance(payload, DeltaPayload) \
+           and payload.getBaseVersionId() == zvc_selector:
+            data = self._getPayloadData(zvc_history, previous_selector,
+                                        payload)
+            payload = SerializedPayload(data, payload._refs)
+            self._compressPayload(payload)
+            previous._data._object = payload
+
+    def _getPayloadData(self, zvc_history, zvc_selector, payload,
+                        cache=None):
+        """Returns the pickle of a serialized payload
+
+        Delta stored versions are rebuilt following the chain of bases
+        up to the first fully stored version. ``cache`` maps ZVC version
+        ids to pickles rebuilt already (used when retrieving many
+        versions at once).
+        """
+        deltas = []
+        version_id = zvc_selector
+        payload = self._resolvePayload(payload)
+        while True:
+            if cache is not None and version_id in cache:
+                data = cache[version_id]
+                break
+            if not isinstance(payload, DeltaPayload):
+                if not isinstance(payload, SerializedPayload):
+                    raise StorageRetrieveError(
+                        "The base version of a delta stored version isn't "
+                        "available anymore (ZVC version '%s')." % version_id)
+                data = payload.getData()
+                if cache is not None and deltas:
+                    cache[version_id] = data
+                break
+            deltas.append((version_id, payload))
+            version_id = payload.getBaseVersionId()
+            version = zvc_history.getVersionById(version_id)
+            payload = self._resolvePayload(version._data._object)
+
+        deltas.reverse()
+        for version_id, delta in deltas:
+            data = delta.applyTo(data)
+            if cache is not None:
+                cache[version_id] = data
+        return data
+
+    def _retrieveZVCObject(self, zvc_histid, zvc_selector,
+                           zvc_history=None, cache=None):
+        """Returns a copy of the object stored by ZVC
+        """
+        if zvc_history is None:
+            zvc_history = self._getZVCRepo().getVersionHistory(zvc_histid)
+        payload = zvc_history.getVersionById(zvc_selector)._data._object
+        payload = self._resolvePayload(payload)
+        if isinstance(payload, SerializedPayload):
+            # unpickling returns a copy already
+            return payload.load(self._getPayloadData(zvc_history,
+                                                     zvc_selector, payload,
+                                                     cache))
+
+        zvc_repo = self._getZVCRepo()
+        zvc_obj = zvc_repo.getVersionOfResource(zvc_histid, zvc_selector)
+        return zvc_obj.getWrappedObject()
+
+    def _resolvePayload(self, payload):
+        """Returns the shared payload if the payload is a reference to it
+        """
+        if isinstance(payload, PayloadReference):
+            return self._getPayloadStore().get(payload.getDigest())
+        return payload
+
+    def _getStatistics(self):
+        """Returns the Running Aggregates of the Statistics
+        """
+        if self._statistics is None:
+            self._statistics = StorageStatistics()
+        return self._statistics
+
+    def _getPayloadStore(self, autoAdd=True):
+        """Returns the Payload Store
+
+        Returns None if there wasn't ever saved any deduplicated version.
+        """
+        if self._payloadStore is None:
+            if not autoAdd:
+                return None
+            self._payloadStore = PayloadStore()
+        return self._payloadStore
 
     def _getShadowStorage(self, autoAdd=True):
         """Returns the Shadow Storage
@@ -466,6 +969,18 @@ class ZVCStorageTool(UniqueObject, SimpleItem):
         zvc_vid = str(history.getVersionId(selector, countPurged) + 1)
         return zvc_hid, zvc_vid
 
+    def _getZVCVersion(self, zvc_histid, zvc_selector):
+        """Returns the version object stored in the ZVC history
+
+        Implementation Note:
+
+        ZVCs ``getVersionOfResource`` is quite more complex (and clones
+        the versions data). But as we do not use labeling and branches
+        it is not a problem to get the version in this simple way.
+        """
+        zvc_history = self._getZVCRepo().getVersionHistory(zvc_histid)
+        return zvc_history.getVersionById(zvc_selector)
+
     def _getVcInfo(self, obj, shadowInfo, set_checked_in=False):
         """Recalls ZVC Related Informations and Attaches them to the Object
         """
@@ -489,14 +1004,24 @@ class ZVCStorageTool(UniqueObject, SimpleItem):
         vc_info.version_id = str(len(zvc_repo.getVersionIds(obj)))
         return vc_info
 
+    def _retrieveMetadata(self, shadowInfo, zvc_histid, zvc_selector):
+        """Returns a copy of the metadata of a version
+
+        The metadata cached in the shadow history is authoritative. Only
+        for shadow records of storages not migrated yet the metadata is
+        read from the ZVC log (see ``migrateShadowMetadata``).
+        """
+        metadata = shadowInfo.get("metadata", None)
+        if metadata is None:
+            return self._retrieveMetadataFromZVC(zvc_histid, zvc_selector)
+        return deepCopy(metadata)
+
     def _retrieveZVCLogEntry(self, zvc_histid, zvc_selector):
         """Retrieves the metadata from ZVCs log
 
-        Unfortunately this may get costy with long histories.
-        We should really store metadata in the shadow storage in the
-        future or loop over the log in reverse.
-
-        XXX also store (only store) the metadata in the shadow before 1.0beta1
+        Unfortunately this gets costy with long histories as the whole
+        log is scanned. Only used as fallback and for migrations, the
+        metadata is cached in the shadow history.
         """
         zvc_repo = self._getZVCRepo()
         log = zvc_repo.getVersionHistory(zvc_histid).getLogEntries()
@@ -636,78 +1161,280 @@ class ZVCStorageTool(UniqueObject, SimpleItem):
 
         return (nbrOfMigratedHistories, nbrOfMigratedVersions, totalTime)
 
+    # -------------------------------------------------------------------
+    # Migration Support
+    #
+    # - Shadow records missing the metadata (storages older than 1.0beta1)
+    # -------------------------------------------------------------------
+
+    def migrateShadowMetadata(self):
+        """Copies the metadata from ZVCs log to the shadow histories
+
+        Only versions whose shadow record doesn't cache the metadata yet
+        are touched. The log of every history is scanned only once.
+
+        Returns the number of migrated histories and versions.
+        """
+        storage = self._getShadowStorage(autoAdd=False)
+        if storage is None:
+            return 0, 0
+
+        startTime = time.time()
+        zvc_repo = self._getZVCRepo()
+        checkin = LogEntry.ACTION_CHECKIN
+        nbrOfMigratedHistories = 0
+        nbrOfMigratedVersions = 0
+        for history_id in storage.getHistoryIds():
+            history = storage.getHistory(history_id)
+            missing = [vid for vid, shadowInfo in history._full.items()
+                       if shadowInfo.get("metadata", None) is None
+                       and shadowInfo.get("vc_info", None) is not None]
+            if not missing:
+                continue
+
+            zvc_histid = history._full[missing[0]]["vc_info"].history_id
+            log = zvc_repo.getVersionHistory(zvc_histid).getLogEntries()
+            messages = dict([(e.version_id, e.message) for e in log
+                             if e.action == checkin])
+            for vid in missing:
+                message = messages.get(str(vid + 1), None)
+                if message is None:
+                    continue
+                shadowInfo = history._full[vid]
+                shadowInfo["metadata"] = loads(message.split('\x00\n', 1)[1])
+                # reassign to let the BTree know about the change
+                history._full[vid] = shadowInfo
+                nbrOfMigratedVersions += 1
+            nbrOfMigratedHistories += 1
+
+        logger.log(logging.INFO, "CMFEditions storage migration: "
+            "copied metadata of %s versions in %s histories to the shadow "
+            "storage in %.2f seconds" % (nbrOfMigratedVersions,
+                                         nbrOfMigratedHistories,
+                                         time.time() - startTime))
+        return nbrOfMigratedHistories, nbrOfMigratedVersions
+
+    security.declarePrivate('migrateAvailableVersions')
+    def migrateAvailableVersions(self):
+        """Converts the lists of not purged versions to tree sets
+
+        Histories of older storages would otherwise be migrated on the
+        next save or purge only.
+
+        Returns the number of migrated histories.
+        """
+        storage = self._getShadowStorage(autoAdd=False)
+        if storage is None:
+            return 0
+
+        startTime = time.time()
+        nbrOfMigratedHistories = 0
+        for history_id in storage.getHistoryIds():
+            if storage.getHistory(history_id).migrateAvailable():
+                nbrOfMigratedHistories += 1
+
+        logger.log(logging.INFO, "CMFEditions storage migration: "
+            "converted the available versions of %s histories in %.2f "
+            "seconds" % (nbrOfMigratedHistories, time.time() - startTime))
+        return nbrOfMigratedHistories
+
+    security.declarePrivate('migrateModificationDates')
+    def migrateModificationDates(self):
+        """Caches the modification dates of the versions in the shadow
+        histories
+
+        Only not purged versions whose shadow record doesn't cache the
+        modification date yet are loaded from the ZVC storage.
+
+        Returns the number of migrated histories and versions.
+        """
+        storage = self._getShadowStorage(autoAdd=False)
+        if storage is None:
+            return 0, 0
+
+        startTime = time.time()
+        nbrOfMigratedHistories = 0
+        nbrOfMigratedVersions = 0
+        for history_id in storage.getHistoryIds():
+            history = storage.getHistory(history_id)
+            available = history._getAvailable()
+            missing = [vid for vid, shadowInfo in history._full.items()
+                       if vid in available
+                       and shadowInfo.get("modified", None) is None
+                       and shadowInfo.get("vc_info", None) is not None]
+            if not missing:
+                continue
+
+            vdatas = self.retrieveMany(history_id, missing, countPurged=True,
+                                       substitute=False)
+            for vid, vdata in zip(missing, vdatas):
+                modified = getModified(vdata.object)
+                if modified is None:
+                    continue
+                shadowInfo = history._full[vid]
+                shadowInfo["modified"] = modified
+                # reassign to let the BTree know about the change
+                history._full[vid] = shadowInfo
+                nbrOfMigratedVersions += 1
+            nbrOfMigratedHistories += 1
+
+        logger.log(logging.INFO, "CMFEditions storage migration: "
+            "cached the modification dates of %s versions in %s histories "
+            "in %.2f seconds" % (nbrOfMigratedVersions,
+                                 nbrOfMigratedHistories,
+                                 time.time() - startTime))
+        return nbrOfMigratedHistories, nbrOfMigratedVersions
+
+    security.declarePrivate('shardShadowStorage')
+    def shardShadowStorage(self):
+        """Spreads the histories of an older shadow storage over shards
+
+        Returns the number of moved histories.
+        """
+        storage = self._getShadowStorage(autoAdd=False)
+        if storage is None:
+            return 0
+
+        startTime = time.time()
+        nbrOfHistories = storage.shard()
+        logger.log(logging.INFO, "CMFEditions storage migration: "
+            "moved %s histories to shards in %.2f seconds"
+            % (nbrOfHistories, time.time() - startTime))
+        return nbrOfHistories
+
+    # -------------------------------------------------------------------
+    # Statistics Support
+    #
+    # - The statistics are kept up to date on save and purge and by
+    #   the event subscribers marking histories of deleted items.
+    # -------------------------------------------------------------------
+
+    security.declarePrivate('setHistoryDeleted')
+    def setHistoryDeleted(self, history_id, deleted=True):
+        """Marks the history as belonging to a deleted (or existing) item
+        """
+        storage = self._getShadowStorage(autoAdd=False)
+        if storage is None:
+            return
+        history = storage.getHistory(history_id)
+        if history is None or history.deleted == bool(deleted):
+            return
+
+        self._getStatistics().move(history.portal_type, history.deleted,
+                                   history.portal_type, bool(deleted), 1,
+                                   history.getLength(countPurged=False),
+                                   history.getSize()[0])
+        history.deleted = bool(deleted)
+
+    security.declarePrivate('rebuildStatistics')
+    def rebuildStatistics(self):
+        """Recalculates the statistics scanning all histories
+
+        Also records the portal type and the state of the item in the
+        shadow histories of older storages. This is costly and only
+        needed for migrating older storages.
+
+        Returns the number of histories scanned.
+        """
+        startTime = time.time()
+        statistics = self._statistics = StorageStatistics()
+        storage = self._getShadowStorage(autoAdd=False)
+        if storage is None:
+            return 0
+
+        hidhandler = getToolByName(self, "portal_historyidhandler")
+        nbrOfHistories = 0
+        for history_id in storage.getHistoryIds():
+            history = storage.getHistory(history_id)
+            workingCopy = hidhandler.queryObject(history_id)
+            deleted = workingCopy is None
+            if not history.portal_type:
+                if workingCopy is not None:
+                    portal_type = workingCopy.getPortalTypeName()
+                else:
+                    try:
+                        vdata = self.retrieve(history_id, substitute=False)
+                        portal_type = getPortalType(vdata.object)
+                    except StorageError:
+                        portal_type = ''
+                if portal_type:
+                    history.portal_type = portal_type
+            if history.deleted != deleted:
+                history.deleted = deleted
+            statistics.change(history.portal_type, deleted, 1,
+                              history.getLength(countPurged=False),
+                              history.getSize()[0])
+            nbrOfHistories += 1
+
+        logger.log(logging.INFO, "CMFEditions storage migration: "
+            "calculated the statistics of %s histories in %.2f seconds"
+            % (nbrOfHistories, time.time() - startTime))
+        return nbrOfHistories
+
     # -------------------------------------------------------------------
     # ZMI methods
     # -------------------------------------------------------------------
 
     security.declareProtected(ManagePortal, 'zmi_getStorageStatistics')
-    def zmi_getStorageStatistics(self):
+    def zmi_getStorageStatistics(self, b_start=0, b_size=100):
         """
         """
         startTime = time.time()
-        # get all history ids (incl. such that were deleted in the portal)
+
+        # the summaries are read from the running aggregates
+        statistics = self._getStatistics()
+        types = []
+        totals = {True: [0, 0, 0], False: [0, 0, 0]}
+        for portal_type, deleted, counters in statistics.listCounters():
+            types.append({
+                "portal_type": portal_type or "n/a",
+                "deleted": deleted,
+                "histories": counters.histories,
+                "versions": counters.versions,
+                "size": counters.size,
+            })
+            total = totals[deleted]
+            total[0] += counters.histories
+            total[1] += counters.versions
+            total[2] += counters.size
+        existingHistories, existingVersions, existingSize = totals[False]
+        deletedHistories, deletedVersions, deletedSize = totals[True]
+
+        # collect informations of the histories of the current page only
         storage = self._getShadowStorage(autoAdd=False)
         if storage is not None:
-            historyIds = storage._storage
+            historyIds = list(islice(storage.getHistoryIds(),
+                                     b_start, b_start + b_size))
         else:
-            historyIds = {}
+            historyIds = []
         hidhandler = getToolByName(self, "portal_historyidhandler")
         portal_paths_len = len(getToolByName(self, "portal_url")())
 
-        # collect interesting informations
-        histories = []
-        for hid in historyIds.keys():
-            history = self.getHistory(hid)
-            length = len(history)
-            shadowStorage = self._getShadowHistory(hid)
-            size = 0
-            sizeState = "n/a"
-            if shadowStorage is not None:
-                size, sizeState = shadowStorage.getSize()
-
-            workingCopy = hidhandler.queryObject(hid)
-            if workingCopy is not None:
-                url = workingCopy.absolute_url()
-                path = url[portal_paths_len:]
-                portal_type = workingCopy.getPortalTypeName()
-            else:
-                path = None
-                url = None
-                retrieved = self.retrieve(hid).object.object
-                portal_type = retrieved.getPortalTypeName()
+        existing = []
+        deleted = []
+        for hid in historyIds:
+            history = storage.getHistory(hid)
+            size, sizeState = history.getSize()
+            workingCopy = None
+            if not history.deleted:
+                workingCopy = hidhandler.queryObject(hid)
             histData = {
                 "history_id": hid,
-                "length": length,
-                "url": url,
-                "path": path,
-                "portal_type": portal_type,
+                "length": history.getLength(countPurged=True),
+                "url": None,
+                "path": None,
+                "portal_type": history.portal_type or "n/a",
                 "size": size,
                 "sizeState": sizeState,
             }
-            histories.append(histData)
-
-        # collect history ids with still existing working copies
-        existing = []
-        existingHistories = 0
-        existingVersions = 0
-        existingSize = 0
-        deleted = []
-        deletedHistories = 0
-        deletedVersions = 0
-        deletedSize = 0
-        for histData in histories:
-            if histData["path"] is None:
-                deleted.append(histData)
-                deletedHistories += 1
-                deletedVersions += histData["length"]
-                deletedSize += 0 # TODO
-            else:
+            if workingCopy is not None:
+                url = workingCopy.absolute_url()
+                histData["url"] = url
+                histData["path"] = url[portal_paths_len:]
                 existing.append(histData)
-                existingHistories += 1
-                existingVersions += histData["length"]
-                existingSize += 0 # TODO
+            else:
+                deleted.append(histData)
 
-        processingTime = "%.2f" % round(time.time() - startTime, 2)
         histories = existingHistories+deletedHistories
         versions = existingVersions+deletedVersions
 
@@ -728,41 +1455,151 @@ class ZVCStorageTool(UniqueObject, SimpleItem):
         else:
             deletedAverage = "n/a"
 
+        # shared payloads
+        payloadStore = self._getPayloadStore(autoAdd=False)
+        if payloadStore is not None:
+            storedSize, referencedSize = payloadStore.getSizes()
+        else:
+            storedSize, referencedSize = 0, 0
+        if storedSize:
+            dedupRatio = "%.2f" % round(float(referencedSize)/storedSize, 2)
+        else:
+            dedupRatio = "n/a"
+
+        # batching
+        previousStart = None
+        if b_start > 0:
+            previousStart = max(0, b_start - b_size)
+        nextStart = None
+        if b_start + b_size < histories:
+            nextStart = b_start + b_size
+
+        processingTime = "%.2f" % round(time.time() - startTime, 2)
+
         return {
             "existing": existing,
             "deleted": deleted,
+            "types": types,
+            "batch": {
+                "start": b_start,
+                "end": b_start + len(historyIds),
+                "previous": previousStart,
+                "next": nextStart,
+            },
             "summaries": {
                 "time": processingTime,
                 "totalHistories": histories,
                 "totalVersions": versions,
+                "totalSize": existingSize + deletedSize,
                 "totalAverage": totalAverage,
                 "existingHistories": existingHistories,
                 "existingVersions": existingVersions,
+                "existingSize": existingSize,
                 "existingAverage": existingAverage,
                 "deletedHistories": deletedHistories,
                 "deletedVersions": deletedVersions,
+                "deletedSize": deletedSize,
                 "deletedAverage": deletedAverage,
+                "sharedStoredSize": storedSize,
+                "sharedReferencedSize": referencedSize,
+                "dedupRatio": dedupRatio,
             }
         }
 
 InitializeClass(ZVCStorageTool)
 
 
+class StatisticsCounters(Persistent):
+    """Number of Histories, Versions and their Size
+    """
+    histories = 0
+    versions = 0
+    size = 0
+
+    def change(self, histories=0, versions=0, size=0):
+        self.histories += histories
+        self.versions += versions
+        self.size += size
+
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        # concurrent changes of the counters add up
+        state = dict(newState)
+        for name in ('histories', 'versions', 'size'):
+            state[name] = savedState.get(name, 0) + newState.get(name, 0) \
+                          - oldState.get(name, 0)
+        return state
+
+
+class StorageStatistics(Persistent):
+    """Running Aggregates of the Storage
+
+    Counts the histories, the versions (not purged) and their size per
+    portal type separately for existing and deleted items.
+    """
+
+    def __init__(self):
+        self._counters = OOBTree()
+
+    def change(self, portal_type, deleted, histories=0, versions=0, size=0):
+        """Changes the counters of a portal type
+        """
+        key = (portal_type or '', bool(deleted))
+        counters = self._counters.get(key, None)
+        if counters is None:
+            counters = self._counters[key] = StatisticsCounters()
+        counters.change(histories, versions, size)
+
+    def move(self, from_type, from_deleted, to_type, to_deleted,
+             histories, versions, size):
+        """Moves counts from one portal type or state to another one
+        """
+        self.change(from_type, from_deleted, -histories, -versions, -size)
+        self.change(to_type, to_deleted, histories, versions, size)
+
+    def listCounters(self):
+        """Returns (portal_type, deleted, counters) tuples
+        """
+        return [key + (counters, ) for key, counters in self._counters.items()]
+
+
+def getShard(history_id, shards):
+    """Returns the number of the shard the history belongs to
+
+    Has to be the same on every platform (``hash`` isn't).
+    """
+    return (zlib.crc32(str(history_id)) & 0xffffffff) % shards
+
+
 class ShadowStorage(Persistent):
     """Container for Shadow Histories
 
     Only cares about containerish operations.
+
+    The histories are spread over separately persisted trees. Concurrent
+    saves of unrelated histories then rarely touch the same buckets
+    (new histories would otherwise all be inserted into the last bucket).
     """
-    def __init__(self):
-        # Using a OOBtree to allow history ids of any type. The type
+    # shadow storages of older versions keep all histories in one tree
+    _storage = None
+    _shards = None
+
+    def __init__(self, shards=SHADOW_STORAGE_SHARDS):
+        # Using OOBtrees to allow history ids of any type. The type
         # of the history ids higly depends on the unique id tool which
         # we isn't under our control.
-        self._storage = OOBTree()
+        self._shards = tuple([OOBTree() for i in range(shards)])
+
+    def _getTree(self, history_id):
+        """Returns the tree the history is stored in
+        """
+        if self._shards is None:
+            return self._storage
+        return self._shards[getShard(history_id, len(self._shards))]
 
     def isRegistered(self, history_id):
         """Returns True if a History With the Given History id Exists
         """
-        return history_id in self._storage
+        return history_id in self._getTree(history_id)
 
     def getHistory(self, history_id, autoAdd=False):
         """Returns the History Object of the Given ``history_id``.
@@ -770,10 +1607,45 @@ class ShadowStorage(Persistent):
         Returns None if ``autoAdd`` is False and the history
         does not exist. Else prepares and returns an empty history.
         """
+        tree = self._getTree(history_id)
         # Create a new history if there isn't one yet
-        if autoAdd and not self.isRegistered(history_id):
-            self._storage[history_id] = ShadowHistory()
-        return self._storage.get(history_id, None)
+        if autoAdd and history_id not in tree:
+            tree[history_id] = ShadowHistory()
+        return tree.get(history_id, None)
+
+    def getHistoryIds(self, start=None):
+        """Iterates over the ids of all histories in ascending order
+
+        If ``start`` is given only the ids greater than ``start`` are
+        returned (used as cursor by jobs processing all histories).
+        """
+        if self._shards is None:
+            trees = (self._storage, )
+        else:
+            trees = self._shards
+        if start is None:
+            keys = [tree.keys() for tree in trees]
+        else:
+            keys = [tree.keys(min=start, excludemin=True) for tree in trees]
+        if len(keys) == 1:
+            return iter(keys[0])
+        # the shards are sorted each
+        return heapq.merge(*keys)
+
+    def shard(self, shards=SHADOW_STORAGE_SHARDS):
+        """Spreads the histories of an older shadow storage over shards
+
+        Returns the number of moved histories.
+        """
+        if self._shards is not None:
+            return 0
+        self._shards = tuple([OOBTree() for i in range(shards)])
+        nbrOfHistories = 0
+        for history_id, history in self._storage.items():
+            self._getTree(history_id)[history_id] = history
+            nbrOfHistories += 1
+        del self._storage
+        return nbrOfHistories
 
 InitializeClass(ShadowStorage)
 
@@ -783,6 +1655,17 @@ class ShadowHistory(Persistent):
     """
     security = ClassSecurityInfo()
 
+    # portal type of the youngest version and if the item was deleted
+    portal_type = ''
+    deleted = False
+
+    # number of not purged versions (histories of older storages keep
+    # the ids of the not purged versions in a list and don't count them)
+    _availableLength = None
+
+    # ids of the purged versions (``None`` in histories of older storages)
+    _purged = None
+
     def __init__(self):
         # Using a IOBtree as we know the selectors are integers.
         # The full history contains shadow data for every saved version.
@@ -790,13 +1673,37 @@ class ShadowHistory(Persistent):
         self._full = IOBTree()
         self.nextVersionId = 0
 
-        # Indexes to the full histories versions
-        self._available = []
+        # Indexes to the full histories versions. A tree set is persisted
+        # separately, appending and purging from the front only touch
+        # the first or last bucket.
+        self._available = IITreeSet()
+        self._availableLength = 0
+        self._purged = IITreeSet()
 
         # aproximative size of the history
         self._approxSize = 0
         self._sizeInaccurate = False
 
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        # Concurrent changes of different attributes are merged. An
+        # attribute changed by both transactions conflicts, so two saves
+        # (or purges) of the same history always conflict on
+        # ``nextVersionId`` (or the length). That's exactly what's desired.
+        resolved = dict(newState)
+        for name in set(oldState) | set(savedState) | set(newState):
+            old = oldState.get(name, _marker)
+            saved = savedState.get(name, _marker)
+            new = newState.get(name, _marker)
+            if saved == old:
+                continue
+            if new != old:
+                raise ConflictError
+            if saved is _marker:
+                del resolved[name]
+            else:
+                resolved[name] = saved
+        return resolved
+
     def save(self, data):
         """Saves data in the history
 
@@ -810,7 +1717,12 @@ class ShadowHistory(Persistent):
             del data['referenced_data']
         self._full[version_id] = deepCopy(data)
         self._full[version_id]['referenced_data'] = referenced
-        self._available.append(version_id)
+        self.migrateAvailable()
+        self._available.insert(version_id)
+        self._availableLength += 1
+        portal_type = data.get('portal_type', None)
+        if portal_type and portal_type != self.portal_type:
+            self.portal_type = portal_type
         # Provokes a write conflict if two saves happen the same
         # time. That's exactly what's desired.
         self.nextVersionId += 1
@@ -841,13 +1753,12 @@ class ShadowHistory(Persistent):
     def purge(self, selector, data, countPurged):
         """Purge selected version from the history
         """
-        # find the position to purge
-        version_pos = self._getVersionPos(selector, countPurged)
-        version_id = self._available[version_pos]
+        # find the version to purge
+        version_id = self.getVersionId(selector, countPurged)
 
         # update the histories size
-        sys_metadata = self._full[version_id]["metadata"]["sys_metadata"]
-        size = sys_metadata.get("approxSize", None)
+        metadata = self._full[version_id].get("metadata", None) or {}
+        size = metadata.get("sys_metadata", {}).get("approxSize", None)
         if size is None:
             self._sizeInaccurate = True
         else:
@@ -856,15 +1767,38 @@ class ShadowHistory(Persistent):
                 self._approxSize = 0
                 self._sizeInaccurate = True
 
-        # update the metadata
-        self._full[version_id]["metadata"] = deepCopy(data)
+        # update the metadata and purge the referenced data (reassign the
+        # record as the change wouldn't be noticed in a separate bucket)
+        shadowInfo = self._full[version_id]
+        shadowInfo["metadata"] = deepCopy(data)
+        shadowInfo.pop("referenced_data", None)
+        shadowInfo.pop("modified", None)
+        self._full[version_id] = shadowInfo
         # purge the reference
-        del self._available[version_pos]
-        try:
-            del self._full[version_id]["referenced_data"]
-            self._full._p_changed = True
-        except KeyError:
-            pass
+        self.migrateAvailable()
+        self._available.remove(version_id)
+        self._availableLength -= 1
+        self._purged.insert(version_id)
+
+    def getLastAvailable(self):
+        """Returns the id of the youngest not purged version
+
+        Returns ``None`` if there isn't any.
+        """
+        available = self._getAvailable()
+        if not available:
+            return None
+        return available.maxKey()
+
+    def getPreviousAvailable(self, version_id):
+        """Returns the id of the next older not purged version
+
+        Returns ``None`` if there isn't any.
+        """
+        available = self._getAvailable()
+        if not available or version_id <= available.minKey():
+            return None
+        return available.maxKey(version_id - 1)
 
     security.declareProtected(AccessPreviousVersions, 'getLength')
     def getLength(self, countPurged):
@@ -872,8 +1806,10 @@ class ShadowHistory(Persistent):
         """
         if countPurged:
             return self.nextVersionId
-        else:
+        elif self._availableLength is None:
             return len(self._available)
+        else:
+            return self._availableLength
 
     def __len__(self):
         # Policy: The length is the entire length, including purged
@@ -902,7 +1838,12 @@ class ShadowHistory(Persistent):
         length = self.getLength(countPurged)
         # checking for ``None`` selector (youngest version)
         if selector is None:
-            return length - 1
+            if countPurged:
+                return length - 1
+            # the youngest versions may be purged
+            if not length:
+                return None
+            return self._getAvailable().maxKey()
         # checking if positive selector tries to look into future
         if selector >= length:
             return None
@@ -918,34 +1859,331 @@ class ShadowHistory(Persistent):
             return selector
         else:
             # selector is a positional selector
-            return self._available[selector]
+            available = self._getAvailable()
+            first = available.minKey()
+            if available.maxKey() - first + 1 == length:
+                # no gaps: usually only the oldest versions got purged
+                return first + selector
+            if self._purged is None:
+                # not migrated yet
+                return available.keys()[selector]
+            # skip the purged versions up to the selected one, only the
+            # gaps are visited
+            version_id = first + selector
+            for purged_id in self._purged.keys(first):
+                if purged_id > version_id:
+                    break
+                version_id += 1
+            return version_id
+
+    def _getAvailable(self):
+        """Returns the tree set of the not purged versions ids
+        """
+        available = self._available
+        if isinstance(available, list):
+            # not migrated yet: don't provoke a write when reading
+            available = IITreeSet(available)
+        return available
 
-    def _getVersionPos(self, selector, countPurged):
-        """Returns the Position in the Version History
+    def migrateAvailable(self):
+        """Converts the list of not purged versions of older storages
 
-        The position returned does not count purged versions.
+        Also collects the ids of the purged versions. Returns ``True`` if
+        the history was migrated.
         """
-        if not countPurged:
-            if selector is None:
-                # version counting starts with 0
-                selector = self.getLength(countPurged=False) - 1
-            return int(selector)
-
-        # Lets search from the end of the available list as it is more
-        # likely that a younger versions position has to be returned.
-        # Let's work on a copy to not trigger an unecessary ZODB store
-        # operations.
-        history = self._available[:]
-        history.reverse()
-        try:
-            selector = len(history) - 1 - history.index(selector)
-        except ValueError:
-            selector = None
-        return selector
+        migrated = False
+        if isinstance(self._available, list):
+            self._availableLength = len(self._available)
+            self._available = IITreeSet(self._available)
+            migrated = True
+        if self._purged is None:
+            available = self._available
+            self._purged = IITreeSet([version_id for version_id
+                                      in xrange(self.nextVersionId)
+                                      if version_id not in available])
+            migrated = True
+        return migrated
 
 InitializeClass(ShadowHistory)
 
 
+def serialize(obj):
+    """Pickles the object and returns a ``SerializedPayload``
+
+    Objects already stored in the ZODB and blobs aren't serialized but
+    kept as references. The ZODB has to know about them (e.g. to not
+    pack them away).
+    """
+    refs = []
+
+    def persistent_id(obj):
+        if isinstance(obj, Blob) \
+           or getattr(obj, '_p_jar', None) is not None:
+            refs.append(obj)
+            return str(len(refs) - 1)
+        return None
+
+    stream = StringIO()
+    p = Pickler(stream, 1)
+    p.persistent_id = persistent_id
+    p.dump(obj)
+    return SerializedPayload(stream.getvalue(), refs)
+
+
+class SerializedPayload:
+    """Pickled State of an Object Saved to the Storage
+    """
+
+    # compression algorithm used (None: not compressed)
+    _compression = None
+
+    def __init__(self, data, refs=()):
+        self._data = data
+        self._refs = list(refs)
+
+    def compress(self, algorithm, minSize=0):
+        """Compresses the pickle if big enough and if it pays off
+        """
+        if self._compression is not None or len(self._data) < minSize:
+            return
+        data = compress(self._data, algorithm)
+        if len(data) < len(self._data):
+            self._size = len(self._data)
+            self._data = data
+            self._compression = algorithm
+
+    def getSize(self):
+        """Returns the size of the pickle
+        """
+        if self._compression is None:
+            return len(self._data)
+        return self._size
+
+    def getStoredSize(self):
+        """Returns the size of the pickle as stored (maybe compressed)
+        """
+        return len(self._data)
+
+    def getData(self):
+        """Returns the pickle
+        """
+        if self._compression is None:
+            return self._data
+        return decompress(self._data, self._compression)
+
+    def load(self, data=None):
+        """Unpickles and returns the object
+
+        The pickle may be passed in (e.g. if reconstructed from a delta).
+        """
+        if data is None:
+            data = self.getData()
+        refs = self._refs
+        u = Unpickler(StringIO(data))
+        u.persistent_load = lambda pid: refs[int(pid)]
+        return u.load()
+
+
+# splits a pickle into tokens ending with a newline or a closing tag
+_deltaTokens = re.compile(r'[^\n>]*[\n>]|[^\n>]+').findall
+
+def makeDelta(data, base):
+    """Returns the operations rebuilding ``data`` from ``base``
+
+    The operations are a list of strings (inserted as is) and
+    ``(offset, length)`` tuples (copied from ``base``).
+    """
+    baseTokens = _deltaTokens(base)
+    dataTokens = _deltaTokens(data)
+    offsets = [0]
+    for token in baseTokens:
+        offsets.append(offsets[-1] + len(token))
+
+    ops = []
+    matcher = SequenceMatcher(None, baseTokens, dataTokens)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append((offsets[i1], offsets[i2] - offsets[i1]))
+        elif j1 != j2:
+            ops.append(''.join(dataTokens[j1:j2]))
+    return ops
+
+def applyDelta(ops, base):
+    """Rebuilds the data from ``base`` and the operations
+    """
+    return ''.join([isinstance(op, str) and op or base[op[0]:op[0]+op[1]]
+                    for op in ops])
+
+
+class DeltaPayload(SerializedPayload):
+    """Pickle Stored as Reverse Delta
+
+    Only the difference to the pickle of the next younger version
+    (the base) is stored. The storage rebuilds the pickle by following
+    the chain of bases up to a fully stored version.
+    """
+
+    def __init__(self, payload, base_version_id, base_data):
+        self._refs = payload._refs
+        self._base = base_version_id
+        self._size = payload.getSize()
+        self._delta = dumps(makeDelta(payload.getData(), base_data),
+                            HIGHEST_PROTOCOL)
+
+    def getSize(self):
+        """Returns the size of the pickle (not the size of the delta)
+        """
+        return self._size
+
+    def compress(self, algorithm, minSize=0):
+        # deltas are small already
+        pass
+
+    def getStoredSize(self):
+        """Returns the size of the delta
+        """
+        return len(self._delta)
+
+    def getBaseVersionId(self):
+        """Returns the ZVC version id of the base
+        """
+        return self._base
+
+    def getData(self):
+        raise StorageRetrieveError(
+            "The pickle of a delta stored version can only be rebuilt "
+            "by the storage.")
+
+    def applyTo(self, base_data):
+        """Returns the pickle rebuilt from the pickle of the base
+        """
+        return applyDelta(loads(self._delta), base_data)
+
+
+def getDigest(payload):
+    """Returns the content address of a serialized payload
+
+    Returns None if the payload references objects not stored in the
+    ZODB yet (e.g. newly cloned blobs). Such payloads can't be shared.
+    """
+    digest = sha256(payload.getData())
+    for ref in payload._refs:
+        oid = getattr(ref, '_p_oid', None)
+        if oid is None:
+            return None
+        digest.update(oid)
+    return digest.hexdigest()
+
+
+class PayloadReference:
+    """Reference to a Payload Stored in the Payload Store
+    """
+
+    def __init__(self, digest, size):
+        self._digest = digest
+        self._size = size
+
+    def getDigest(self):
+        return self._digest
+
+    def getSize(self):
+        """Returns the size of the pickle referenced
+        """
+        return self._size
+
+
+class SharedPayload(Persistent):
+    """Reference Counted Payload
+    """
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.refcount = 0
+
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        # a payload whose last reference got released is removed from the
+        # payload store, merging would leave it referenced but removed
+        if 0 in (oldState['refcount'], savedState['refcount'],
+                 newState['refcount']):
+            raise ConflictError
+        # concurrently added or released references add up
+        state = dict(newState)
+        state['refcount'] = savedState['refcount'] + newState['refcount'] \
+                            - oldState['refcount']
+        return state
+
+
+class PayloadStore(Persistent):
+    """Content Addressed Storage of Serialized Payloads
+
+    Identical payloads saved by any history are stored only once. The
+    payloads are reference counted and removed when the last version
+    referencing them got purged.
+    """
+
+    def __init__(self):
+        self._payloads = OOBTree()
+        # conflict free counters for the statistics
+        self._storedSize = Length()
+        self._referencedSize = Length()
+
+    def add(self, payload):
+        """Adds a reference to the payload storing it if not stored yet
+
+        Returns a ``PayloadReference`` or None if the payload can't be
+        shared.
+        """
+        digest = getDigest(payload)
+        if digest is None:
+            return None
+        size = payload.getSize()
+        shared = self._payloads.get(digest, None)
+        if shared is None:
+            shared = self._payloads[digest] = SharedPayload(payload)
+            self._storedSize.change(size)
+        shared.refcount += 1
+        self._referencedSize.change(size)
+        return PayloadReference(digest, size)
+
+    def get(self, digest):
+        """Returns the payload
+        """
+        return self._payloads[digest].payload
+
+    def release(self, digest):
+        """Removes a reference to the payload
+
+        The payload is removed if it isn't referenced anymore.
+        """
+        shared = self._payloads[digest]
+        size = shared.payload.getSize()
+        shared.refcount -= 1
+        self._referencedSize.change(-size)
+        if shared.refcount <= 0:
+            del self._payloads[digest]
+            self._storedSize.change(-size)
+
+    def getSizes(self):
+        """Returns the size of the stored and of the referenced payloads
+        """
+        return self._storedSize(), self._referencedSize()
+
+
+class CompressedData:
+    """Compressed String Stored as Referenced Data
+    """
+
+    def __init__(self, data, algorithm):
+        self._data = compress(data, algorithm)
+        self._algorithm = algorithm
+
+    def getStoredSize(self):
+        return len(self._data)
+
+    def getData(self):
+        return decompress(self._data, self._algorithm)
+
+
 class ZVCAwareWrapper(Persistent):
     """ZVC assumes the stored object has a getPhysicalPath method.
 
@@ -959,8 +2197,13 @@ class ZVCAwareWrapper(Persistent):
             self.__vc_info__ = vc_info
 
     def getWrappedObject(self):
+        if isinstance(self._object, SerializedPayload):
+            return self._object.load()
         return self._object
 
+    def isRemoved(self):
+        return isinstance(self._object, Removed)
+
     def getPhysicalPath(self):
         return self._physicalPath
 
@@ -20,7 +20,8 @@ class DiffView(BrowserView):
         if version=="current":
             return context
         else:
-            return self.repo_tool.retrieve(context, int(version)).object
+            return self.repo_tool.retrieve(context, int(version),
+                                           detached=True).object
 
 
     def versionName(self, version):
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+# This file is part of CMFEditions.
+#
+# CMFEditions is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# CMFEditions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CMFEditions; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#########################################################################
+"""Applying version control to all versionable contents of a site
+
+Turning on versioning for an existing site means saving a first version
+of every versionable content. ``BulkVersioningJob`` does this in
+committed batches and persists a checkpoint with every batch, so an
+interrupted job continues where it stopped when started again.
+
+The work can be split between several processes, every process (worker)
+handling a disjoint part of the paths with its own ZODB connection. Run
+it with the instance script, e.g. with two processes::
+
+  bin/instance run Products/CMFEditions/bulkversioning.py /plone \\
+      --workers 2 --worker 0
+  bin/instance run Products/CMFEditions/bulkversioning.py /plone \\
+      --workers 2 --worker 1
+"""
+
+import logging
+import sys
+import time
+from itertools import islice
+from optparse import OptionParser
+from zlib import crc32
+
+import transaction
+from ZODB.POSException import ConflictError
+from AccessControl import SpecialUsers
+from AccessControl.SecurityManagement import newSecurityManager
+from Testing.makerequest import makerequest
+from zope.component.hooks import setSite
+from Products.CMFCore.utils import getToolByName
+
+from Products.CMFEditions.Permissions import ApplyVersionControl
+from Products.CMFEditions.utilities import getUser
+
+logger = logging.getLogger('CMFEditions')
+
+
+class BulkVersioningJob(object):
+    """Saves a first version of all not yet versioned contents of a site
+    """
+
+    def __init__(self, portal, batchSize=100, worker=0, workers=1,
+                 comment='Initial revision', retries=3):
+        if not 0 <= worker < workers:
+            raise ValueError("worker must be between 0 and %s" % (workers-1))
+        self.portal = portal
+        self.batchSize = batchSize
+        self.worker = worker
+        self.workers = workers
+        self.comment = comment
+        self.retries = retries
+        self.key = '%s/%s' % (worker, workers)
+
+    def iterPaths(self, start=None):
+        """Iterates over the paths of the versionable contents in sorted
+        order (starting after the given path)
+
+        Only the paths handled by this worker are returned.
+        """
+        return self._iterPaths(self._getVersionableRids(), start)
+
+    def _getVersionableRids(self):
+        """Returns the record ids of the versionable contents
+        """
+        portal_repository = getToolByName(self.portal, 'portal_repository')
+        catalog = getToolByName(self.portal, 'portal_catalog')
+        types = portal_repository.getVersionableContentTypes()
+        if not types:
+            return None
+        return catalog._catalog.getIndex('portal_type')._apply_index(
+            {'portal_type': types})[0]
+
+    def _iterPaths(self, rids, start):
+        # the catalogs mapping of the paths to the record ids is sorted
+        # by path already
+        if not rids:
+            return
+        uids = getToolByName(self.portal, 'portal_catalog')._catalog.uids
+        if start is None:
+            items = uids.items()
+        else:
+            items = uids.items(start, excludemin=True)
+        for path, rid in items:
+            if rid not in rids:
+                continue
+            if self.workers > 1 and \
+               (crc32(path) & 0xffffffff) % self.workers != self.worker:
+                continue
+            yield path
+
+    def getPaths(self):
+        """Returns the sorted paths of the versionable contents
+
+        Only the paths handled by this worker are returned.
+        """
+        return list(self.iterPaths())
+
+    def getCheckpoint(self):
+        """Returns the checkpoint of this worker or None
+        """
+        portal_repository = getToolByName(self.portal, 'portal_repository')
+        checkpoints = portal_repository._getBulkCheckpoints()
+        if checkpoints is None:
+            return None
+        return checkpoints.get(self.key, None)
+
+    def reset(self):
+        """Removes the checkpoint to start from the beginning
+        """
+        portal_repository = getToolByName(self.portal, 'portal_repository')
+        checkpoints = portal_repository._getBulkCheckpoints()
+        if checkpoints is not None and self.key in checkpoints:
+            del checkpoints[self.key]
+            transaction.commit()
+
+    def run(self):
+        """Processes all paths after the checkpoint
+
+        The checkpoint is removed when all paths were processed. Returns
+        the number of saved and failed versions (including the ones of
+        the former runs).
+        """
+        checkpoint = self.getCheckpoint() or {}
+        path = checkpoint.get('path', None)
+        self.saved = checkpoint.get('saved', 0)
+        self.failed = checkpoint.get('failed', 0)
+        rids = self._getVersionableRids()
+        # counted for reporting the progress only
+        total = 0
+        for ignored in self._iterPaths(rids, path):
+            total += 1
+
+        done = 0
+        startTime = time.time()
+        while True:
+            # iterating again after every batch as the catalog may have
+            # changed in between
+            paths = list(islice(self._iterPaths(rids, path), self.batchSize))
+            if not paths:
+                break
+            self.processBatch(paths)
+            path = paths[-1]
+            done += len(paths)
+            self.report(done, max(done, total), startTime)
+
+        # the next run starts from the beginning
+        self.reset()
+        return self.saved, self.failed
+
+    def processBatch(self, paths):
+        """Saves the versions of a batch and commits the checkpoint
+        """
+        portal_repository = getToolByName(self.portal, 'portal_repository')
+        for attempt in range(self.retries + 1):
+            try:
+                results = portal_repository._saveMany(
+                    self._getUnversioned(paths), self.comment, {},
+                    autoapply=True, permission=ApplyVersionControl)
+                saved = failed = 0
+                for obj, error in results:
+                    if error is None:
+                        saved += 1
+                        continue
+                    failed += 1
+                    logger.warning("CMFEditions bulk versioning: saving a "
+                                   "version of '%s' failed: %r"
+                                   % ('/'.join(obj.getPhysicalPath()), error))
+                checkpoints = portal_repository._getBulkCheckpoints(
+                    autoAdd=True)
+                checkpoints[self.key] = {
+                    'path': paths[-1],
+                    'saved': self.saved + saved,
+                    'failed': self.failed + failed,
+                    'timestamp': time.time(),
+                }
+                transaction.commit()
+            except ConflictError:
+                transaction.abort()
+                if attempt == self.retries:
+                    raise
+                continue
+            self.saved += saved
+            self.failed += failed
+            # don't let the cache grow with every batch
+            self.portal._p_jar.cacheGC()
+            return
+
+    def _getUnversioned(self, paths):
+        storage = getToolByName(self.portal, 'portal_historiesstorage')
+        hidhandler = getToolByName(self.portal, 'portal_historyidhandler')
+        objs = []
+        for path in paths:
+            obj = self.portal.unrestrictedTraverse(path, None)
+            if obj is None:
+                continue
+            history_id = hidhandler.queryUid(obj, None)
+            if history_id is not None and storage.isRegistered(history_id):
+                continue
+            objs.append(obj)
+        return objs
+
+    def report(self, done, total, startTime):
+        elapsed = time.time() - startTime
+        throughput = elapsed and done / elapsed or 0.0
+        eta = throughput and (total - done) / throughput or 0.0
+        logger.info("CMFEditions bulk versioning (worker %s): %s of %s "
+                    "contents processed, %.1f contents/s, ETA %s"
+                    % (self.key, done, total, throughput,
+                       time.strftime('%H:%M:%S', time.gmtime(eta))))
+
+
+def setupSite(app, portal_path, username=None):
+    """Prepares running a job from a script
+
+    Returns the portal with a request, set as site and the given user
+    (or the system user) logged in.
+    """
+    app = makerequest(app)
+    portal = app.unrestrictedTraverse(portal_path)
+    setSite(portal)
+    if username:
+        user = getUser(portal, username)
+        if user is None:
+            raise ValueError("user '%s' not found" % username)
+    else:
+        user = SpecialUsers.system
+    newSecurityManager(None, user)
+    return portal
+
+
+def main(app, args):
+    parser = OptionParser(usage="%prog portal_path [options]")
+    parser.add_option('--batch-size', type='int', default=100)
+    parser.add_option('--workers', type='int', default=1,
+                      help="number of processes sharing the work")
+    parser.add_option('--worker', type='int', default=0,
+                      help="number of this process (0 to workers-1)")
+    parser.add_option('--user', default=None,
+                      help="user saving the versions (default: system)")
+    parser.add_option('--comment', default='Initial revision')
+    parser.add_option('--reset', action='store_true', default=False,
+                      help="ignore the checkpoint of a former run")
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("the path of the portal is required")
+
+    portal = setupSite(app, args[0], options.user)
+    job = BulkVersioningJob(portal, options.batch_size, options.worker,
+                            options.workers, options.comment)
+    if options.reset:
+        job.reset()
+    saved, failed = job.run()
+    print "Saved %s versions, %s failed." % (saved, failed)
+
+if __name__ == '__main__':
+    # ``app`` is provided by ``bin/instance run``
+    main(app, sys.argv[1:])
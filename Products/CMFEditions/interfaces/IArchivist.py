@@ -100,6 +100,15 @@ class IArchivist(Interface):
         E.g. preserve=('family_name', 'nick_name', 'real_name')
         """
 
+    def retrieveMany(obj=None, history_id=None, selectors=(), preserve=()):
+        """Retrieves many former states of an object.
+
+        Does the same as ``retrieve`` for every selector but looks up
+        the tools and the history only once.
+
+        Returns a list of 'IVersionData' objects.
+        """
+
     def getHistory(obj=None, history_id=None, preserve=()):
         """Return the history of an object.
 
@@ -131,6 +140,29 @@ class IArchivist(Interface):
         """Returns the versioning metadata history.
         """
 
+    def getFingerprint(obj, callbacks=None):
+        """Returns a digest of the versionable state of the working copy.
+
+        The childrens handled as references aren't part of the state.
+        Returns None if the state can't be fingerprinted (e.g. because of
+        uncommitted blob data).
+
+        The fingerprint is stored in the system metadata of every saved
+        version (``fingerprint``). ``callbacks`` are the clone modifiers
+        hooks of the object if looked up already.
+        """
+
+    def isUnchanged(obj=None, history_id=None, callbacks=None,
+                    fingerprint=None):
+        """Check if the working copy changed since its last version.
+
+        Returns True only if the fingerprint of the working copy is equal
+        to the one stored with the most recent version. ``callbacks`` are
+        the clone modifiers hooks of the object if looked up already,
+        ``fingerprint`` the fingerprint of the working copy if taken
+        already (e.g. by ``prepare``).
+        """
+
 
 class IPurgeSupport(Interface):
     """Repository Purge Support
@@ -223,6 +255,14 @@ class IPurgeSupport(Interface):
         (see interface documentation for details).
         """
 
+    def retrieveMany(obj=None, history_id=None, selectors=(), preserve=(),
+                     countPurged=True):
+        """Retrieves many former states of an object.
+
+        See ``retrieve`` for the arguments. Returns a list of
+        'IVersionData' objects.
+        """
+
     def getHistory(obj=None, history_id=None, preserve=(), countPurged=True):
         """Return the history of an object.
 
@@ -219,6 +219,13 @@ class IConditionalModifier(Interface):
         condition evaluates to a true value.
         """
 
+    def dependsOnTypeOnly():
+        """Returns True if ``isApplicable`` only depends on the type.
+
+        The result of ``isApplicable`` may then be reused for all objects
+        of the same portal type and meta type.
+        """
+
     def isEnabled():
         """Returns the enable status.
         """
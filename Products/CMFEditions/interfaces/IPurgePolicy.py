@@ -51,6 +51,14 @@ class IPurgePolicy(Interface):
         implementation. Return ``False`` if the object has to be discared.
         """
 
+    def getVersionsToPurge(history_id, room=0):
+        """Return the versions the policy wants to be purged
+
+        The selectors returned don't count purged versions. ``room`` is
+        the number of versions about to be saved. Used to enforce the
+        policy on histories not saved anymore (e.g. by a sweeper job).
+        """
+
     def retrieveSubstitute(history_id, selector, default=None):
         """Return a selected version of an object or a substitute
 
@@ -83,6 +83,15 @@ class ICopyModifyMergeRepository(Interface):
         'metadata' must be a dictionary.
         """
 
+    def saveMany(objs, comment='', metadata={}):
+        """Saves the current versions of many contents (e.g. on imports).
+
+        All versions share the same comment, metadata and timestamp.
+        Returns a list of '(obj, error)' tuples in the order of 'objs',
+        'error' being None if the save succeeded. Failing saves are
+        rolled back without aborting the other saves.
+        """
+
     def revert(obj, selector=None):
         """Reverts to a former version of the content by replacing the working
         copy.
@@ -99,6 +108,16 @@ class ICopyModifyMergeRepository(Interface):
         copy in any way.
         """
 
+    def retrieveMany(obj, selectors, preserve=()):
+        """Returns many former versions of a content without replacing the
+        working copy.
+
+        Does the same as ``retrieve`` for every selector but with the
+        fixed costs (tool lookups, savepoint) spent only once.
+
+        Returns a list of ``IVersionData`` objects.
+        """
+
     def restore(history_id, selector, container, new_id=None):
         """Restore a Specific version of an Object into a Container
 
@@ -199,7 +218,8 @@ class IPurgeSupport(Interface):
         (see interface documentation for details).
         """
 
-    def retrieve(obj, selector=None, preserve=(), countPurged=True):
+    def retrieve(obj, selector=None, preserve=(), countPurged=True,
+                 detached=False):
         """Returns a former version of a content without replacing the working
         copy.
 
@@ -208,6 +228,19 @@ class IPurgeSupport(Interface):
 
         Also counts purged versions if ``True`` is passed to ``countPurged``
         (see interface documentation for details).
+
+        If ``True`` is passed to ``detached`` the version is built without
+        temporarily changing the working copy and without a savepoint. Use
+        it to view former versions (also on read only clients).
+        """
+
+    def retrieveMany(obj, selectors, preserve=(), countPurged=True,
+                     detached=False):
+        """Returns many former versions of a content without replacing the
+        working copy.
+
+        See ``retrieve`` for the arguments. Returns a list of
+        ``IVersionData`` objects.
         """
 
     def restore(history_id, selector, container, new_id=None,
@@ -233,7 +266,8 @@ class IPurgeSupport(Interface):
         (see interface documentation for details).
         """
 
-    def getHistory(obj, oldestFirst=False, preserve=(), countPurged=True):
+    def getHistory(obj, oldestFirst=False, preserve=(), countPurged=True,
+                   detached=False):
         """Returns the history of a content.
 
         Return the oldest version first  when ``oldestFirst`` set to
@@ -243,6 +277,55 @@ class IPurgeSupport(Interface):
 
         Also counts purged versions if ``True`` is passed to ``countPurged``
         (see interface documentation for details).
+
+        The versions are retrieved detached if ``True`` is passed to
+        ``detached`` (see ``retrieve``).
+        """
+
+
+class IDeferredSaveSupport(Interface):
+    """Saving versions after the editing transaction committed.
+    """
+
+    def setDeferredSaving(deferred):
+        """Sets the deferred saving mode.
+
+        If True saves of the edit event subscribers are queued and done
+        by a worker thread after the transaction committed.
+        The default value is False.
+        """
+
+    def isDeferredSaving():
+        """Returns True if the deferred saving mode is on.
+        """
+
+    def setCoalescedSaving(coalesced):
+        """Sets the coalesced saving mode.
+
+        If True the edit event subscribers save a version only once per
+        object and transaction when the transaction gets committed. The
+        history read later in the same transaction doesn't contain the
+        version yet.
+        The default value is False.
+        """
+
+    def isCoalescedSaving():
+        """Returns True if the coalesced saving mode is on.
+        """
+
+    def enqueueSave(obj, comment=''):
+        """Queues the save of a new version of the working copy.
+
+        Several saves of the same object queued before the version is
+        saved are coalesced to one version with the comments merged.
+        """
+
+    def getSaveQueueStatistics():
+        """Returns the metrics of the save queue as dictionary.
+
+        ``depth`` is the number of queued saves and ``lag`` the seconds
+        the oldest queued save is waiting. The metrics of the worker
+        running in this process are added if one runs.
         """
 
 
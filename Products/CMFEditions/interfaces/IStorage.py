@@ -93,6 +93,16 @@ class IStorage(Interface):
         Returns a 'IVersionData' object.
         """
 
+    def retrieveMany(history_id, selectors):
+        """Returns the selected versions of an object, which has the given
+           history id.
+
+        Does the same as ``retrieve`` for every selector but looks up
+        the history only once.
+
+        Returns a list of 'IVersionData' objects.
+        """
+
     def getHistory(history_id):
         """Return the history of an object by the given history id.
 
@@ -110,14 +120,30 @@ class IStorage(Interface):
         If selected is None, the most recent version (HEAD) is taken.
         """
 
+    def getMetadata(history_id, selector=None):
+        """Returns the metadata of the selected version of the object
+           which has the given history id.
+
+        Only the metadata is looked up, the object isn't rebuilt.
+        If selected is None, the most recent version (HEAD) is taken.
+        """
+
+    def getReferencedData(history_id, selector=None):
+        """Returns the referenced data of the selected version of the
+           object which has the given history id.
+
+        Only the referenced data is looked up, the object isn't rebuilt.
+        If selected is None, the most recent version (HEAD) is taken.
+        """
+
 
 class IPurgeSupport(Interface):
     """Storage Purge Support
 
     Purging a version from the storage removes that version irrevocably.
 
-    Adds ``purge`` and extends the signature of ``retrieve``, ``getHistory``
-    and ``getModificationDate``. The defaults of the extended methods
+    Adds ``purge`` and extends the signature of ``retrieve``, ``getHistory``,
+    ``getModificationDate``, ``getMetadata`` and ``getReferencedData``. The defaults of the extended methods
     mimique the standard behaviour of the original methods.
 
     With the introduction of purging two selection scheme exist for
@@ -159,6 +185,17 @@ class IPurgeSupport(Interface):
         the purging.
         """
 
+    def purgeMany(history_id, selectors, metadata={}, countPurged=True):
+        """Purge many Versions from a Resources History in one pass
+
+        All selectors are resolved before the first version gets purged,
+        so they are interpreted the same way independent of their order
+        (also if ``countPurged`` is ``False``). The same metadata is
+        stored for all purged versions.
+
+        Returns the number of purged versions.
+        """
+
     def retrieve(history_id, selector, countPurged=True, substitute=True):
         """Return the Version of the Resource with the given History Id
 
@@ -172,6 +209,15 @@ class IPurgeSupport(Interface):
         Return a ``IVersionData`` object.
         """
 
+    def retrieveMany(history_id, selectors, countPurged=True,
+                     substitute=True):
+        """Return the Versions of the Resource with the given History Id
+
+        See ``retrieve`` for the arguments.
+
+        Return a list of ``IVersionData`` objects.
+        """
+
     def getHistory(history_id, countPurged=True, substitute=True):
         """Return the history of an object by the given history id.
 
@@ -198,6 +244,26 @@ class IPurgeSupport(Interface):
         If selected is None, the most recent version (HEAD) is taken.
         """
 
+    def getMetadata(history_id, selector=None, countPurged=True):
+        """Returns the metadata of the selected version of the object
+           which has the given history id.
+
+        If ``countPurged`` is ``True`` purged versions are returned also.
+        If ``False`` purged versions aren't returned.
+
+        If selected is None, the most recent version (HEAD) is taken.
+        """
+
+    def getReferencedData(history_id, selector=None, countPurged=True):
+        """Returns the referenced data of the selected version of the
+           object which has the given history id.
+
+        If ``countPurged`` is ``True`` purged versions are returned also.
+        If ``False`` purged versions aren't returned.
+
+        If selected is None, the most recent version (HEAD) is taken.
+        """
+
 
 class IHistory(Interface):
     """Iterable version history.
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+# This file is part of CMFEditions.
+#
+# CMFEditions is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# CMFEditions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CMFEditions; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#########################################################################
+"""Enforcing the purge policy on all histories
+
+The purge policy is applied when a content is saved only. Histories of
+contents not edited anymore (including the ones of deleted contents)
+keep their versions. ``RetentionSweeper`` applies the policy to all
+histories of the storage in committed batches. The cursor is persisted
+with every batch, so a run stopped (e.g. after the time budget) continues
+where it stopped the next time. Run it from cron with the instance
+script, e.g. with a budget of ten minutes::
+
+  bin/instance run Products/CMFEditions/retentionsweeper.py /plone \\
+      --time-budget 600
+
+A dry run (``--dry-run``) reports the versions and bytes that would be
+reclaimed without purging anything.
+"""
+
+import logging
+import sys
+import time
+from itertools import islice
+from optparse import OptionParser
+
+import transaction
+from ZODB.POSException import ConflictError
+from Products.CMFCore.utils import getToolByName
+
+from Products.CMFEditions.bulkversioning import setupSite
+
+logger = logging.getLogger('CMFEditions')
+
+PURGE_COMMENT = "purged by the retention sweeper"
+
+
+class RetentionSweeper(object):
+    """Applies the purge policy to all histories of the storage
+    """
+
+    def __init__(self, portal, batchSize=100, timeBudget=None, dryRun=False,
+                 retries=3):
+        self.portal = portal
+        self.batchSize = batchSize
+        self.timeBudget = timeBudget
+        self.dryRun = dryRun
+        self.retries = retries
+
+    def run(self):
+        """Sweeps the histories after the cursor until all are processed
+        or the time budget is used up
+
+        Returns a report with the number of processed histories, the
+        number of purged versions and their approximate size (the ones
+        that would be purged on dry runs) and if the sweep finished.
+        """
+        report = {'histories': 0, 'versions': 0, 'bytes': 0,
+                  'finished': False, 'dryRun': self.dryRun}
+        policy = getToolByName(self.portal, 'portal_purgepolicy', None)
+        if getattr(policy, 'getVersionsToPurge', None) is None:
+            logger.warning("CMFEditions retention sweeper: no purge policy "
+                           "supporting sweeping installed")
+            report['finished'] = True
+            return report
+        storage = getToolByName(self.portal, 'portal_historiesstorage')
+
+        startTime = time.time()
+        cursor = policy._sweep_cursor
+        while True:
+            historyIds = list(islice(storage.getHistoryIds(cursor),
+                                     self.batchSize))
+            if not historyIds:
+                report['finished'] = True
+                break
+            versions, size = self.processBatch(policy, storage, historyIds)
+            report['histories'] += len(historyIds)
+            report['versions'] += versions
+            report['bytes'] += size
+            cursor = historyIds[-1]
+            if self.timeBudget is not None and \
+               time.time() - startTime >= self.timeBudget:
+                break
+
+        # the next sweep starts from the beginning
+        if report['finished'] and not self.dryRun and \
+           policy._sweep_cursor is not None:
+            policy._sweep_cursor = None
+            transaction.commit()
+
+        logger.info("CMFEditions retention sweeper: %s%s versions of %s "
+                    "histories purged, approx. %s bytes reclaimed in %.2f "
+                    "seconds (%s)" % (self.dryRun and "dry run: " or "",
+                    report['versions'], report['histories'], report['bytes'],
+                    time.time() - startTime,
+                    report['finished'] and "finished" or "to be continued"))
+        return report
+
+    def processBatch(self, policy, storage, historyIds):
+        """Applies the policy to the histories and commits the cursor
+
+        Dry runs roll back to a savepoint taken before the batch instead.
+        Returns the number of purged versions and their approximate size.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                if self.dryRun:
+                    savepoint = transaction.savepoint(optimistic=True)
+                versions = size = 0
+                for history_id in historyIds:
+                    selectors = policy.getVersionsToPurge(history_id)
+                    if not selectors:
+                        continue
+                    size += self._getSize(storage, history_id, selectors)
+                    if self.dryRun:
+                        versions += len(selectors)
+                        continue
+                    metadata = {'sys_metadata': {'comment': PURGE_COMMENT}}
+                    versions += storage.purgeMany(history_id, selectors,
+                                                  metadata=metadata,
+                                                  countPurged=False)
+                if self.dryRun:
+                    savepoint.rollback()
+                else:
+                    policy._sweep_cursor = historyIds[-1]
+                    transaction.commit()
+            except ConflictError:
+                transaction.abort()
+                if attempt == self.retries:
+                    raise
+                continue
+            # don't let the cache grow with every batch
+            self.portal._p_jar.cacheGC()
+            return versions, size
+
+    def _getSize(self, storage, history_id, selectors):
+        size = 0
+        for selector in selectors:
+            metadata = storage.getMetadata(history_id, selector,
+                                           countPurged=False)
+            size += metadata.get('sys_metadata', {}).get('approxSize', 0)
+        return size
+
+
+def main(app, args):
+    parser = OptionParser(usage="%prog portal_path [options]")
+    parser.add_option('--batch-size', type='int', default=100)
+    parser.add_option('--time-budget', type='float', default=None,
+                      help="seconds after which to stop (continued on "
+                           "the next run)")
+    parser.add_option('--dry-run', action='store_true', default=False,
+                      help="only report what would be purged")
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("the path of the portal is required")
+
+    portal = setupSite(app, args[0])
+    sweeper = RetentionSweeper(portal, options.batch_size,
+                               options.time_budget, options.dry_run)
+    report = sweeper.run()
+    print "%s%s versions of %s histories, approx. %s bytes%s." % (
+        options.dry_run and "Would purge " or "Purged ",
+        report['versions'], report['histories'], report['bytes'],
+        not report['finished'] and " (not finished yet)" or "")
+
+if __name__ == '__main__':
+    # ``app`` is provided by ``bin/instance run``
+    main(app, sys.argv[1:])
@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+# This file is part of CMFEditions.
+#
+# CMFEditions is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# CMFEditions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CMFEditions; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#########################################################################
+"""Deferred saving of versions
+
+In coalesced saving mode the edit event subscribers save a version only
+once per object and transaction: the saves are collected and done when
+the transaction gets committed.
+
+In deferred saving mode the subscribers don't save a version in the
+editors request at all. They queue the save in a persistent queue of the
+repository tool instead. After the transaction committed a worker thread
+with its own ZODB connection saves the queued versions.
+"""
+
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from itertools import islice
+from StringIO import StringIO
+
+import transaction
+from Persistence import Persistent
+from BTrees.OOBTree import OOBTree, OOTreeSet
+from BTrees.Length import Length
+from ZODB.POSException import ConflictError
+from Acquisition import aq_base
+from AccessControl import SpecialUsers
+from AccessControl.SecurityManagement import getSecurityManager
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import setSecurityManager
+from ZPublisher.BaseRequest import RequestContainer
+from ZPublisher.HTTPRequest import HTTPRequest
+from ZPublisher.HTTPResponse import HTTPResponse
+from zope.component.hooks import getSite, setSite
+from Products.CMFCore.utils import getToolByName
+
+from Products.CMFEditions.utilities import dereference, isObjectChanged
+from Products.CMFEditions.utilities import maybeSaveVersion, mergeComments
+from Products.CMFEditions.utilities import getUser
+from Products.CMFEditions.interfaces.IModifier import FileTooLargeToVersionError
+
+logger = logging.getLogger('CMFEditions')
+
+
+class SaveQueue(Persistent):
+    """Persistent queue of the versions to save
+
+    The entries are keyed by the physical path of the object. Several
+    saves of the same object queued before the worker processed them
+    are coalesced to one entry accumulating the comments.
+    """
+
+    def __init__(self):
+        self._entries = OOBTree()
+        # (time queued first, path) of the entries ordered by age
+        self._queued = OOTreeSet()
+        self._length = Length()
+
+    def __len__(self):
+        return self._length()
+
+    def enqueue(self, path, history_id, comment, principal, timestamp=None):
+        """Queues a save of the object with the given path
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        entry = self._entries.get(path, None)
+        if entry is None:
+            self._length.change(1)
+            entry = {'comments': (), 'queued': timestamp}
+            self._queued.insert((timestamp, path))
+        comments = entry['comments']
+        if comment and comment not in comments:
+            comments += (comment, )
+        self._entries[path] = {
+            'history_id': history_id or entry.get('history_id', None),
+            'comments': comments,
+            'principal': principal,
+            # the version is saved with the time of the last edit
+            'timestamp': timestamp,
+            # the time the object was queued first (for the lag)
+            'queued': entry['queued'],
+        }
+
+    def get(self, path):
+        """Returns the entry of the given path or None
+        """
+        return self._entries.get(path, None)
+
+    def remove(self, path):
+        """Removes the entry of the given path
+        """
+        entry = self._entries.get(path, None)
+        if entry is not None:
+            del self._entries[path]
+            self._queued.remove((entry['queued'], path))
+            self._length.change(-1)
+
+    def getPaths(self, maxItems=None):
+        """Returns the paths of (at most ``maxItems``) queued entries
+
+        The entry queued first comes first.
+        """
+        return [path for queued, path
+                in islice(self._queued.keys(), maxItems)]
+
+    def getLag(self, now=None):
+        """Returns the seconds the oldest entry is waiting already
+        """
+        if not self._queued:
+            return 0.0
+        if now is None:
+            now = time.time()
+        return max(0.0, now - self._queued.minKey()[0])
+
+
+def processEntry(portal, path):
+    """Saves the version queued for the object with the given path
+
+    The entry is removed from the queue. The version is saved as the
+    user having queued it. Returns ``True`` if a version was saved.
+    """
+    portal_repository = getToolByName(portal, 'portal_repository')
+    queue = portal_repository._getSaveQueue()
+    entry = queue is not None and queue.get(path) or None
+    if entry is None:
+        return False
+    queue.remove(path)
+
+    obj = portal.unrestrictedTraverse(path, None)
+    if obj is None and entry['history_id'] is not None:
+        # moved or renamed since queued
+        obj = dereference(history_id=entry['history_id'],
+                          zodb_hook=portal)[0]
+    if obj is None:
+        logger.warning("CMFEditions save queue: '%s' doesn't exist "
+                       "anymore, no version saved" % path)
+        return False
+
+    user = getUser(portal, entry['principal'])
+    if user is None:
+        logger.warning("CMFEditions save queue: user '%s' not found, "
+                       "saving as system user" % entry['principal'])
+        user = SpecialUsers.system
+    oldSecurityManager = getSecurityManager()
+    newSecurityManager(None, user)
+    try:
+        # a version may have been saved explicitly in the meantime
+        if not isObjectChanged(obj):
+            return False
+        portal_repository._saveQueued(obj, mergeComments(entry['comments']),
+                                      entry['timestamp'])
+    finally:
+        setSecurityManager(oldSecurityManager)
+    return True
+
+
+class SaveQueueWorker(threading.Thread):
+    """Drains the save queue of a portal
+
+    Every queued save is done in a separate transaction which is retried
+    on conflicts. Entries failing otherwise are logged and dropped to not
+    block the queue.
+    """
+
+    def __init__(self, db, portal_path, interval=60.0, batchSize=20,
+                 retries=3):
+        threading.Thread.__init__(self, name='CMFEditions save queue '
+                                             'worker %s' % '/'.join(portal_path))
+        self.setDaemon(True)
+        self.db = db
+        self.portal_path = portal_path
+        self.interval = interval
+        self.batchSize = batchSize
+        self.retries = retries
+        self._wakeup = threading.Event()
+        self._stopped = False
+        # metrics
+        self.saved = 0
+        self.failed = 0
+        self.conflicts = 0
+        self.lastError = None
+        self.lastRun = None
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def getStatistics(self):
+        """Returns the metrics of the worker
+        """
+        return {
+            'saved': self.saved,
+            'failed': self.failed,
+            'conflicts': self.conflicts,
+            'lastError': self.lastError,
+            'lastRun': self.lastRun,
+        }
+
+    def run(self):
+        while not self._stopped:
+            # also polling as wakeups of other ZEO clients aren't noticed
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                while not self._stopped and self.processBatch():
+                    pass
+            except Exception:
+                transaction.abort()
+                logger.exception("CMFEditions save queue: worker error")
+            self.lastRun = time.time()
+
+    def processBatch(self):
+        """Processes a batch of queued saves
+
+        Returns ``True`` if entries were processed and more may be queued.
+        """
+        connection = self.db.open()
+        site = getSite()
+        try:
+            app = _withRequest(connection.root()['Application'])
+            portal = app.unrestrictedTraverse(self.portal_path)
+            setSite(portal)
+            portal_repository = getToolByName(portal, 'portal_repository')
+            queue = portal_repository._getSaveQueue()
+            if queue is None:
+                return False
+            paths = queue.getPaths(self.batchSize)
+            transaction.abort()
+            processed = 0
+            for path in paths:
+                if self._stopped:
+                    break
+                processed += self.processPath(portal, path)
+            return processed > 0 and len(paths) == self.batchSize
+        finally:
+            transaction.abort()
+            setSite(site)
+            connection.close()
+
+    def processPath(self, portal, path):
+        """Saves the version queued for the path in its own transaction
+
+        Returns ``False`` if the entry was left in the queue.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                transaction.begin()
+                saved = processEntry(portal, path)
+                transaction.get().note("CMFEditions: saved queued version "
+                                       "of %s" % path)
+                transaction.commit()
+                self.saved += saved
+                return True
+            except ConflictError:
+                # the entry is left in the queue if retrying doesn't help
+                transaction.abort()
+                self.conflicts += 1
+            except Exception, e:
+                transaction.abort()
+                self.failed += 1
+                self.lastError = "%s: %s" % (path, e)
+                logger.exception("CMFEditions save queue: saving a version "
+                                 "of '%s' failed, dropping it" % path)
+                self._drop(portal, path)
+                return True
+        return False
+
+    def _drop(self, portal, path):
+        try:
+            transaction.begin()
+            getToolByName(portal, 'portal_repository') \
+                ._getSaveQueue().remove(path)
+            transaction.commit()
+        except ConflictError:
+            transaction.abort()
+
+
+def _withRequest(app):
+    """Wraps the application into a request as the publisher does
+
+    Tools and content acquire ``REQUEST`` also outside of a request.
+    """
+    response = HTTPResponse(stdout=StringIO())
+    environ = {
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'REQUEST_METHOD': 'GET',
+    }
+    request = HTTPRequest(StringIO(), environ, response)
+    request['PARENTS'] = [app]
+    return app.__of__(RequestContainer(REQUEST=request))
+
+
+_workers = {}
+_workersLock = threading.Lock()
+
+def getWorker(db, portal_path, autoStart=False):
+    """Returns the worker of the portal running in this process
+
+    Starts one if ``autoStart`` is ``True``. Returns None if no worker
+    runs and none was started.
+    """
+    key = (db.database_name, tuple(portal_path))
+    _workersLock.acquire()
+    try:
+        worker = _workers.get(key, None)
+        if (worker is None or not worker.isAlive()) and autoStart:
+            worker = _workers[key] = SaveQueueWorker(db, tuple(portal_path))
+            worker.start()
+        return worker
+    finally:
+        _workersLock.release()
+
+def wakeupWorker(status, db, portal_path):
+    """After commit hook waking (or starting) the worker of the portal
+    """
+    if status:
+        getWorker(db, portal_path, autoStart=True).wakeup()
+
+
+class _SaveCollector(object):
+    """Collects the saves of a transaction (see ``saveAtCommit``)
+
+    Joins the transaction as data manager to forget the saves collected
+    after a savepoint that gets rolled back.
+    """
+
+    def __init__(self):
+        self.saves = OrderedDict()
+        self.joined = False
+        self.transaction_manager = transaction.manager
+
+    def join(self, txn):
+        if not self.joined:
+            txn.join(self)
+            self.joined = True
+
+    def savepoint(self):
+        return _SaveCollectorSavepoint(self)
+
+    def abort(self, txn):
+        # also called when rolling back a savepoint taken before joining
+        self.saves.clear()
+        self.joined = False
+
+    def tpc_begin(self, txn):
+        pass
+
+    commit = tpc_vote = tpc_finish = tpc_begin
+    tpc_abort = abort
+
+    def sortKey(self):
+        return 'CMFEditions save collector %d' % id(self)
+
+
+class _SaveCollectorSavepoint(object):
+
+    def __init__(self, collector):
+        self.collector = collector
+        self.saves = [(key, dict(entry, comments=list(entry['comments'])))
+                      for key, entry in collector.saves.items()]
+
+    def rollback(self):
+        saves = self.collector.saves
+        saves.clear()
+        for key, entry in self.saves:
+            saves[key] = dict(entry, comments=list(entry['comments']))
+
+
+_transactionSaves = weakref.WeakKeyDictionary()
+
+def saveAtCommit(obj, comment=''):
+    """Saves a version of the object when the transaction gets committed
+
+    Several saves of the same object within one transaction (e.g. by
+    the edit form, a workflow transition and a rename) are coalesced to
+    one version with the comments merged. Saves collected after a
+    savepoint are dropped if the savepoint gets rolled back.
+    """
+    txn = transaction.get()
+    collector = _transactionSaves.get(txn, None)
+    if collector is None:
+        collector = _transactionSaves[txn] = _SaveCollector()
+        txn.addBeforeCommitHook(_saveCoalesced, (collector.saves, ))
+    collector.join(txn)
+    saves = collector.saves
+    entry = saves.setdefault(id(aq_base(obj)), {'comments': []})
+    # the latest wrapper and user win
+    entry['obj'] = obj
+    entry['securityManager'] = getSecurityManager()
+    entry['comments'].append(comment)
+
+def updateSaveAtCommit(obj):
+    """Updates the save collected by ``saveAtCommit`` for an object moved
+    or renamed later in the transaction
+    """
+    collector = _transactionSaves.get(transaction.get(), None)
+    if collector is not None:
+        entry = collector.saves.get(id(aq_base(obj)), None)
+        if entry is not None:
+            entry['obj'] = obj
+
+def _getCurrent(obj):
+    """Returns the object at its current location or None if it got
+    removed
+
+    Objects moved without notifying an event are looked up by their
+    history id.
+    """
+    current = obj.unrestrictedTraverse(obj.getPhysicalPath(), None)
+    if current is not None and aq_base(current) is aq_base(obj):
+        return current
+    hidhandler = getToolByName(obj, 'portal_historyidhandler', None)
+    history_id = hidhandler is not None and hidhandler.queryUid(obj, None)
+    if history_id is None:
+        return None
+    current = dereference(history_id=history_id, zodb_hook=obj)[0]
+    if current is None or aq_base(current) is not aq_base(obj):
+        return None
+    return current
+
+def _saveCoalesced(saves):
+    """Before commit hook saving the versions collected by ``saveAtCommit``
+    """
+    oldSecurityManager = getSecurityManager()
+    try:
+        # the savepoints of the saves may roll back the collected saves
+        for entry in list(saves.values()):
+            obj = _getCurrent(entry['obj'])
+            if obj is None:
+                logger.info("CMFEditions: '%s' got removed before the "
+                            "transaction got committed, no version saved"
+                            % '/'.join(entry['obj'].getPhysicalPath()))
+                continue
+            setSecurityManager(entry['securityManager'])
+            # a version may have been saved explicitly in the meantime
+            if not isObjectChanged(obj):
+                continue
+            try:
+                maybeSaveVersion(obj, comment=mergeComments(entry['comments']),
+                                 force=False, deferred=True)
+            except FileTooLargeToVersionError:
+                pass # There's no way to emit a warning here. Or is there?
+    finally:
+        setSecurityManager(oldSecurityManager)
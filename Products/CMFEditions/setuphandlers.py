@@ -30,3 +30,38 @@ def installSkipRegistryBasesPointersModifier(context):
     """Upgrade step to install the component registry bases modifier."""
     portal_modifier = getToolByName(context, 'portal_modifier', None)
     StandardModifiers.install(portal_modifier, ['SkipRegistryBasesPointers'])
+
+
+def migrateShadowMetadata(context):
+    """Upgrade step copying the version metadata to the shadow storage."""
+    storage = getToolByName(context, 'portal_historiesstorage', None)
+    if storage is not None:
+        storage.migrateShadowMetadata()
+
+
+def rebuildStatistics(context):
+    """Upgrade step calculating the statistics of the storage."""
+    storage = getToolByName(context, 'portal_historiesstorage', None)
+    if storage is not None:
+        storage.rebuildStatistics()
+
+
+def migrateAvailableVersions(context):
+    """Upgrade step converting the available versions of the histories."""
+    storage = getToolByName(context, 'portal_historiesstorage', None)
+    if storage is not None:
+        storage.migrateAvailableVersions()
+
+
+def shardShadowStorage(context):
+    """Upgrade step spreading the shadow histories over shards."""
+    storage = getToolByName(context, 'portal_historiesstorage', None)
+    if storage is not None:
+        storage.shardShadowStorage()
+
+
+def migrateModificationDates(context):
+    """Upgrade step caching the modification dates of the versions."""
+    storage = getToolByName(context, 'portal_historiesstorage', None)
+    if storage is not None:
+        storage.migrateModificationDates()
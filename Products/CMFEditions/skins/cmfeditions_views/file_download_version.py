@@ -10,7 +10,8 @@
 request = container.REQUEST
 RESPONSE =  request.RESPONSE
 
-obj = context.portal_repository.retrieve(context, version_id).object
+obj = context.portal_repository.retrieve(context, version_id,
+                                         detached=True).object
 RESPONSE.setHeader('Content-Type', obj.getContentType())
 RESPONSE.setHeader('Content-Length', obj.get_size())
 RESPONSE.setHeader('Content-Disposition',
@@ -7,7 +7,8 @@
 ##parameters=here_url, version_id=None
 ##title=Image tag for specific version
 ##
-obj = context.portal_repository.retrieve(context, version_id).object
+obj = context.portal_repository.retrieve(context, version_id,
+                                         detached=True).object
 working_copy_tag = obj.tag()
 
 # XXX Does someone know a less ugly way to do this?
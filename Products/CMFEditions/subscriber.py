@@ -25,9 +25,11 @@ $Id: ArchivistTool.py,v 1.15 2005/06/24 11:34:08 gregweb Exp $
 """
 from zope.i18nmessageid import MessageFactory
 from Acquisition import aq_get
+from Products.CMFCore.utils import getToolByName
 
 from Products.CMFEditions.utilities import isObjectChanged, maybeSaveVersion
 from Products.CMFEditions.interfaces.IModifier import FileTooLargeToVersionError
+from Products.CMFEditions.savequeue import saveAtCommit, updateSaveAtCommit
 from Products.CMFEditions import CMFEditionsMessageFactory as _
 
 PMF = MessageFactory('plone')
@@ -40,8 +42,15 @@ def webdavObjectEventHandler(obj, event, comment):
     if not changed:
         return
 
+    portal_repository = getToolByName(obj, 'portal_repository', None)
+    if portal_repository is not None and \
+       portal_repository.isCoalescedSaving():
+        # several events of one transaction result in one version only
+        saveAtCommit(obj, comment=comment)
+        return
+
     try:
-        maybeSaveVersion(obj, comment=comment, force=False)
+        maybeSaveVersion(obj, comment=comment, force=False, deferred=True)
     except FileTooLargeToVersionError:
         pass # There's no way to emit a warning here. Or is there?
 
@@ -62,3 +71,27 @@ def objectInitialized(obj, event):
 def objectEdited(obj, event):
     comment = _getVersionComment(event.object) or PMF('Edited')
     return webdavObjectEventHandler(obj, event, comment=comment)
+
+def _setHistoryDeleted(obj, deleted):
+    storage = getToolByName(obj, 'portal_historiesstorage', None)
+    hidhandler = getToolByName(obj, 'portal_historyidhandler', None)
+    if storage is None or hidhandler is None:
+        return
+    history_id = hidhandler.queryUid(obj, None)
+    if history_id is not None:
+        storage.setHistoryDeleted(history_id, deleted)
+
+def objectRemoved(obj, event):
+    # moves the history to the statistics of deleted items
+    if event.oldParent is not None and event.newParent is None:
+        _setHistoryDeleted(obj, True)
+
+def objectAdded(obj, event):
+    # a moved or re-added item exists (again)
+    if event.newParent is not None:
+        _setHistoryDeleted(obj, False)
+
+def objectMoved(obj, event):
+    # the versions saved at commit are saved at the new location
+    if event.newParent is not None:
+        updateSaveAtCommit(event.object)
@@ -235,6 +235,12 @@ class DummyArchivist(SimpleItem):
 
         return deepCopy(vdata)
 
+    def retrieveMany(self, obj=None, history_id=None, selectors=(),
+                     preserve=(), countPurged=True):
+        return [self.retrieve(obj, history_id, selector, preserve,
+                              countPurged)
+                for selector in selectors]
+
     def getHistory(self, obj=None, history_id=None, preserve=()):
         obj, history_id = dereference(obj, history_id, self)
         return [deepCopy(obj) for obj in self._archive[history_id]]
@@ -260,6 +266,13 @@ class DummyArchivist(SimpleItem):
         mem = self.retrieve(obj=obj, history_id=history_id, selector=selector)
         return mem.data.object.modified() == obj.modified()
 
+    def getFingerprint(self, obj, callbacks=None):
+        return None
+
+    def isUnchanged(self, obj=None, history_id=None, callbacks=None,
+                    fingerprint=None):
+        return False
+
 
 class VersionAwareReference:
     def __init__(self, **info):
@@ -283,6 +296,12 @@ class VersionAwareReference:
 class DummyModifier(DummyBaseTool):
     id = 'portal_modifier'
 
+    def beginOperation(self):
+        pass
+
+    def endOperation(self):
+        pass
+
     def beforeSaveModifier(self, obj, clone):
         return {}, [], [] # XXX 2nd and 3rd shall be lists
 
@@ -309,6 +328,12 @@ class FolderishContentObjectModifier(DummyBaseTool):
 
     id = 'portal_modifier'
 
+    def beginOperation(self):
+        pass
+
+    def endOperation(self):
+        pass
+
     def getReferencedAttributes(self, obj):
         # we declare the title beeing a big blob we don't want to be
         # pickled and unpickled by the archivist
@@ -543,6 +568,11 @@ class MemoryStorage(DummyBaseTool):
             raise StorageRetrieveError("Retrieving non existing version %s"
                                        % selector)
 
+    def retrieveMany(self, history_id, selectors,
+                     countPurged=True, substitute=True):
+        return [self.retrieve(history_id, selector, countPurged, substitute)
+                for selector in selectors]
+
     def getHistory(self, history_id, preserve=(), countPurged=True,
                    substitute=True):
         history = []
@@ -569,6 +599,16 @@ class MemoryStorage(DummyBaseTool):
         vdata = self.retrieve(history_id, selector, countPurged, substitute)
         return vdata.object.object.modified()
 
+    def getMetadata(self, history_id, selector=None, countPurged=True):
+        vdata = self.retrieve(history_id, selector, countPurged,
+                              substitute=False)
+        return vdata.metadata
+
+    def getReferencedData(self, history_id, selector=None, countPurged=True):
+        vdata = self.retrieve(history_id, selector, countPurged,
+                              substitute=False)
+        return vdata.referenced_data
+
     def purge(self, history_id, selector, metadata={}, countPurged=True):
         """See ``IPurgeSupport``
         """
@@ -584,6 +624,19 @@ class MemoryStorage(DummyBaseTool):
             # digging into ZVC internals: remove the stored object
             history[selector] = StorageVersionData(removedInfo, None, metadata)
 
+    def purgeMany(self, history_id, selectors, metadata={}, countPurged=True):
+        """See ``IPurgeSupport``
+        """
+        history = self._histories[history_id]
+        vdatas = [self.retrieve(history_id, selector, countPurged,
+                                substitute=False) for selector in selectors]
+        nbrOfPurged = 0
+        for vdata in vdatas:
+            if not isinstance(vdata.object, Removed):
+                self.purge(history_id, history.index(vdata), metadata)
+                nbrOfPurged += 1
+        return nbrOfPurged
+
     def _getHistory(self, history_id):
         try:
             history = self._histories[history_id]
@@ -651,6 +704,13 @@ class DummyPurgePolicy(DummyBaseTool):
 
         return True
 
+    def getVersionsToPurge(self, history_id, room=0):
+        """Purge all but the two most current versions
+        """
+        storage = getToolByName(self, 'portal_historiesstorage')
+        length = len(storage.getHistory(history_id, countPurged=False))
+        return range(max(min(length - 2 + room, length), 0))
+
     def retrieveSubstitute(self, history_id, selector, default=None):
         """Retrives the next older version
         """
@@ -684,6 +744,12 @@ class PurgePolicyTestDummyStorage(DummyBaseTool):
               countPurged=True):
         del self.history[selector]
 
+    def purgeMany(self, history_id, selectors, metadata={},
+                  countPurged=True):
+        for selector in sorted(selectors, reverse=True):
+            del self.history[selector]
+        return len(selectors)
+
     def retrieve(self, history_id, selector=None,
                  countPurged=True, substitute=True):
         if selector >= len(self.history):
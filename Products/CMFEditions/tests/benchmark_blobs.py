@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+# This file is part of CMFEditions.
+#
+# CMFEditions is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# CMFEditions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CMFEditions; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#########################################################################
+"""Benchmark of versioning big blobs
+
+Saves a version of a committed blob to a fresh FileStorage with a blob
+directory once by copying the data and once through a hard link or
+reflink (if supported by the file system) and reports the time needed
+(including the commit) and the growth of the blob directory.
+
+Run it with the python of the instance (e.g. ``bin/zopepy``)::
+
+  bin/zopepy Products/CMFEditions/tests/benchmark_blobs.py [size in MB ...]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import transaction
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.blob import Blob
+
+from Products.CMFEditions.StandardModifiers import copyBlob
+
+MB = 1 << 20
+
+def diskUsage(directory):
+    """Returns the number of bytes used by the files in the directory
+
+    Hard linked files are only counted once.
+    """
+    inodes = {}
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in filenames:
+            st = os.stat(os.path.join(dirpath, name))
+            inodes[(st.st_dev, st.st_ino)] = st.st_blocks * 512
+    return sum(inodes.values())
+
+def run(size):
+    """Returns the time and the disk usage of copying and linking
+    """
+    tmpdir = tempfile.mkdtemp()
+    blob_dir = os.path.join(tmpdir, 'blobs')
+    db = DB(FileStorage(os.path.join(tmpdir, 'Data.fs'), blob_dir=blob_dir))
+    try:
+        conn = db.open()
+        root = conn.root()
+        blob = root['blob'] = Blob()
+        chunk = os.urandom(MB)
+        blob_file = blob.open('w')
+        for i in range(size):
+            blob_file.write(chunk)
+        blob_file.close()
+        transaction.commit()
+
+        results = []
+        for name, link in (('copy', False), ('link', True)):
+            conn.cacheMinimize()
+            usage = diskUsage(blob_dir)
+            start = time.time()
+            root[name] = copyBlob(root['blob'], link=link)
+            transaction.commit()
+            results.append((name, time.time() - start,
+                            diskUsage(blob_dir) - usage))
+        conn.close()
+        return results
+    finally:
+        db.close()
+        shutil.rmtree(tmpdir)
+
+def main(args):
+    sizes = [int(arg) for arg in args] or [100, 500, 1000]
+    print "%-10s %-6s %10s %12s %14s" % ('size', 'mode', 'seconds',
+                                          'MB/s', 'disk growth')
+    for size in sizes:
+        for name, seconds, growth in run(size):
+            print "%7d MB %-6s %9.3fs %12.1f %11.1f MB" % (
+                size, name, seconds, size / max(seconds, 1e-6),
+                float(growth) / MB)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+# This file is part of CMFEditions.
+#
+# CMFEditions is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# CMFEditions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CMFEditions; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#########################################################################
+"""Benchmark of the ZVC storages payload formats
+
+Saves a history of a document with slightly changing text to a fresh
+FileStorage for every payload format and reports the size of the
+(packed) storage and the time needed to retrieve the oldest, a middle
+and the youngest version.
+
+Run it with the python of the instance (e.g. ``bin/zopepy``)::
+
+  bin/zopepy Products/CMFEditions/tests/benchmark_storage.py [depth [interval]]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import transaction
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+
+from Products.CMFEditions.ArchivistTool import ObjectData
+from Products.CMFEditions.ZVCStorageTool import ZVCStorageTool
+from Products.CMFEditions.tests.DummyTools import Dummy
+
+PARAGRAPH = "<p>Paragraph %s of the document. Lorem ipsum dolor sit amet, " \
+            "consectetur adipisicing elit, sed do eiusmod tempor.</p>\n"
+
+def buildText(version, paragraphs=200):
+    # every version changes another paragraph
+    lines = [PARAGRAPH % i for i in range(paragraphs)]
+    lines[version % paragraphs] = PARAGRAPH % ('changed in v%s' % version)
+    return ''.join(lines)
+
+def buildMetadata(version):
+    return {'sys_metadata': {'comment': 'saved v%s' % version,
+                             'physicalPath': ('', 'doc')}}
+
+def run(depth, serializedPayloads, deltaSnapshotInterval):
+    """Returns the size of the storage and the retrieve latencies
+    """
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'Data.fs')
+    db = DB(FileStorage(path))
+    try:
+        conn = db.open()
+        root = conn.root()
+        storage = root['storage'] = ZVCStorageTool()
+        storage.serializedPayloads = serializedPayloads
+        storage.deltaSnapshotInterval = deltaSnapshotInterval
+        transaction.commit()
+
+        for version in range(depth):
+            obj = Dummy()
+            obj.text = buildText(version)
+            if version == 0:
+                storage.register(1, ObjectData(obj),
+                                 metadata=buildMetadata(version))
+            else:
+                storage.save(1, ObjectData(obj),
+                             metadata=buildMetadata(version))
+            transaction.commit()
+
+        db.pack()
+        size = os.path.getsize(path)
+
+        latencies = []
+        for selector in (0, depth // 2, depth - 1):
+            # start with a cold cache
+            conn.cacheMinimize()
+            start = time.time()
+            vdata = storage.retrieve(1, selector)
+            latencies.append(time.time() - start)
+            assert vdata.object.object.text == buildText(selector)
+        transaction.abort()
+        conn.close()
+        return size, latencies
+    finally:
+        db.close()
+        shutil.rmtree(tmpdir)
+
+def main(args):
+    depth = len(args) > 0 and int(args[0]) or 100
+    interval = len(args) > 1 and int(args[1]) or 10
+    formats = (
+        ('object', False, 0),
+        ('serialized', True, 0),
+        ('delta (interval %s)' % interval, True, interval),
+    )
+    print "History depth: %s versions" % depth
+    print "%-22s %12s %10s %10s %10s" % ('format', 'bytes', 'oldest',
+                                          'middle', 'youngest')
+    for name, serialized, snapshotInterval in formats:
+        size, latencies = run(depth, serialized, snapshotInterval)
+        print "%-22s %12d %9.2fms %9.2fms %9.2fms" % (
+            (name, size) + tuple([l * 1000 for l in latencies]))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -23,8 +23,16 @@
 """Test the ATContentTypes content
 """
 import os
+import shutil
+import tempfile
+
+import transaction
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.blob import Blob
 
 from Products.CMFEditions import PACKAGE_HOME
+from Products.CMFEditions import StandardModifiers
 from Products.CMFEditions.tests.base import CMFEditionsBaseTestCase
 
 
@@ -211,6 +219,30 @@ class TestATContents(CMFEditionsBaseTestCase):
         portal_repository.revert(content, 0)
         self.assertEqual(content.getFile().getBlob(), blob1)
 
+    def testBlobDigestsStored(self):
+        from hashlib import sha256
+        self.folder.invokeFactory('File', id='file')
+        file1 = open(
+            os.path.join(PACKAGE_HOME, 'tests/images/img1.png'),
+            'rb'
+        ).read()
+        portal_repository = self.portal_repository
+        portal_storage = self.portal.portal_historiesstorage
+        content = self.folder.file
+        content.edit(file=file1)
+        portal_repository.applyVersionControl(content, comment='save no 1')
+        history_id = self.portal.portal_historyidhandler.queryUid(content)
+        # the digest and the size are stored along with the blob
+        referenced_data = portal_storage.getReferencedData(history_id)
+        self.assertEqual(referenced_data['CloneBlobs/file:digest'],
+                         (sha256(file1).hexdigest(), len(file1)))
+        # an unchanged file is detected by its digest
+        content.edit(title='Title 2')
+        portal_repository.save(content, comment='save no 2')
+        self.assertEqual(
+            portal_storage.getReferencedData(history_id)['CloneBlobs/file'],
+            referenced_data['CloneBlobs/file'])
+
     def testBlobsNotStringConverted(self):
         file1 = open(os.path.join(PACKAGE_HOME, 'tests/file1.dat')).read()
         content = self.folder[
@@ -229,3 +261,176 @@ class TestATContents(CMFEditionsBaseTestCase):
                 self.assertFalse(file1 in repr(err))
             else:
                 self.fail("Didn't raise ArchivistError")
+
+    def testBlobsReusedAfterPurges(self):
+        self.folder.invokeFactory('File', id='file')
+        portal_repository = self.portal_repository
+        portal_storage = self.portal.portal_historiesstorage
+        content = self.folder.file
+        files = ['file data %s' % i for i in range(3)]
+        content.edit(file=files[0])
+        portal_repository.applyVersionControl(content, comment='save no 1')
+        for i in (1, 2):
+            content.edit(file=files[i])
+            portal_repository.save(content, comment='save no %s' % (i+1))
+        history_id = self.portal.portal_historyidhandler.queryUid(content)
+        blob1 = portal_storage.getReferencedData(history_id, 1)[
+            'CloneBlobs/file']
+        # purging the oldest and the youngest version leaves the second
+        # version the youngest available one
+        metadata = {'sys_metadata': {'comment': 'purged'}}
+        for selector in (0, 2):
+            portal_storage.purge(history_id, selector, metadata=metadata)
+        # the blob of the youngest available version is reused
+        content.edit(file=files[1])
+        portal_repository.save(content, comment='save no 4')
+        self.assertEqual(
+            portal_storage.getReferencedData(history_id)['CloneBlobs/file'],
+            blob1)
+
+
+class TestBlobCopying(CMFEditionsBaseTestCase):
+    """Copying committed blobs by hard linking, reflinking or copying
+    """
+
+    def afterSetUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.original = os.link, StandardModifiers.fcntl
+
+    def beforeTearDown(self):
+        os.link, StandardModifiers.fcntl = self.original
+        shutil.rmtree(self.tmpdir, True)
+
+    def copyCommittedBlob(self):
+        """Copies a committed blob of a separate blob storage
+
+        Returns the file name of the committed blob and the copy (which
+        has to be kept as its file is removed with it).
+        """
+        db = DB(FileStorage(os.path.join(self.tmpdir, 'Data.fs'),
+                            blob_dir=os.path.join(self.tmpdir, 'blobs')))
+        tm = transaction.TransactionManager()
+        conn = db.open(transaction_manager=tm)
+        try:
+            blob = conn.root()['blob'] = Blob()
+            blob_file = blob.open('w')
+            blob_file.write('blob data ' * 1000)
+            blob_file.close()
+            tm.commit()
+
+            new_blob = StandardModifiers.copyBlob(blob)
+            new_blob_file = new_blob.open('r')
+            try:
+                self.assertEqual(new_blob_file.read(), 'blob data ' * 1000)
+            finally:
+                new_blob_file.close()
+            return blob.committed(), new_blob
+        finally:
+            tm.abort()
+            conn.close()
+            db.close()
+
+    def patchLinking(self, link, ioctl):
+        os.link = link
+        class fcntl:
+            pass
+        fcntl.ioctl = staticmethod(ioctl)
+        StandardModifiers.fcntl = fcntl
+
+    def test01_hardLink(self):
+        committed, new_blob = self.copyCommittedBlob()
+        copied = new_blob._p_blob_uncommitted
+        self.assertEqual(os.stat(copied).st_ino, os.stat(committed).st_ino)
+
+    def test02_reflink(self):
+        def link(source, target):
+            raise OSError("not supported")
+        calls = []
+        def ioctl(dst, request, src):
+            # cloning is simulated by copying
+            calls.append(request)
+            os.write(dst, os.read(src, 1 << 20))
+        self.patchLinking(link, ioctl)
+        committed, new_blob = self.copyCommittedBlob()
+        copied = new_blob._p_blob_uncommitted
+        self.assertEqual(calls, [StandardModifiers.FICLONE])
+        self.assertNotEqual(os.stat(copied).st_ino, os.stat(committed).st_ino)
+
+    def test03_copy(self):
+        def link(source, target):
+            raise OSError("not supported")
+        def ioctl(dst, request, src):
+            raise IOError("not supported")
+        self.patchLinking(link, ioctl)
+        tempdir = tempfile.gettempdir()
+        before = set(os.listdir(tempdir))
+        committed, new_blob = self.copyCommittedBlob()
+        copied = new_blob._p_blob_uncommitted
+        self.assertNotEqual(os.stat(copied).st_ino, os.stat(committed).st_ino)
+
+        # the link targets are cleaned up
+        self.failIf([name for name in set(os.listdir(tempdir)) - before
+                     if name.startswith('CMFEditions')])
+
+        # failing to create the target isn't an error
+        self.failIf(StandardModifiers._linkFile(
+            committed, os.path.join(self.tmpdir, 'missing', 'blob')))
+
+
+class SchemaDummy:
+    portal_type = 'SchemaDummy'
+
+    def __init__(self, schema):
+        self.schema = schema
+
+    def Schema(self):
+        return self.schema
+
+
+class TestBlobFields(CMFEditionsBaseTestCase):
+
+    def afterSetUp(self):
+        StandardModifiers._blob_fields.clear()
+        self.original = StandardModifiers._getFieldSignature
+        self.signatures = []
+        def getFieldSignature(schema):
+            self.signatures.append(schema)
+            return self.original(schema)
+        StandardModifiers._getFieldSignature = getFieldSignature
+
+    def beforeTearDown(self):
+        StandardModifiers._getFieldSignature = self.original
+        StandardModifiers._blob_fields.clear()
+
+    def test01_cacheHit(self):
+        self.folder.invokeFactory('File', id='file')
+        content = self.folder.file
+        fields = StandardModifiers.getBlobFields(content)
+        self.assertEqual([f.getName() for f in fields], ['file'])
+        self.assertEqual(len(self.signatures), 1)
+
+        # the fields of the same schema aren't looked at again
+        self.assertEqual(StandardModifiers.getBlobFields(content), fields)
+        self.assertEqual(len(self.signatures), 1)
+
+    def test02_schemaChanged(self):
+        from Products.Archetypes.atapi import Schema, StringField
+        from plone.app.blob.field import BlobField
+        obj = SchemaDummy(Schema((StringField('file'), )))
+        self.assertEqual(StandardModifiers.getBlobFields(obj), [])
+
+        # an equal schema (e.g. of a schema extender) uses the cache
+        obj.schema = Schema((StringField('file'), ))
+        self.assertEqual(StandardModifiers.getBlobFields(obj), [])
+        self.assertEqual(len(self.signatures), 2)
+
+        # a field changing its type is detected
+        obj.schema = Schema((BlobField('file'), ))
+        self.assertEqual(StandardModifiers.getBlobFields(obj),
+                         [obj.schema['file']])
+
+        # as is an added field
+        obj.schema = Schema((BlobField('file'), BlobField('image')))
+        self.assertEqual([f.getName() for f in
+                          StandardModifiers.getBlobFields(obj)],
+                         ['file', 'image'])
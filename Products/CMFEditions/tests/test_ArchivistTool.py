@@ -30,6 +30,7 @@ from zope.interface.verify import verifyObject
 
 from Products.CMFEditions.interfaces.IArchivist import IArchivist
 from Products.CMFEditions.interfaces.IArchivist import IPurgeSupport
+from Products.CMFEditions.ArchivistTool import ArchivistTool
 
 from DummyTools import DummyModifier
 from DummyTools import DummyHistoryIdHandler
@@ -376,6 +377,77 @@ class TestArchivistToolMemoryStorage(CMFEditionsBaseTestCase):
         self.assertEqual(history.retrieve(0)['metadata']['app_metadata'], 'save number 1')
         self.assertEqual(history.retrieve(1)['metadata']['app_metadata'], 'save number 2')
 
+    def test10_retrieveMany(self):
+        portal_archivist = self.portal.portal_archivist
+        doc = self.portal.doc
+        for i in range(3):
+            doc.text = 'text v%s' % (i+1)
+            prep = portal_archivist.prepare(doc,
+                                            app_metadata='save number %s' % (i+1))
+            if i:
+                portal_archivist.save(prep)
+            else:
+                portal_archivist.register(prep)
+
+        vdatas = portal_archivist.retrieveMany(obj=doc, selectors=(2, 0),
+                                               preserve=('gaga',))
+        self.assertEqual([vdata.data.object.text for vdata in vdatas],
+                         ['text v3', 'text v1'])
+        self.assertEqual([vdata.app_metadata for vdata in vdatas],
+                         ['save number 3', 'save number 1'])
+        self.assertEqual(vdatas[1].preserved_data['gaga'], 'gaga')
+        self.assertEqual(doc.text, 'text v3')
+
+    def test11_isUnchanged(self):
+        portal_archivist = self.portal.portal_archivist
+        doc = self.portal.doc
+        doc.text = 'text v1'
+        self.failIf(portal_archivist.isUnchanged(doc))
+
+        prep = portal_archivist.prepare(doc)
+        portal_archivist.register(prep)
+        prep.copyVersionIdFromClone()
+        fingerprint = portal_archivist.getFingerprint(doc)
+        self.failUnless(fingerprint)
+        self.failUnless(portal_archivist.isUnchanged(doc))
+
+        doc.text = 'text v2'
+        self.failIf(portal_archivist.isUnchanged(doc))
+        self.failIfEqual(portal_archivist.getFingerprint(doc), fingerprint)
+
+        prep = portal_archivist.prepare(doc)
+        portal_archivist.save(prep)
+        prep.copyVersionIdFromClone()
+        self.failUnless(portal_archivist.isUnchanged(doc))
+
+    def test12_fingerprintTakenFromClone(self):
+        portal_archivist = self.portal.portal_archivist
+        doc = self.portal.doc
+        doc.text = 'text v1'
+        pickled = []
+        def _pickle(obj, callbacks):
+            pickled.append(obj)
+            return ArchivistTool._pickle(portal_archivist, obj, callbacks)
+        portal_archivist._pickle = _pickle
+        try:
+            prep = portal_archivist.prepare(doc)
+            portal_archivist.register(prep)
+            prep.copyVersionIdFromClone()
+            doc.text = 'text v2'
+            prep = portal_archivist.prepare(doc)
+            # the working copy gets the new version id after saving only
+            self.assertEqual(doc.version_id, 0)
+            portal_archivist.save(prep)
+            prep.copyVersionIdFromClone()
+        finally:
+            del portal_archivist._pickle
+
+        # the working copy is pickled once per save only
+        self.assertEqual(len(pickled), 2)
+        self.assertEqual(prep.metadata['sys_metadata']['fingerprint'],
+                         portal_archivist.getFingerprint(doc))
+        self.failUnless(portal_archivist.isUnchanged(doc))
+
 class TestArchivistToolZStorage(TestArchivistToolMemoryStorage):
 
    def installStorageTool(self):
@@ -37,6 +37,12 @@ from Products.CMFEditions.interfaces.IRepository import IContentTypeVersionPolic
 from Products.CMFEditions.interfaces.IRepository import IVersionData
 from Products.CMFEditions.VersionPolicies import VersionPolicy
 from Products.CMFEditions.VersionPolicies import ATVersionOnEditPolicy
+from Products.CMFEditions.utilities import isObjectVersioned
+from Products.CMFEditions.utilities import maybeSaveVersion
+from Products.CMFEditions import savequeue
+from Products.CMFEditions.savequeue import saveAtCommit
+from Products.CMFEditions.interfaces.IModifier import FileTooLargeToVersionError
+from Products.CMFEditions.bulkversioning import BulkVersioningJob
 
 from DummyTools import DummyArchivist
 from DummyTools import notifyModified
@@ -282,6 +288,273 @@ class TestCopyModifyMergeRepositoryTool(TestCopyModifyMergeRepositoryToolBase):
         self.assertEqual(history.retrieve(0)['metadata']['sys_metadata']['comment'], 'save number 1')
         self.assertEqual(history.retrieve(1)['metadata']['sys_metadata']['comment'], 'save number 2')
 
+    def test10_retrieveMany(self):
+        portal_repository = self.portal.portal_repository
+        doc = self.portal.doc
+
+        doc.text = 'text v1'
+        portal_repository.applyVersionControl(doc, comment='save no 1')
+        doc.text = 'text v2'
+        portal_repository.save(doc, comment='save no 2')
+        doc.text = 'text v3'
+
+        vdatas = portal_repository.retrieveMany(doc, (1, 0))
+        self.assertEqual([vdata.object.text for vdata in vdatas],
+                         ['text v2', 'text v1'])
+        self.assertEqual([vdata.comment for vdata in vdatas],
+                         ['save no 2', 'save no 1'])
+        # the working copy is left untouched
+        self.assertEqual(doc.text, 'text v3')
+
+    def test11_detachedRetrieve(self):
+        portal_repository = self.portal.portal_repository
+        fol = self.portal.fol
+
+        fol.title = 'fol title v1'
+        fol.doc1_inside.text = 'text v1'
+        portal_repository.applyVersionControl(fol, comment='save no 1')
+        fol.title = 'fol title v2'
+        fol.doc1_inside.text = 'text v2'
+        portal_repository.save(fol, comment='save no 2')
+
+        # detached retrieves don't need a savepoint
+        def savepoint(*args, **kw):
+            self.fail("savepoint used")
+        orig_savepoint = transaction.savepoint
+        transaction.savepoint = savepoint
+        try:
+            vdata = portal_repository.retrieve(fol, selector=0,
+                                               detached=True)
+            hist = portal_repository.getHistory(fol, detached=True)
+            versions = [v.object.title for v in hist]
+            vdatas = portal_repository.retrieveMany(fol, (0, 1),
+                                                    detached=True)
+        finally:
+            transaction.savepoint = orig_savepoint
+
+        self.failUnless(verifyObject(IVersionData, vdata))
+        self.assertEqual(vdata.object.title, 'fol title v1')
+        self.assertEqual(vdata.object.aq_parent, self.portal)
+        self.assertEqual(vdata.comment, 'save no 1')
+        self.assertEqual(versions, ['fol title v2', 'fol title v1'])
+        self.assertEqual([v.object.title for v in vdatas],
+                         ['fol title v1', 'fol title v2'])
+
+        # the working copy is left untouched
+        self.assertEqual(fol.title, 'fol title v2')
+        self.assertEqual(fol.doc1_inside.text, 'text v2')
+        self.failIf(vdata.object is fol)
+
+    def test12_deferredSaving(self):
+        portal_repository = self.portal.portal_repository
+        doc = self.portal.doc
+        portal_repository.setDeferredSaving(True)
+
+        # the saves are queued and coalesced
+        doc.text = 'text v1'
+        maybeSaveVersion(doc, comment='edit 1', deferred=True)
+        maybeSaveVersion(doc, comment='edit 2', deferred=True)
+        self.failIf(isObjectVersioned(doc))
+        self.assertEqual(portal_repository.getSaveQueueStatistics()['depth'],
+                         1)
+
+        self.assertEqual(portal_repository.processSaveQueue(), 1)
+        self.assertEqual(portal_repository.getSaveQueueStatistics()['depth'],
+                         0)
+        vdata = portal_repository.retrieve(doc)
+        self.assertEqual(vdata.object.text, 'text v1')
+        self.assertEqual(vdata.comment, u'edit 1; edit 2')
+
+        # saved immediately if the mode is off
+        portal_repository.setDeferredSaving(False)
+        doc.text = 'text v2'
+        notifyModified(doc)
+        maybeSaveVersion(doc, comment='edit 3', deferred=True)
+        self.assertEqual(portal_repository.retrieve(doc).object.text,
+                         'text v2')
+
+    def test13_saveAtCommitCoalescesSaves(self):
+        portal_repository = self.portal.portal_repository
+        doc = self.portal.doc
+
+        doc.text = 'text v1'
+        saveAtCommit(doc, comment='edited')
+        saveAtCommit(doc, comment='published')
+        saveAtCommit(doc, comment='edited')
+        self.failIf(isObjectVersioned(doc))
+
+        # one version is saved when committing
+        for hook, args, kws in transaction.get().getBeforeCommitHooks():
+            if hook is savequeue._saveCoalesced:
+                hook(*args, **kws)
+        self.assertEqual(len(portal_repository.getHistory(doc)), 1)
+        vdata = portal_repository.retrieve(doc)
+        self.assertEqual(vdata.object.text, 'text v1')
+        self.assertEqual(vdata.comment, u'edited; published')
+
+    def test14_saveMany(self):
+        portal_repository = self.portal.portal_repository
+        doc = self.portal.doc
+        link = self.portal.link
+        fol = self.portal.fol
+
+        # a failing save doesn't abort the others
+        recursiveSave = portal_repository._recursiveSave
+        def failingSave(obj, *args, **kw):
+            if obj is link:
+                raise FileTooLargeToVersionError
+            return recursiveSave(obj, *args, **kw)
+        portal_repository._recursiveSave = failingSave
+        try:
+            results = portal_repository.saveMany([doc, link, fol],
+                                                 comment='imported')
+        finally:
+            del portal_repository._recursiveSave
+
+        self.assertEqual([obj for obj, error in results], [doc, link, fol])
+        self.assertEqual(results[0][1], None)
+        self.failUnless(isinstance(results[1][1],
+                                   FileTooLargeToVersionError))
+        self.assertEqual(results[2][1], None)
+        self.failIf(isObjectVersioned(link))
+        doc_vdata = portal_repository.retrieve(doc)
+        fol_vdata = portal_repository.retrieve(fol)
+        self.assertEqual(doc_vdata.comment, 'imported')
+        self.assertEqual(doc_vdata.sys_metadata['timestamp'],
+                         fol_vdata.sys_metadata['timestamp'])
+
+    def test15_bulkVersioningJob(self):
+        # the job commits its batches
+        transaction.commit()
+        job = BulkVersioningJob(self.portal, batchSize=2)
+        paths = job.getPaths()
+        self.failUnless('/'.join(self.portal.doc.getPhysicalPath()) in paths)
+        self.assertEqual(paths, sorted(paths))
+
+        # the workers process disjoint parts of the paths
+        parts = [BulkVersioningJob(self.portal, worker=i, workers=2)
+                 for i in range(2)]
+        parts = [part.getPaths() for part in parts]
+        self.assertEqual(sorted(parts[0] + parts[1]), paths)
+        self.failIf(set(parts[0]) & set(parts[1]))
+
+        # an interrupted job continues after its checkpoint
+        processBatch = job.processBatch
+        def interruptingBatch(paths):
+            processBatch(paths)
+            raise KeyboardInterrupt
+        job.processBatch = interruptingBatch
+        self.assertRaises(KeyboardInterrupt, job.run)
+        self.assertEqual(job.getCheckpoint()['path'], paths[1])
+        self.assertEqual(list(job.iterPaths(paths[1])), paths[2:])
+
+        job = BulkVersioningJob(self.portal, batchSize=2)
+        saved, failed = job.run()
+        self.failUnless(saved > 0)
+        self.assertEqual(failed, 0)
+        self.failUnless(isObjectVersioned(self.portal.doc))
+        self.failUnless(isObjectVersioned(self.portal.fol.doc1_inside))
+
+        # the checkpoint is removed when finished
+        self.assertEqual(job.getCheckpoint(), None)
+        self.assertEqual(job.run(), (0, 0))
+
+    def test16_saveQueueLag(self):
+        queue = savequeue.SaveQueue()
+        self.assertEqual(queue.getLag(), 0.0)
+        queue.enqueue('/plone/a', None, 'edit', 'user', timestamp=100.0)
+        queue.enqueue('/plone/b', None, 'edit', 'user', timestamp=110.0)
+        # queuing again keeps the time queued first
+        queue.enqueue('/plone/a', None, 'edit 2', 'user', timestamp=120.0)
+        self.assertEqual(queue.getLag(now=130.0), 30.0)
+        queue.enqueue('/plone/0', None, 'edit', 'user', timestamp=125.0)
+        # the entries are processed in the order queued
+        self.assertEqual(queue.getPaths(), ['/plone/a', '/plone/b',
+                                            '/plone/0'])
+        self.assertEqual(queue.getPaths(1), ['/plone/a'])
+        queue.remove('/plone/0')
+
+        queue.remove('/plone/a')
+        self.assertEqual(queue.getLag(now=130.0), 20.0)
+        queue.remove('/plone/b')
+        self.assertEqual(queue.getLag(now=130.0), 0.0)
+        self.assertEqual(len(queue), 0)
+
+    def test17_saveAtCommitAfterMove(self):
+        portal_repository = self.portal.portal_repository
+        doc = self.portal.doc
+        link = self.portal.link
+
+        doc.text = 'text v1'
+        saveAtCommit(doc, comment='edited')
+        saveAtCommit(link, comment='edited')
+
+        # moved and removed later in the transaction
+        transaction.savepoint(optimistic=True)
+        self.portal.fol.manage_pasteObjects(
+            self.portal.manage_cutObjects(ids=['doc']))
+        self.portal.manage_delObjects(ids=['link'])
+
+        # the moved object is saved at its new location
+        for hook, args, kws in transaction.get().getBeforeCommitHooks():
+            if hook is savequeue._saveCoalesced:
+                hook(*args, **kws)
+        moved = self.portal.fol.doc
+        self.assertEqual(len(portal_repository.getHistory(moved)), 1)
+        self.assertEqual(portal_repository.retrieve(moved).object.text,
+                         'text v1')
+        self.failIf(isObjectVersioned(link))
+
+    def test18_saveManyReportsErrorsPerPosition(self):
+        portal_repository = self.portal.portal_repository
+        doc = self.portal.doc
+
+        # only the second save of the same object fails
+        recursiveSave = portal_repository._recursiveSave
+        calls = []
+        def failingSave(obj, *args, **kw):
+            calls.append(obj)
+            if len(calls) == 2:
+                raise FileTooLargeToVersionError
+            return recursiveSave(obj, *args, **kw)
+        portal_repository._recursiveSave = failingSave
+        try:
+            results = portal_repository.saveMany([doc, doc, doc])
+        finally:
+            del portal_repository._recursiveSave
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(results[0][1], None)
+        self.failUnless(isinstance(results[1][1],
+                                   FileTooLargeToVersionError))
+        self.assertEqual(results[2][1], None)
+        self.assertEqual(len(portal_repository.getHistory(doc)), 2)
+
+    def test19_saveAtCommitAfterSavepointRollback(self):
+        portal_repository = self.portal.portal_repository
+        doc = self.portal.doc
+        link = self.portal.link
+
+        doc.text = 'text v1'
+        saveAtCommit(doc, comment='edited')
+        sp = transaction.savepoint(optimistic=True)
+        saveAtCommit(doc, comment='published')
+        saveAtCommit(link, comment='edited')
+        sp.rollback()
+
+        # the saves collected after the savepoint are dropped
+        for hook, args, kws in transaction.get().getBeforeCommitHooks():
+            if hook is savequeue._saveCoalesced:
+                hook(*args, **kws)
+        self.assertEqual(portal_repository.retrieve(doc).comment, u'edited')
+        self.failIf(isObjectVersioned(link))
+
+    def test20_coalescedSavingIsOptional(self):
+        portal_repository = self.portal.portal_repository
+        self.failIf(portal_repository.isCoalescedSaving())
+        portal_repository.setCoalescedSaving(True)
+        self.failUnless(portal_repository.isCoalescedSaving())
+
 
 
 class TestRepositoryWithDummyArchivist(TestCopyModifyMergeRepositoryToolBase):
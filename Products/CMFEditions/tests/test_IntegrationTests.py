@@ -1157,3 +1157,133 @@ class TestIntegration(CMFEditionsBaseTestCase):
         self.assertEqual(self.portal.fol.Title(), "v2")
         self.assertTrue(
             self.portal.fol.getSiteManager().__bases__[0] is base)
+
+    def test27_versioningFolderDoesNotLoadChildren(self):
+        portal_repo = self.portal.portal_repository
+        portal_archivist = self.portal.portal_archivist
+        fol = self.portal.fol
+        for i in range(20):
+            fol.invokeFactory('Document', 'child%s' % i)
+        portal_repo.applyVersionControl(fol.doc1)
+        transaction.savepoint(optimistic=True)
+
+        # turn all childrens into ghosts
+        fol._p_jar.cacheMinimize()
+        fol = self.portal.fol
+        ids = fol.objectIds()
+
+        def loaded():
+            tree = aq_base(fol)._tree
+            return [name for name in ids if tree[name]._p_changed is not None]
+
+        self.assertEqual(loaded(), [])
+        portal_archivist._cloneByPickle(fol)
+        self.assertEqual(loaded(), [])
+
+        # the history ids of the childrens are read from the catalog
+        modifier = self.portal.portal_modifier['OMInsideChildrensModifier']
+        histids = dict(modifier.getModifier()._getSubObjectHistoryIds(fol))
+        self.failIf('doc1' in loaded())
+        self.assertEqual(len(histids), len(ids))
+        self.assertEqual(histids['doc1'],
+                         self.portal.portal_historyidhandler.queryUid(fol.doc1))
+        self.assertEqual(histids['child0'], None)
+
+    def test28_savingFolderOnlySavesChangedInsideRefs(self):
+        portal_modifier = self.portal.portal_modifier
+        portal_modifier.edit("OMOutsideChildrensModifier", enabled=False,
+                             condition="python: False")
+        portal_modifier.edit("OMInsideChildrensModifier", enabled=True,
+                             condition="python: portal_type=='Folder'")
+
+        portal_repo = self.portal.portal_repository
+        fol = self.portal.fol
+        doc1 = fol.doc1
+        doc2 = fol.doc2
+
+        fol.setTitle('v1 of fol')
+        doc1.setTitle('v1 of doc1')
+        doc2.setTitle('v1 of doc2')
+        portal_repo.applyVersionControl(fol, comment='first save')
+
+        # only the changed document gets a new version
+        fol.setTitle('v2 of fol')
+        doc2.setTitle('v2 of doc2')
+        portal_repo.save(fol, comment='second save')
+        self.assertEqual(len(portal_repo.getHistory(doc1)), 1)
+        self.assertEqual(len(portal_repo.getHistory(doc2)), 2)
+        self.assertEqual(len(portal_repo.getHistory(fol)), 2)
+
+        # the folders version references the existing version
+        repo_fol = portal_repo.retrieve(fol, 1).object
+        self.assertEqual(repo_fol.doc1.Title(), 'v1 of doc1')
+        self.assertEqual(repo_fol.doc2.Title(), 'v2 of doc2')
+
+        # reverting restores the unchanged document too
+        doc1.setTitle('v2 of doc1')
+        portal_repo.revert(fol, 1)
+        self.assertEqual(self.portal.fol.doc1.Title(), 'v1 of doc1')
+
+    def test29_revertFolderWithChildrenVersionedInSameTransaction(self):
+        portal_modifier = self.portal.portal_modifier
+        portal_modifier.edit("OMOutsideChildrensModifier", enabled=False,
+                             condition="python: False")
+        portal_modifier.edit("OMInsideChildrensModifier", enabled=True,
+                             condition="python: portal_type=='Folder'")
+
+        portal_repo = self.portal.portal_repository
+        catalog = self.portal.portal_catalog
+        fol = self.portal.fol
+        doc1 = fol.doc1
+
+        doc1.setTitle('v1 of doc1')
+        portal_repo.applyVersionControl(doc1, comment='first save')
+        # simulate the reindexing of the child being deferred until the
+        # transaction gets committed
+        rid = catalog.getrid('/'.join(doc1.getPhysicalPath()))
+        catalog._catalog.getIndex('cmf_uid').unindex_object(rid)
+
+        fol.setTitle('v1 of fol')
+        portal_repo.applyVersionControl(fol, comment='first save')
+
+        # reverting keeps the versioned child
+        doc1.setTitle('v2 of doc1')
+        portal_repo.revert(fol, 0)
+        self.failUnless('doc1' in self.portal.fol.objectIds())
+        self.assertEqual(self.portal.fol.doc1.Title(), 'v1 of doc1')
+
+    def test30_savingFolderPicklesEveryObjectOnce(self):
+        portal_modifier = self.portal.portal_modifier
+        portal_modifier.edit("OMOutsideChildrensModifier", enabled=False,
+                             condition="python: False")
+        portal_modifier.edit("OMInsideChildrensModifier", enabled=True,
+                             condition="python: portal_type=='Folder'")
+
+        portal_repo = self.portal.portal_repository
+        portal_archivist = self.portal.portal_archivist
+        fol = self.portal.fol
+        doc1 = fol.doc1
+        doc2 = fol.doc2
+        portal_repo.applyVersionControl(fol, comment='first save')
+        self.assertEqual(doc1.version_id, 0)
+
+        pickled = []
+        _pickle = portal_archivist._pickle
+        def countingPickle(obj, callbacks):
+            pickled.append(obj.getId())
+            return _pickle(obj, callbacks)
+        portal_archivist._pickle = countingPickle
+        try:
+            doc2.setTitle('v2 of doc2')
+            portal_repo.save(fol, comment='second save')
+        finally:
+            del portal_archivist._pickle
+
+        # the fingerprints of the inside references are taken from the
+        # pickles made for cloning them
+        self.assertEqual(sorted(pickled), ['doc1', 'doc2', 'fol'])
+        self.assertEqual(len(portal_repo.getHistory(doc1)), 1)
+        self.assertEqual(len(portal_repo.getHistory(doc2)), 2)
+        # the unchanged working copy keeps its version id
+        self.assertEqual(doc1.version_id, 0)
+        self.assertEqual(doc2.version_id, 1)
@@ -25,11 +25,16 @@
 
 from Products.CMFEditions.tests.base import CMFEditionsBaseTestCase
 
+import transaction
 from zope.interface.verify import verifyObject
 from Products.CMFEditions.interfaces.IPurgePolicy import IPurgePolicy
 
+from Products.CMFEditions.ArchivistTool import ObjectData
+from Products.CMFEditions.retentionsweeper import RetentionSweeper
+
 from DummyTools import PurgePolicyTestDummyStorage
 from DummyTools import DummyData, RemovedData
+from DummyTools import Dummy
 
 
 class TestKeepLastNVersionsTool(CMFEditionsBaseTestCase):
@@ -111,3 +116,56 @@ class TestKeepLastNVersionsTool(CMFEditionsBaseTestCase):
         # next older
         data = purgepolicy.retrieveSubstitute(history_id=1, selector=3)
         self.assertEquals(data.data, 1)
+
+
+class TestRetentionSweeper(CMFEditionsBaseTestCase):
+
+    def afterSetUp(self):
+        self.setRoles(['Manager',])
+        self.portal.portal_purgepolicy.maxNumberOfVersionsToKeep = -1
+
+    def _saveVersions(self, history_id, count):
+        storage = self.portal.portal_historiesstorage
+        for i in range(count):
+            obj = Dummy()
+            obj.text = 'v%s of text' % (i+1)
+            metadata = {'sys_metadata': {'comment': 'saved v%s' % (i+1)}}
+            if i == 0:
+                storage.register(history_id, ObjectData(obj),
+                                 metadata=metadata)
+            else:
+                storage.save(history_id, ObjectData(obj), metadata=metadata)
+
+    def test01_sweep(self):
+        storage = self.portal.portal_historiesstorage
+        purgepolicy = self.portal.portal_purgepolicy
+        for history_id in (1, 2, 3):
+            self._saveVersions(history_id, 4)
+        purgepolicy.maxNumberOfVersionsToKeep = 2
+        # the sweeper commits its batches
+        transaction.commit()
+
+        # a dry run only reports
+        report = RetentionSweeper(self.portal, batchSize=2, dryRun=True).run()
+        self.assertEqual(report['histories'], 3)
+        self.assertEqual(report['versions'], 6)
+        self.failUnless(report['bytes'] > 0)
+        self.failUnless(report['finished'])
+        self.assertEqual(len(storage.getHistory(1, countPurged=False)), 4)
+
+        # stops after the first batch if the time budget is used up
+        report = RetentionSweeper(self.portal, batchSize=2, timeBudget=0).run()
+        self.assertEqual((report['histories'], report['versions']), (2, 4))
+        self.failIf(report['finished'])
+        self.assertEqual(purgepolicy._sweep_cursor, 2)
+
+        # and continues after the cursor
+        report = RetentionSweeper(self.portal, batchSize=2).run()
+        self.assertEqual((report['histories'], report['versions']), (1, 2))
+        self.failUnless(report['finished'])
+        self.assertEqual(purgepolicy._sweep_cursor, None)
+        for history_id in (1, 2, 3):
+            history = storage.getHistory(history_id, countPurged=False)
+            self.assertEqual(len(history), 2)
+        vdata = storage.retrieve(1, 0, countPurged=False)
+        self.assertEqual(vdata.object.object.text, 'v3 of text')
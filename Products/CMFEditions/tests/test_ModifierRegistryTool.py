@@ -25,6 +25,7 @@
 
 from Products.CMFEditions.tests.base import CMFEditionsBaseTestCase
 
+import threading
 from pickle import dumps, loads, HIGHEST_PROTOCOL
 
 from zope.interface.verify import verifyObject
@@ -38,6 +39,9 @@ from Products.CMFEditions.interfaces.IModifier import ISaveRetrieveModifier
 from Products.CMFEditions.interfaces.IModifier import IAttributeModifier
 from Products.CMFEditions.interfaces.IModifier import ICloneModifier
 from Products.CMFEditions.interfaces.IModifier import IModifierRegistryQuery
+from Products.CMFEditions import Modifiers
+from Products.CMFEditions.Modifiers import ConditionalTalesModifier
+from Products.CMFEditions.ModifierRegistryTool import ModifierProfile
 
 
 # provoke the warning messages before the first test
@@ -360,3 +364,139 @@ class TestModifierRegistryTool(CMFEditionsBaseTestCase):
 %(class)s_A.afterRetrieveModifier
 <end>"""%{'class':'LoggingModifier'}
         self.assertEqual(mlog_str, expected_result)
+
+    def test11_modifierChainsCached(self):
+        portal_modifier = self.portal.portal_modifier
+        self.portal.invokeFactory('Document', 'doc2')
+        doc = self.portal.doc
+        doc2 = self.portal.doc2
+
+        portal_modifier.register('1', SimpleModifier1())
+        portal_modifier.edit('1', enabled=True,
+                             condition="python:portal_type == 'Document'")
+        portal_modifier.register('2', SimpleModifier2())
+        portal_modifier.edit('2', enabled=True,
+                             condition='python:object is not None')
+        self.failUnless(portal_modifier.get('1').dependsOnTypeOnly())
+        self.failIf(portal_modifier.get('2').dependsOnTypeOnly())
+
+        evaluated = []
+        isApplicable = ConditionalTalesModifier.isApplicable
+        def countingIsApplicable(self, obj, portal=None):
+            evaluated.append(self.getId())
+            return isApplicable(self, obj, portal)
+        ConditionalTalesModifier.isApplicable = countingIsApplicable
+        try:
+            # the conditions are evaluated once per object and operation
+            doc_copy = deepcopy(aq_base(doc))
+            portal_modifier.beginOperation()
+            for i in range(3):
+                portal_modifier.beforeSaveModifier(doc, doc_copy)
+            self.assertEqual(doc_copy.beforeSave1, 3)
+            self.assertEqual(doc_copy.beforeSave2, 3)
+            self.assertEqual(evaluated, ['1', '2'])
+
+            # type only conditions are evaluated once per type
+            doc2_copy = deepcopy(aq_base(doc2))
+            portal_modifier.beforeSaveModifier(doc2, doc2_copy)
+            self.assertEqual(doc2_copy.beforeSave1, 1)
+            self.assertEqual(evaluated, ['1', '2', '2'])
+
+            # editing invalidates the cached chains
+            portal_modifier.edit('1', condition='python:False')
+            portal_modifier.beforeSaveModifier(doc, doc_copy)
+            self.assertEqual(doc_copy.beforeSave1, 3)
+            self.assertEqual(doc_copy.beforeSave2, 4)
+            self.assertEqual(evaluated, ['1', '2', '2', '1', '2'])
+            portal_modifier.endOperation()
+
+            # the chains are evaluated again in the next operation
+            portal_modifier.beforeSaveModifier(doc, doc_copy)
+            self.assertEqual(doc_copy.beforeSave2, 5)
+            self.assertEqual(evaluated, ['1', '2', '2', '1', '2', '2'])
+        finally:
+            ConditionalTalesModifier.isApplicable = isApplicable
+
+    def test12_compiledConditions(self):
+        portal_modifier = self.portal.portal_modifier
+        doc = self.portal.doc
+
+        portal_modifier.register('1', SimpleModifier1())
+        portal_modifier.edit('1', enabled=True,
+                             condition="python: portal_type in ('Document', 'File')")
+        portal_modifier.register('2', SimpleModifier2())
+        portal_modifier.edit('2', enabled=True,
+                             condition="python: meta_type == 'Folder'")
+        portal_modifier.register('3', SimpleModifier3())
+        portal_modifier.edit('3', enabled=True,
+                             condition="python: object.getId() == 'doc'")
+        self.failUnless(portal_modifier.get('1').isCompiled())
+        self.failUnless(portal_modifier.get('2').isCompiled())
+        self.failIf(portal_modifier.get('3').isCompiled())
+
+        # compiled conditions don't need an expression context
+        def failing(*args, **kw):
+            self.fail("expression context created")
+        createExpressionContext = Modifiers.createExpressionContext
+        Modifiers.createExpressionContext = failing
+        try:
+            self.failUnless(portal_modifier.get('1').isApplicable(doc))
+            self.failIf(portal_modifier.get('2').isApplicable(doc))
+        finally:
+            Modifiers.createExpressionContext = createExpressionContext
+        self.failUnless(portal_modifier.get('3').isApplicable(doc))
+
+        evaluations = [(c['id'], c['evaluation'])
+                       for c in portal_modifier.listConditions()]
+        self.assertEqual(evaluations, [('1', 'python predicate'),
+                                       ('2', 'python predicate'),
+                                       ('3', 'TALES expression')])
+
+    def test13_profiling(self):
+        portal_modifier = self.portal.portal_modifier
+        doc = self.portal.doc
+        doc_copy = deepcopy(aq_base(doc))
+        for id, m in (('1', loggingModifiers[0]), ('2', loggingModifiers[1])):
+            portal_modifier.register(id, m)
+            portal_modifier.edit(id, enabled=True, condition='python:True')
+        portal_modifier.getProfile().clear()
+
+        # nothing is recorded by default
+        portal_modifier.beforeSaveModifier(doc, doc_copy)
+        self.assertEqual(portal_modifier.getProfileSummary(), [])
+
+        portal_modifier.setProfiling(True)
+        portal_modifier.getReferencedAttributes(doc)
+        persistent_id = portal_modifier.getOnCloneModifiers(doc)[0]
+        for i in range(3):
+            persistent_id(doc_copy)
+        portal_modifier.beforeSaveModifier(doc, doc_copy)
+        portal_modifier.afterRetrieveModifier(doc, doc_copy)
+        portal_modifier.setProfiling(False)
+
+        records = [r for r in portal_modifier.listProfileRecords()
+                   if r['modifier'] == '1']
+        self.assertEqual([r['phase'] for r in records],
+                         ['getReferencedAttributes', 'getOnCloneModifiers',
+                          'persistent_id', 'beforeSaveModifier',
+                          'afterRetrieveModifier'])
+        # the size of the referenced data is recorded
+        self.assertEqual(records[0]['size'], 40)
+        # the persistent_id calls of one clone operation are summed up
+        self.assertEqual(records[2]['calls'], 3)
+        self.assertEqual(len(portal_modifier.getProfileSummary()), 10)
+
+    def test14_profilingThreads(self):
+        profile = ModifierProfile()
+        token = object()
+        profile.record('1', 'persistent_id', 1.0, token=token)
+
+        # a clone operation of another thread doesn't close the record
+        def cloneInOtherThread():
+            profile.record('1', 'persistent_id', 1.0, token=object())
+        thread = threading.Thread(target=cloneInOtherThread)
+        thread.start()
+        thread.join()
+
+        profile.record('1', 'persistent_id', 1.0, token=token)
+        self.assertEqual([r['calls'] for r in profile.listRecords()], [2, 1])
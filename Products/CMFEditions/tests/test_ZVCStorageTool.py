@@ -27,9 +27,18 @@
 from Products.CMFEditions.tests.base import CMFEditionsBaseTestCase
 
 from zope.interface.verify import verifyObject
+from BTrees.IIBTree import IITreeSet
+from BTrees.OOBTree import OOBTree
+from ZODB.POSException import ConflictError
 from OFS.ObjectManager import ObjectManager
 
 from Products.CMFEditions.ArchivistTool import ObjectData
+from Products.CMFEditions.ZVCStorageTool import SerializedPayload
+from Products.CMFEditions.ZVCStorageTool import DeltaPayload
+from Products.CMFEditions.ZVCStorageTool import PayloadReference
+from Products.CMFEditions.ZVCStorageTool import SharedPayload
+from Products.CMFEditions.ZVCStorageTool import CompressedData
+from Products.CMFEditions.ZVCStorageTool import ShadowHistory
 from Products.CMFEditions.interfaces.IStorage import IStorage
 from Products.CMFEditions.interfaces.IStorage import IPurgeSupport
 from Products.CMFEditions.interfaces.IStorage import StorageUnregisteredError
@@ -446,6 +455,75 @@ class TestZVCStorageTool(CMFEditionsBaseTestCase):
         self.assertEqual(history.retrieve(2)['metadata']['sys_metadata']['comment'], "saved v3")
         self.assertEqual(history.retrieve(3)['metadata']['sys_metadata']['comment'], "saved v4")
 
+    def test15_retrieveMany(self):
+        portal_storage = self.portal.portal_historiesstorage
+        self._setupMinimalHistory()
+        portal_storage.purge(1, 1, metadata=self.buildMetadata("purged v2"))
+
+        vdatas = portal_storage.retrieveMany(1, (3, 0, 2))
+        self.assertEqual([vdata.object.object.text for vdata in vdatas],
+                         ['v4 of text', 'v1 of text', 'v3 of text'])
+        self.assertEqual([self.getComment(vdata) for vdata in vdatas],
+                         ['saved v4', 'saved v1', 'saved v3'])
+
+        vdatas = portal_storage.retrieveMany(1, (0, 1), countPurged=False)
+        self.assertEqual([vdata.object.object.text for vdata in vdatas],
+                         ['v1 of text', 'v3 of text'])
+
+        self.assertRaises(StorageRetrieveError,
+                          portal_storage.retrieveMany, 1, (0, 4))
+
+    def test16_getReferencedData(self):
+        portal_storage = self.portal.portal_historiesstorage
+
+        obj = Dummy()
+        obj.text = 'v1 of text'
+        portal_storage.register(1, ObjectData(obj),
+                                referenced_data={'mod/name': 'v1 data'},
+                                metadata=self.buildMetadata('saved v1'))
+        obj = Dummy()
+        obj.text = 'v2 of text'
+        portal_storage.save(1, ObjectData(obj),
+                            referenced_data={'mod/name': 'v2 data'},
+                            metadata=self.buildMetadata('saved v2'))
+
+        self.assertEqual(portal_storage.getReferencedData(1),
+                         {'mod/name': 'v2 data'})
+        self.assertEqual(portal_storage.getReferencedData(1, 0),
+                         {'mod/name': 'v1 data'})
+
+        portal_storage.purge(1, 1, metadata=self.buildMetadata("purged v2"))
+        self.assertEqual(portal_storage.getReferencedData(1, countPurged=False),
+                         {'mod/name': 'v1 data'})
+
+        self.assertRaises(StorageRetrieveError,
+                          portal_storage.getReferencedData, 1, 5)
+
+    def test17_purgeMany(self):
+        self._setupMinimalHistory()
+        portal_storage = self.portal.portal_historiesstorage
+
+        # selectors not counting purged versions are resolved up front
+        purged = portal_storage.purgeMany(1, [0, 2],
+                                          metadata=self.buildMetadata("purged"),
+                                          countPurged=False)
+        self.assertEqual(purged, 2)
+        self.assertEqual(len(portal_storage.getHistory(1)), 4)
+        self.assertEqual(len(portal_storage.getHistory(1, countPurged=False)),
+                         2)
+        texts = [portal_storage.retrieve(1, i, countPurged=False)
+                 .object.object.text for i in range(2)]
+        self.assertEqual(texts, ['v2 of text', 'v4 of text'])
+        retrieved_obj = portal_storage.retrieve(history_id=1, selector=2,
+                                                substitute=False)
+        self.failIf(retrieved_obj.isValid())
+        self.assertEqual(self.getComment(retrieved_obj), "purged")
+
+        # purged versions aren't purged again
+        self.assertEqual(portal_storage.purgeMany(1, [0, 1, 2]), 1)
+        self.assertEqual(len(portal_storage.getHistory(1, countPurged=False)),
+                         1)
+
 
 class TestMemoryStorage(TestZVCStorageTool):
 
@@ -453,3 +531,502 @@ class TestMemoryStorage(TestZVCStorageTool):
         # install the memory storage
         tool = MemoryStorage()
         setattr(self.portal, tool.getId(), tool)
+
+
+class TestZVCStorageToolInternals(CMFEditionsBaseTestCase):
+    """Tests depending on implementation details of the ZVC storage
+    """
+
+    def afterSetUp(self):
+        self.setRoles(['Manager',])
+        self.portal.portal_historiesstorage._shadowStorage = None
+        self.portal.portal_historiesstorage._statistics = None
+        try:
+            del self.portal.portal_purgepolicy
+        except AttributeError:
+            pass
+
+    def buildMetadata(self, comment):
+        return {'sys_metadata': {'comment': comment}}
+
+    def _saveVersion(self, history_id, version, padding=''):
+        portal_storage = self.portal.portal_historiesstorage
+        obj = Dummy()
+        obj.text = '%s of text%s' % (version, padding)
+        metadata = self.buildMetadata('saved %s' % version)
+        if portal_storage.isRegistered(history_id):
+            return portal_storage.save(history_id, ObjectData(obj),
+                                       metadata=metadata)
+        return portal_storage.register(history_id, ObjectData(obj),
+                                       metadata=metadata)
+
+    def _saveVersions(self, history_id, count, padding=''):
+        for i in range(count):
+            self._saveVersion(history_id, 'v%s' % (i+1), padding)
+
+    def _getStoredObject(self, history_id, selector):
+        portal_storage = self.portal.portal_historiesstorage
+        zvc_histid, zvc_selector = \
+            portal_storage._getZVCAccessInfo(history_id, selector, True)
+        version = portal_storage._getZVCVersion(zvc_histid, zvc_selector)
+        return version._data._object
+
+    def test01_retrieveReadsMetadataFromShadowHistory(self):
+        portal_storage = self.portal.portal_historiesstorage
+        self._saveVersions(1, 3)
+
+        # the ZVC log isn't consulted anymore if the shadow history
+        # caches the metadata
+        def failing(*args):
+            self.fail("ZVC log scanned")
+        portal_storage._retrieveZVCLogEntry = failing
+
+        vdata = portal_storage.retrieve(1, 1)
+        self.assertEqual(vdata.metadata['sys_metadata']['comment'],
+                         'saved v2')
+        # metadata returned is a copy
+        vdata.metadata['sys_metadata']['comment'] = 'changed'
+        vdata = portal_storage.retrieve(1, 1)
+        self.assertEqual(vdata.metadata['sys_metadata']['comment'],
+                         'saved v2')
+
+    def test02_migrateShadowMetadata(self):
+        portal_storage = self.portal.portal_historiesstorage
+        self._saveVersions(1, 3)
+
+        # simulate an old storage without metadata in the shadow records
+        history = portal_storage._getShadowHistory(1)
+        for vid in history._full.keys():
+            shadowInfo = history._full[vid]
+            del shadowInfo['metadata']
+            history._full[vid] = shadowInfo
+
+        # falls back to the ZVC log before the migration
+        vdata = portal_storage.retrieve(1, 2)
+        self.assertEqual(vdata.metadata['sys_metadata']['comment'],
+                         'saved v3')
+
+        self.assertEqual(portal_storage.migrateShadowMetadata(), (1, 3))
+        self.assertEqual(portal_storage.migrateShadowMetadata(), (0, 0))
+        for vid in range(3):
+            metadata = history.retrieve(vid)['metadata']
+            self.assertEqual(metadata['sys_metadata']['comment'],
+                             'saved v%s' % (vid+1))
+
+    def test03_serializedPayloads(self):
+        portal_storage = self.portal.portal_historiesstorage
+        self._saveVersion(1, 'v1')
+        portal_storage.serializedPayloads = True
+        self._saveVersion(1, 'v2')
+
+        self.failIf(isinstance(self._getStoredObject(1, 0),
+                               SerializedPayload))
+        payload = self._getStoredObject(1, 1)
+        self.failUnless(isinstance(payload, SerializedPayload))
+
+        # the size is the size of the pickle
+        vdata = portal_storage.retrieve(1, 1)
+        self.assertEqual(vdata.metadata['sys_metadata']['approxSize'],
+                         payload.getSize())
+
+        # both formats are readable
+        self.assertEqual(portal_storage.retrieve(1, 0).object.object.text,
+                         'v1 of text')
+        self.assertEqual(vdata.object.object.text, 'v2 of text')
+
+        # purging replaces the payload
+        portal_storage.purge(1, 1, metadata=self.buildMetadata('purged'))
+        self.failIf(portal_storage.retrieve(1, 1).isValid())
+
+    def test04_deltaPayloads(self):
+        portal_storage = self.portal.portal_historiesstorage
+        portal_storage.deltaSnapshotInterval = 3
+        padding = '\n<p>unchanged paragraph</p>' * 100
+        self._saveVersions(1, 7, padding)
+
+        # every third and the youngest version are fully stored
+        for selector in range(7):
+            payload = self._getStoredObject(1, selector)
+            if selector in (0, 3, 6):
+                self.assertEqual(payload.__class__, SerializedPayload)
+            else:
+                self.failUnless(isinstance(payload, DeltaPayload))
+                self.assertEqual(payload.getBaseVersionId(),
+                                 str(selector + 2))
+                self.failUnless(payload.getStoredSize() < payload.getSize())
+
+        for selector in range(7):
+            vdata = portal_storage.retrieve(1, selector)
+            self.assertEqual(vdata.object.object.text,
+                             'v%s of text%s' % (selector + 1, padding))
+
+        # purging the base of a delta stores the older version fully
+        portal_storage.purge(1, 2, metadata=self.buildMetadata('purged'))
+        self.assertEqual(self._getStoredObject(1, 1).__class__,
+                         SerializedPayload)
+        self.assertEqual(portal_storage.retrieve(1, 1).object.object.text,
+                         'v2 of text%s' % padding)
+        # the next saved version doesn't touch the fully stored version
+        self._saveVersion(1, 'v8', padding)
+        self.assertEqual(self._getStoredObject(1, 6).__class__,
+                         SerializedPayload)
+        self.failUnless(isinstance(self._getStoredObject(1, 5),
+                                   DeltaPayload))
+        portal_storage.purge(1, 6, metadata=self.buildMetadata('purged'))
+        self.assertEqual(portal_storage.retrieve(1, 5).object.object.text,
+                         'v6 of text%s' % padding)
+
+    def test05_deduplicatePayloads(self):
+        portal_storage = self.portal.portal_historiesstorage
+        portal_storage.deduplicatePayloads = True
+        obj1 = Dummy()
+        obj1.text = 'v1 of text'
+        obj2 = Dummy()
+        obj2.text = 'v2 of text'
+        portal_storage.register(1, ObjectData(obj1),
+                                metadata=self.buildMetadata('saved v1'))
+        portal_storage.save(1, ObjectData(obj2),
+                            metadata=self.buildMetadata('saved v2'))
+        portal_storage.save(1, ObjectData(obj1),
+                            metadata=self.buildMetadata('reverted to v1'))
+        portal_storage.register(2, ObjectData(obj1),
+                                metadata=self.buildMetadata('copy of v1'))
+
+        # identical versions share the payload
+        ref1 = self._getStoredObject(1, 0)
+        ref2 = self._getStoredObject(1, 1)
+        self.failUnless(isinstance(ref1, PayloadReference))
+        self.assertEqual(self._getStoredObject(1, 2).getDigest(),
+                         ref1.getDigest())
+        self.assertEqual(self._getStoredObject(2, 0).getDigest(),
+                         ref1.getDigest())
+        self.assertNotEqual(ref2.getDigest(), ref1.getDigest())
+
+        payloadStore = portal_storage._getPayloadStore()
+        size1, size2 = ref1.getSize(), ref2.getSize()
+        self.assertEqual(payloadStore.getSizes(),
+                         (size1 + size2, 3 * size1 + size2))
+
+        # the size of a version is the one of its payload, not the one
+        # of the reference
+        for history_id, selector, size in ((1, 0, size1), (1, 1, size2),
+                                           (1, 2, size1), (2, 0, size1)):
+            sys_metadata = portal_storage.getMetadata(history_id, selector)[
+                'sys_metadata']
+            self.assertEqual(sys_metadata['approxSize'], size)
+
+        self.assertEqual(portal_storage.retrieve(1, 1).object.object.text,
+                         'v2 of text')
+        self.assertEqual(portal_storage.retrieve(1, 2).object.object.text,
+                         'v1 of text')
+        self.assertEqual(portal_storage.retrieve(2, 0).object.object.text,
+                         'v1 of text')
+
+        # the shared payload is removed with the last reference only
+        portal_storage.purge(1, 0, metadata=self.buildMetadata('purged'))
+        portal_storage.purge(1, 2, metadata=self.buildMetadata('purged'))
+        self.assertEqual(portal_storage.retrieve(2, 0).object.object.text,
+                         'v1 of text')
+        portal_storage.purge(2, 0, metadata=self.buildMetadata('purged'))
+        self.failIf(ref1.getDigest() in payloadStore._payloads)
+        self.assertEqual(payloadStore.getSizes(), (size2, size2))
+
+    def test06_compression(self):
+        portal_storage = self.portal.portal_historiesstorage
+        padding = '\n<p>unchanged paragraph</p>' * 100
+        self._saveVersion(1, 'v1', padding)
+        portal_storage.compressionAlgorithm = 'zlib'
+        portal_storage.compressionMinSize = 100
+
+        obj = Dummy()
+        obj.text = 'v2 of text%s' % padding
+        referenced_data = {'body': 'body text ' * 100, 'small': 'small'}
+        portal_storage.save(1, ObjectData(obj), referenced_data,
+                            metadata=self.buildMetadata('saved v2'))
+
+        payload = self._getStoredObject(1, 1)
+        self.assertEqual(payload._compression, 'zlib')
+        self.failUnless(payload.getStoredSize() < payload.getSize())
+        shadowInfo = portal_storage._getShadowHistory(1).retrieve(1)
+        self.failUnless(isinstance(shadowInfo['referenced_data']['body'],
+                                   CompressedData))
+        self.assertEqual(shadowInfo['referenced_data']['small'], 'small')
+
+        # the raw and the stored size are recorded
+        vdata = portal_storage.retrieve(1, 1)
+        sys_metadata = vdata.metadata['sys_metadata']
+        self.failUnless(sys_metadata['storedSize'] <
+                        sys_metadata['approxSize'])
+
+        # old uncompressed and new compressed versions are readable
+        self.assertEqual(vdata.object.object.text, 'v2 of text%s' % padding)
+        self.assertEqual(vdata.referenced_data, referenced_data)
+        self.assertEqual(portal_storage.retrieve(1, 0).object.object.text,
+                         'v1 of text%s' % padding)
+
+    def test07_retrieveManyDeltaPayloads(self):
+        portal_storage = self.portal.portal_historiesstorage
+        portal_storage.deltaSnapshotInterval = 5
+        padding = '\n<p>unchanged paragraph</p>' * 100
+        self._saveVersions(1, 5, padding)
+
+        # every pickle is rebuilt once only
+        applied = []
+        applyTo = DeltaPayload.applyTo
+        def countingApplyTo(self, base_data):
+            applied.append(self)
+            return applyTo(self, base_data)
+        DeltaPayload.applyTo = countingApplyTo
+        try:
+            vdatas = portal_storage.retrieveMany(1, range(5))
+        finally:
+            DeltaPayload.applyTo = applyTo
+
+        self.assertEqual(len(applied), 3)
+        for selector, vdata in enumerate(vdatas):
+            self.assertEqual(vdata.object.object.text,
+                             'v%s of text%s' % (selector + 1, padding))
+
+    def test08_statistics(self):
+        portal_storage = self.portal.portal_historiesstorage
+        self._saveVersions(1, 3)
+        self._saveVersions(2, 2)
+
+        def getSummaries():
+            return portal_storage.zmi_getStorageStatistics()['summaries']
+
+        summaries = getSummaries()
+        self.assertEqual(summaries['existingHistories'], 2)
+        self.assertEqual(summaries['existingVersions'], 5)
+        self.assertEqual(summaries['deletedHistories'], 0)
+        size = summaries['existingSize']
+        self.assertEqual(size,
+            portal_storage._getShadowHistory(1).getSize()[0] +
+            portal_storage._getShadowHistory(2).getSize()[0])
+
+        # purging decrements the aggregates
+        portal_storage.purge(1, 0, metadata=self.buildMetadata('purged'))
+        summaries = getSummaries()
+        self.assertEqual(summaries['existingVersions'], 4)
+        self.failUnless(summaries['existingSize'] < size)
+
+        # histories of deleted items are counted separately
+        portal_storage.setHistoryDeleted(2)
+        summaries = getSummaries()
+        self.assertEqual(summaries['existingHistories'], 1)
+        self.assertEqual(summaries['existingVersions'], 2)
+        self.assertEqual(summaries['deletedHistories'], 1)
+        self.assertEqual(summaries['deletedVersions'], 2)
+
+        # saving again implies the item exists
+        self._saveVersion(2, 'v3')
+        summaries = getSummaries()
+        self.assertEqual(summaries['existingHistories'], 2)
+        self.assertEqual(summaries['existingVersions'], 5)
+        self.assertEqual(summaries['deletedHistories'], 0)
+
+        # the listing of the histories is paginated
+        statistics = portal_storage.zmi_getStorageStatistics(b_size=1)
+        self.assertEqual(len(statistics['deleted']), 1)
+        self.assertEqual(statistics['batch']['next'], 1)
+        statistics = portal_storage.zmi_getStorageStatistics(1, 1)
+        self.assertEqual(statistics['batch']['previous'], 0)
+        self.assertEqual(statistics['batch']['next'], None)
+
+        # rebuilding leads to the same totals (the dummy histories
+        # don't have a working copy and are counted as deleted)
+        existing = getSummaries()
+        self.assertEqual(portal_storage.rebuildStatistics(), 2)
+        summaries = getSummaries()
+        self.assertEqual(summaries['deletedHistories'], 2)
+        self.assertEqual(summaries['deletedVersions'],
+                         existing['existingVersions'])
+        self.assertEqual(summaries['deletedSize'], existing['existingSize'])
+
+    def test09_availableVersions(self):
+        portal_storage = self.portal.portal_historiesstorage
+        self._saveVersions(1, 6)
+        history = portal_storage._getShadowHistory(1)
+
+        # purging the oldest versions (like ``KeepLastNVersionsTool``)
+        for i in range(2):
+            portal_storage.purge(1, 0, metadata=self.buildMetadata('purged'),
+                                 countPurged=False)
+        self.assertEqual(history.getLength(countPurged=False), 4)
+        self.assertEqual(history.getVersionId(0, countPurged=False), 2)
+
+        # purging in the middle leaves a gap
+        portal_storage.purge(1, 3, metadata=self.buildMetadata('purged'))
+        self.assertEqual(list(history._available), [2, 4, 5])
+        self.assertEqual(history.getVersionId(1, countPurged=False), 4)
+        self.assertEqual(history.getPreviousAvailable(4), 2)
+        self.assertEqual(history.getPreviousAvailable(2), None)
+        self.assertEqual(history.getLastAvailable(), 5)
+
+        # purging the youngest version (selecting it by ``None`` has to
+        # select the youngest available one)
+        portal_storage.purge(1, 5, metadata=self.buildMetadata('purged'))
+        self.assertEqual(history.getVersionId(None, countPurged=True), 5)
+        self.assertEqual(history.getVersionId(None, countPurged=False), 4)
+        self.assertEqual(
+            portal_storage.retrieve(1, countPurged=False).object.object.text,
+            'v5 of text')
+        self._saveVersion(1, 'v6')
+        self.assertEqual(history.getVersionId(None, countPurged=False), 6)
+
+        # histories of older storages keep the ids in a list
+        history._available = [2, 4, 6]
+        del history._availableLength
+        self.assertEqual(history.getLength(countPurged=False), 3)
+        self.assertEqual(history.getVersionId(-1, countPurged=False), 6)
+        self.assertEqual(portal_storage.migrateAvailableVersions(), 1)
+        self.assertEqual(portal_storage.migrateAvailableVersions(), 0)
+        self.failUnless(isinstance(history._available, IITreeSet))
+        self.assertEqual(history.getLength(countPurged=False), 3)
+        self._saveVersion(1, 'v7')
+        self.assertEqual(list(history._available), [2, 4, 6, 7])
+
+    def test10_shardedShadowStorage(self):
+        portal_storage = self.portal.portal_historiesstorage
+        for history_id in range(1, 4):
+            self._saveVersions(history_id, 2)
+
+        # simulate an older shadow storage keeping all histories in one tree
+        storage = portal_storage._getShadowStorage()
+        histories = OOBTree()
+        for history_id in storage.getHistoryIds():
+            histories[history_id] = storage.getHistory(history_id)
+        storage._storage = histories
+        storage._shards = None
+        self.assertEqual(portal_storage.retrieve(2, 1).object.object.text,
+                         'v2 of text')
+
+        self.assertEqual(portal_storage.shardShadowStorage(), 3)
+        self.assertEqual(portal_storage.shardShadowStorage(), 0)
+        self.assertEqual(sorted(storage.getHistoryIds()), [1, 2, 3])
+        self.assertEqual(portal_storage.retrieve(2, 1).object.object.text,
+                         'v2 of text')
+
+    def test11_shadowHistoryConflictResolution(self):
+        portal_storage = self.portal.portal_historiesstorage
+        self._saveVersions(1, 1)
+        history = portal_storage._getShadowHistory(1)
+        old = {'nextVersionId': 1, 'deleted': False, '_approxSize': 10}
+
+        # marking the item deleted concurrently to a save is merged
+        deleted = dict(old, deleted=True)
+        saved = dict(old, nextVersionId=2, _approxSize=20)
+        self.assertEqual(history._p_resolveConflict(old, deleted, saved),
+                         {'nextVersionId': 2, 'deleted': True,
+                          '_approxSize': 20})
+
+        # two saves of the same history conflict
+        self.assertRaises(ConflictError, history._p_resolveConflict,
+                          old, saved, dict(saved, _approxSize=30))
+
+    def test12_modificationDateCachedInShadowHistory(self):
+        portal_storage = self.portal.portal_historiesstorage
+        self._saveVersions(1, 3)
+        history = portal_storage._getShadowHistory(1)
+        dates = [history.retrieve(vid)['modified'] for vid in range(3)]
+        self.failIf(None in dates)
+
+        # the versions aren't loaded to get the modification date
+        def failing(*args, **kw):
+            self.fail("version retrieved")
+        portal_storage.retrieve = failing
+        self.assertEqual(portal_storage.getModificationDate(1, 1), dates[1])
+        self.assertEqual(portal_storage.getModificationDate(1), dates[2])
+        del portal_storage.retrieve
+
+        # simulate an old storage without modification dates
+        for vid in history._full.keys():
+            shadowInfo = history._full[vid]
+            del shadowInfo['modified']
+            history._full[vid] = shadowInfo
+
+        # falls back to retrieving the version before the migration
+        self.assertEqual(portal_storage.getModificationDate(1, 1), dates[1])
+
+        self.assertEqual(portal_storage.migrateModificationDates(), (1, 3))
+        self.assertEqual(portal_storage.migrateModificationDates(), (0, 0))
+        for vid in range(3):
+            self.assertEqual(history.retrieve(vid)['modified'], dates[vid])
+
+    def test13_sharedPayloadConflictResolution(self):
+        payload = SharedPayload(None)
+        old = {'payload': None, 'refcount': 2}
+
+        # concurrently added and released references add up
+        self.assertEqual(payload._p_resolveConflict(
+                             old, dict(old, refcount=3), dict(old, refcount=1)),
+                         {'payload': None, 'refcount': 2})
+
+        # releasing the last reference concurrently to adding one conflicts
+        self.assertRaises(ConflictError, payload._p_resolveConflict,
+                          old, dict(old, refcount=0), dict(old, refcount=3))
+        self.assertRaises(ConflictError, payload._p_resolveConflict,
+                          old, dict(old, refcount=3), dict(old, refcount=0))
+
+        # as does adding the payload concurrently
+        self.assertRaises(ConflictError, payload._p_resolveConflict,
+                          dict(old, refcount=0), dict(old, refcount=1),
+                          dict(old, refcount=1))
+
+    def test14_compressionAndDeduplication(self):
+        portal_storage = self.portal.portal_historiesstorage
+        portal_storage.compressionAlgorithm = 'zlib'
+        portal_storage.compressionMinSize = 100
+        portal_storage.deduplicatePayloads = True
+        padding = '\n<p>unchanged paragraph</p>' * 100
+        referenced_data = {'body': 'body text ' * 100}
+        obj = Dummy()
+        obj.text = 'v1 of text%s' % padding
+        portal_storage.register(1, ObjectData(obj), referenced_data,
+                                metadata=self.buildMetadata('saved v1'))
+        portal_storage.register(2, ObjectData(obj), referenced_data,
+                                metadata=self.buildMetadata('copy of v1'))
+
+        # the shared payload is stored compressed
+        reference = self._getStoredObject(2, 0)
+        self.failUnless(isinstance(reference, PayloadReference))
+        payload = portal_storage._getPayloadStore().get(reference.getDigest())
+        self.failUnless(payload.getStoredSize() < payload.getSize())
+
+        # the sizes of the first and of the sharing version are the same
+        sizes = []
+        for history_id in (1, 2):
+            sys_metadata = portal_storage.getMetadata(history_id, 0)[
+                'sys_metadata']
+            sizes.append((sys_metadata['approxSize'],
+                          sys_metadata['storedSize']))
+        self.assertEqual(sizes[0], sizes[1])
+        approxSize, storedSize = sizes[0]
+        self.failUnless(approxSize > payload.getSize())
+        self.failUnless(payload.getStoredSize() < storedSize < approxSize)
+
+    def test15_largeGappedHistory(self):
+        history = ShadowHistory()
+        for i in range(3000):
+            history.save({'metadata': {'sys_metadata': {'approxSize': 1}}})
+        # purge the oldest versions and every third one of the others
+        purged = {'sys_metadata': {'comment': 'purged'}}
+        for version_id in range(100) + range(102, 3000, 3):
+            history.purge(version_id, purged, countPurged=True)
+        available = list(history._available)
+        self.assertEqual(history.getLength(countPurged=False),
+                         len(available))
+
+        # the positional selectors skip the gaps
+        for selector in (0, 1, 2, 3, 1000, len(available) - 1, -1):
+            self.assertEqual(history.getVersionId(selector,
+                                                  countPurged=False),
+                             available[selector])
+
+        # histories of older storages don't know the purged versions yet
+        del history._purged
+        self.assertEqual(history.getVersionId(1000, countPurged=False),
+                         available[1000])
+        self.failUnless(history.migrateAvailable())
+        self.assertEqual(history.getVersionId(1000, countPurged=False),
+                         available[1000])
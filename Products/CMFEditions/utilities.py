@@ -114,13 +114,51 @@ def isObjectChanged(obj):
             changed = True
     return changed
 
-def maybeSaveVersion(obj, policy='at_edit_autoversion', comment='', force=False):
+def maybeSaveVersion(obj, policy='at_edit_autoversion', comment='', force=False,
+                     deferred=False):
+    """Saves a version if the object supports the policy (or if forced).
+
+    If ``deferred`` is ``True`` and the repository is in deferred saving
+    mode the save is queued and done after the transaction committed.
+    """
     pr = getToolByName(obj, 'portal_repository', None)
     if pr is not None:
         isVersionable = pr.isVersionable(obj)
 
         if isVersionable and (force or pr.supportsPolicy(obj, policy)):
-            pr.save(obj=obj, comment=comment)
+            if deferred and pr.isDeferredSaving():
+                pr.enqueueSave(obj=obj, comment=comment)
+            else:
+                pr.save(obj=obj, comment=comment)
+
+def mergeComments(comments):
+    """Merges the comments of several saves coalesced to one version.
+
+    A single distinct comment is returned as is (keeping i18n messages).
+    """
+    merged = []
+    for comment in comments:
+        if comment and comment not in merged:
+            merged.append(comment)
+    if not merged:
+        return ''
+    if len(merged) == 1:
+        return merged[0]
+    return u'; '.join([isinstance(c, str) and c.decode('utf-8', 'replace')
+                       or unicode(c) for c in merged])
+
+def getUser(context, name):
+    """Returns the user with the given name wrapped in its user folder
+
+    Users of the portal are looked up first, then the ones of the Zope
+    root. Returns None if the user doesn't exist.
+    """
+    for acl_users in (getToolByName(context, 'acl_users'),
+                      context.getPhysicalRoot().acl_users):
+        user = acl_users.getUser(name)
+        if user is not None:
+            return user.__of__(acl_users)
+    return None
 
 def wrap(obj, parent):
     """Copy the context and containment from one object to another.